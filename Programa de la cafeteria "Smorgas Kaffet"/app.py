@@ -6,21 +6,40 @@
 
 import secrets
 import re
+import sys
+import csv
+import io
 import json
+import logging
 import os
+import queue
+import random
+import threading
+import time
+import uuid
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FuturoVencido
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 from functools import wraps
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
+import click
+import multiprocessing
 import pymysql
-from pymysql.cursors import DictCursor
-from pymysql.err import IntegrityError, OperationalError
+from pymysql.constants import SERVER_STATUS
+from pymysql.cursors import DictCursor, SSDictCursor
+from pymysql.err import IntegrityError, InterfaceError, OperationalError
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, jsonify
+    session, flash, jsonify, has_request_context, g, Response, stream_with_context
 )
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
-from waitress import serve
+from waitress import create_server
 
 # ---------------- Configuración Flask ----------------
 app = Flask(__name__)
@@ -32,13 +51,88 @@ app.config["SESSION_TTL_MIN"] = 30  # 30 min, puedes ajustar
 SESSION_TTL_MIN = app.config["SESSION_TTL_MIN"]
 
 
+# ---------------- Instrumentación de BD por petición ----------------
+# Cada petición acumula en flask.g: nº de sentencias, tiempo total en BD, tiempo para
+# obtener conexión (espera en el pool + connect/ping) y la sentencia más lenta.
+# Se publica en la cabecera Server-Timing y se registra en el log si la petición
+# completa tarda más de PETICION_LENTA_MS.
+PETICION_LENTA_MS = float(os.getenv("PETICION_LENTA_MS", "500"))
+
+_RE_SQL_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b")
+_RE_SQL_TUPLAS = re.compile(r"(\([?, ]*\))(?:\s*,\s*\([?, ]*\))+")
+_RE_ESPACIOS = re.compile(r"\s+")
+
+def normalizar_sql(sql):
+    """SQL sin literales ni espacios de sobra: misma sentencia con otros valores = mismo texto."""
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    sql = _RE_SQL_LITERAL.sub("?", sql)
+    sql = _RE_SQL_TUPLAS.sub(r"\1, ...", sql)   # INSERT multi-fila -> (?, ?), ...
+    return _RE_ESPACIOS.sub(" ", sql).strip()[:300]
+
+def _medicion():
+    """Acumulador de la petición en curso (None fuera de una petición: tareas de fondo)."""
+    return g.get("db_medicion") if has_request_context() else None
+
+class _CursorMedido(DictCursor):
+    """
+    DictCursor que mide cada sentencia enviada al servidor.
+    executemany() de PyMySQL termina llamando a execute(), así que también queda medido.
+    """
+
+    def execute(self, query, args=None):
+        m = _medicion()
+        if m is None:
+            return super().execute(query, args)
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            dur = time.perf_counter() - t0
+            m["sentencias"] += 1
+            m["db_seg"] += dur
+            if dur > m["lenta_seg"]:
+                m["lenta_seg"], m["lenta_sql"] = dur, query   # se normaliza solo si se reporta
+
+@app.before_request
+def _iniciar_medicion():
+    g.db_medicion = {
+        "inicio": time.perf_counter(), "sentencias": 0, "db_seg": 0.0,
+        "conexiones": 0, "conexion_seg": 0.0, "lenta_seg": 0.0, "lenta_sql": None,
+    }
+
+@app.after_request
+def _publicar_medicion(resp):
+    """Cabecera Server-Timing (visible en las DevTools del navegador) + log de peticiones lentas."""
+    m = g.get("db_medicion")
+    if m is None:
+        return resp
+    total_ms = (time.perf_counter() - m["inicio"]) * 1000
+    db_ms = m["db_seg"] * 1000
+    resp.headers.add(
+        "Server-Timing",
+        f'db;dur={db_ms:.1f};desc="{m["sentencias"]} sentencias", '
+        f'dbconn;dur={m["conexion_seg"] * 1000:.1f};desc="{m["conexiones"]} conexiones", '
+        f'app;dur={total_ms:.1f}',
+    )
+    if total_ms >= PETICION_LENTA_MS:
+        app.logger.warning(
+            "Petición lenta %s %s: %.0f ms (BD %.0f ms en %d sentencias, conexión %.0f ms); "
+            "más lenta %.0f ms: %s",
+            request.method, request.path, total_ms, db_ms, m["sentencias"],
+            m["conexion_seg"] * 1000, m["lenta_seg"] * 1000,
+            normalizar_sql(m["lenta_sql"]) if m["lenta_sql"] else "-",
+        )
+    return resp
+
+
 # ---------------- Configuración BD (MariaDB) ----------------
 # Config común sin el usuario/contraseña (se eligen según la sesión)
 BASE_DB_CFG = {
     "host": "127.0.0.1",
     "port": 3306,
     "database": "proyecto_smorgas",
-    "cursorclass": DictCursor,
+    "cursorclass": _CursorMedido,
     "charset": "utf8mb4",
     "autocommit": False,
 }
@@ -53,43 +147,230 @@ ROLE_DB_CREDENTIALS = {
 DEFAULT_DB_USER = os.getenv("DB_USER_DEFAULT", "root")
 DEFAULT_DB_PASS = os.getenv("DB_PASS_DEFAULT", "")
 
-def get_db_connection():
+# ---------------- Pool de conexiones ----------------
+# waitress atiende con WAITRESS_THREADS hilos: nunca hay más peticiones simultáneas
+# que hilos, así que ese es el tope de conexiones por credencial.
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", "8"))
+POOL_MAX = int(os.getenv("DB_POOL_MAX", WAITRESS_THREADS))
+POOL_ESPERA_SEG = float(os.getenv("DB_POOL_ESPERA_SEG", "10"))   # espera máx. por una conexión libre
+POOL_PING_SEG = float(os.getenv("DB_POOL_PING_SEG", "30"))       # ping solo si estuvo ociosa más de esto
+POOL_IDLE_SEG = float(os.getenv("DB_POOL_IDLE_SEG", "300"))      # cierra conexiones ociosas más viejas
+
+# Se ejecuta una sola vez por conexión física (también al reconectar)
+SESSION_INIT_SQL = "SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED"
+
+
+class _PoolConexiones:
     """
-    Abre una conexión a MariaDB con credenciales dinámicas:
-    - Si hay sesión y rol: usa las credenciales mapeadas (admin/mesero).
-    - Si no hay sesión/rol: usa credenciales por defecto (root o variables de entorno).
-    - Fija nivel de aislamiento por sesión: READ COMMITTED (reduce bloqueos largos/lecturas repetidas).
+    Pool thread-safe de conexiones PyMySQL para UNA credencial (usuario/contraseña).
+    - Reutiliza conexiones físicas (evita handshake TCP + auth por petición).
+    - Aplica la configuración de sesión en la conexión (init_command), no por petición.
+    - Hace ping al tomar una conexión que estuvo ociosa más de POOL_PING_SEG.
+    - Cierra conexiones ociosas más viejas que POOL_IDLE_SEG.
+    - Limita a 'maximo' conexiones abiertas; si no hay libres, espera hasta POOL_ESPERA_SEG.
     """
-    cfg = dict(BASE_DB_CFG)
-    rol = session.get("rol")
-    creds = ROLE_DB_CREDENTIALS.get(rol)
 
+    def __init__(self, user, password, maximo=POOL_MAX):
+        self.cfg = dict(BASE_DB_CFG, user=user, password=password, init_command=SESSION_INIT_SQL)
+        self.maximo = maximo
+        self._cupos = threading.BoundedSemaphore(maximo)
+        self._lock = threading.Lock()
+        self._libres = []          # pila de (conexión, momento en que se liberó)
+        self.abiertas = 0
+        self.creadas = 0
+
+    def _conectar(self):
+        conn = pymysql.connect(**self.cfg)
+        with self._lock:
+            self.abiertas += 1
+            self.creadas += 1
+        return conn
+
+    def _cerrar(self, conn):
+        with self._lock:
+            self.abiertas -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _desalojar_ociosas(self, ahora):
+        """Saca del pool las conexiones ociosas vencidas (se cierran fuera del lock)."""
+        with self._lock:
+            vencidas = [c for c, t in self._libres if ahora - t > POOL_IDLE_SEG]
+            if vencidas:
+                self._libres = [(c, t) for c, t in self._libres if ahora - t <= POOL_IDLE_SEG]
+        for conn in vencidas:
+            self._cerrar(conn)
+
+    def tomar(self):
+        if not self._cupos.acquire(timeout=POOL_ESPERA_SEG):
+            raise OperationalError(0, "No hay conexiones libres a la BD (pool agotado).")
+        try:
+            ahora = time.monotonic()
+            self._desalojar_ociosas(ahora)
+            while True:
+                with self._lock:
+                    conn, liberada = self._libres.pop() if self._libres else (None, None)
+                if conn is None:
+                    return self._conectar()
+                if ahora - liberada < POOL_PING_SEG:
+                    return conn
+                try:
+                    conn.ping(reconnect=False)
+                    return conn
+                except Exception:
+                    self._cerrar(conn)   # conexión muerta: prueba con la siguiente
+        except BaseException:
+            self._cupos.release()
+            raise
+
+    def devolver(self, conn, descartar=False):
+        try:
+            if not descartar and conn.open:
+                # Nada de una petición debe filtrarse a la siguiente (locks, transacción abierta)
+                if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+                with self._lock:
+                    self._libres.append((conn, time.monotonic()))
+            else:
+                self._cerrar(conn)
+        except Exception:
+            self._cerrar(conn)
+        finally:
+            self._cupos.release()
+
+    def estadisticas(self):
+        with self._lock:
+            return {"abiertas": self.abiertas, "libres": len(self._libres),
+                    "creadas": self.creadas, "maximo": self.maximo}
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _credenciales(rol):
+    """Credenciales de BD para un rol (admin/mesero) o las de por defecto (root/env)."""
+    creds = ROLE_DB_CREDENTIALS.get(rol)
     if creds:
-        cfg.update(user=creds["user"], password=creds["password"])
+        return creds["user"], creds["password"]
+    return DEFAULT_DB_USER, DEFAULT_DB_PASS
+
+def _pool_para(rol):
+    clave = _credenciales(rol)
+    pool = _POOLS.get(clave)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(clave)
+            if pool is None:
+                pool = _POOLS[clave] = _PoolConexiones(*clave)
+    return pool
+
+@contextmanager
+def get_db_connection(rol=None):
+    """
+    Presta una conexión del pool a MariaDB con credenciales dinámicas:
+    - Si hay sesión y rol: usa las credenciales mapeadas (admin/mesero).
+    - Si no hay sesión/rol: usa credenciales por defecto (root o variables de entorno).
+    - 'rol' explícito permite usarla fuera de una petición (tareas de fondo).
+    - Nivel de aislamiento por sesión: READ COMMITTED (fijado al abrir la conexión física).
+    Uso:  with get_db_connection() as conn: ...
+    Al salir se devuelve al pool; si quedó una transacción abierta se hace rollback,
+    y si hubo un error de conexión se descarta.
+    """
+    if rol is None and has_request_context():
+        rol = session.get("rol")
+    pool = _pool_para(rol)
+    m = _medicion()
+    if m is None:
+        conn = pool.tomar()
     else:
-        cfg.update(user=DEFAULT_DB_USER, password=DEFAULT_DB_PASS)
-
-    conn = pymysql.connect(**cfg)
-    # Aislamiento pesimista razonable para concurrencia de edición
-    with conn.cursor() as cur:
-        cur.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
-    return conn
+        t0 = time.perf_counter()
+        conn = pool.tomar()
+        m["conexiones"] += 1
+        m["conexion_seg"] += time.perf_counter() - t0
+    try:
+        yield conn
+    except (OperationalError, InterfaceError):
+        pool.devolver(conn, descartar=not conn.open)
+        raise
+    except BaseException:
+        pool.devolver(conn)
+        raise
+    else:
+        pool.devolver(conn)
 
 # ---------- Helper de retry ante deadlocks / timeouts ----------
-def tx_with_retry(fn, retries=3):
+# Backoff exponencial con jitter completo: el intento i espera un tiempo aleatorio en
+# [0, min(TX_BACKOFF_MAX_SEG, TX_BACKOFF_BASE_SEG * 2**i)], para que los que chocaron
+# no vuelvan a entrar todos a la vez sobre los mismos locks. TX_PRESUPUESTO_SEG acota
+# el tiempo total (intentos + esperas) que una petición dedica a reintentar.
+TX_BACKOFF_BASE_SEG = float(os.getenv("TX_BACKOFF_BASE_SEG", "0.05"))
+TX_BACKOFF_MAX_SEG = float(os.getenv("TX_BACKOFF_MAX_SEG", "1.0"))
+TX_PRESUPUESTO_SEG = float(os.getenv("TX_PRESUPUESTO_SEG", "8.0"))
+
+class ConflictoVersion(Exception):
+    """En modo optimista: la fila cambió (Version distinta) desde que el cliente la leyó."""
+
+_REINTENTOS = {}   # sitio -> contadores (ver _stats_reintentos)
+_REINTENTOS_LOCK = threading.Lock()
+
+def _stats_reintentos(sitio):
+    st = _REINTENTOS.get(sitio)
+    if st is None:
+        with _REINTENTOS_LOCK:
+            st = _REINTENTOS.setdefault(sitio, {
+                "llamadas": 0, "intentos": 0, "deadlocks": 0, "lock_timeouts": 0,
+                "fallos": 0, "conflictos": 0, "espera_seg": 0.0,
+            })
+    return st
+
+def _contar(st, **incrementos):
+    with _REINTENTOS_LOCK:
+        for k, v in incrementos.items():
+            st[k] += v
+
+def estadisticas_reintentos():
+    """Copia de los contadores de tx_with_retry por sitio de llamada."""
+    with _REINTENTOS_LOCK:
+        return {sitio: dict(st) for sitio, st in _REINTENTOS.items()}
+
+def tx_with_retry(fn, retries=3, sitio="tx"):
     """
     Ejecuta una función transaccional 'fn()' con reintentos
     si ocurre deadlock (1213) o lock wait timeout (1205).
     La función 'fn' debe encargarse de abrir/cerrar su conexión y commit/rollback.
+    - Entre intentos espera con backoff exponencial + jitter.
+    - No reintenta si la espera se saldría del presupuesto TX_PRESUPUESTO_SEG.
+    - Acumula contadores por 'sitio' (ver estadisticas_reintentos()).
     """
+    st = _stats_reintentos(sitio)
+    _contar(st, llamadas=1)
+    inicio = time.monotonic()
     for i in range(retries):
+        _contar(st, intentos=1)
         try:
             return fn()
         except OperationalError as e:
             code = e.args[0] if e.args else None
+            if code == 1213:
+                _contar(st, deadlocks=1)
+            elif code == 1205:
+                _contar(st, lock_timeouts=1)
             if code in (1213, 1205) and i < retries - 1:
-                # reintenta
-                continue
+                espera = random.uniform(0, min(TX_BACKOFF_MAX_SEG, TX_BACKOFF_BASE_SEG * 2 ** i))
+                if time.monotonic() - inicio + espera <= TX_PRESUPUESTO_SEG:
+                    # reintenta
+                    time.sleep(espera)
+                    _contar(st, espera_seg=espera)
+                    continue
+            _contar(st, fallos=1)
+            raise
+        except ConflictoVersion:
+            _contar(st, conflictos=1)
+            raise
+        except Exception:
+            _contar(st, fallos=1)
             raise
 
 # ---------------- Helpers ----------------
@@ -115,16 +396,119 @@ def _session_active(cur, row_now):
         return (ahora - uv) <= timedelta(minutes=SESSION_TTL_MIN)
     return False
 
-def _bump_session(cur, id_usuario):
-    """Desliza la ventana de sesión (heartbeat)."""
-    nueva_exp = _now_sql() + timedelta(minutes=SESSION_TTL_MIN)
-    cur.execute("""
-        UPDATE TBL_USUARIOS
-           SET Ultimo_Visto = NOW(),
-               Session_Expira = %s
-         WHERE ID_Usuario = %s
-    """, (nueva_exp, id_usuario))
+SQL_SESION = """
+    SELECT ID_Usuario, Session_Token, Session_Expira, Ultimo_Visto
+      FROM TBL_USUARIOS
+     WHERE Nombre_Usuario=%s
+"""
+SQL_BUMP_SESION = """
+    UPDATE TBL_USUARIOS
+       SET Ultimo_Visto = NOW(),
+           Session_Expira = %s
+     WHERE ID_Usuario = %s
+"""
 
+def _bump_session(cur, id_usuario):
+    """Desliza la ventana de sesión (heartbeat). Devuelve (ultimo_visto, nueva_expiracion)."""
+    ahora = _now_sql()
+    nueva_exp = ahora + timedelta(minutes=SESSION_TTL_MIN)
+    cur.execute(SQL_BUMP_SESION, (nueva_exp, id_usuario))
+    return ahora, nueva_exp
+
+# ---------------- Caché de validación de sesión ----------------
+# Evita un SELECT + UPDATE + COMMIT en TBL_USUARIOS por cada petición autenticada:
+# - El token/expiración de cada usuario se guarda en memoria y solo se vuelve a leer
+#   de BD cada SESSION_VERIFICAR_SEG (cota del retraso para detectar que la sesión
+#   se cerró o se abrió en otro dispositivo).
+# - El heartbeat (Ultimo_Visto/Session_Expira) solo se escribe cuando la ventana
+#   deslizante avanzó al menos SESSION_BUMP_FRACCION del TTL. La expiración en BD
+#   puede quedar atrasada como mucho esa fracción (30 min * 0.1 = 3 min).
+SESSION_VERIFICAR_SEG = float(os.getenv("SESSION_VERIFICAR_SEG", "15"))
+SESSION_BUMP_FRACCION = float(os.getenv("SESSION_BUMP_FRACCION", "0.1"))
+
+_SESIONES = {}   # Nombre_Usuario -> {ID_Usuario, Session_Token, Session_Expira, Ultimo_Visto, verificada}
+_SESIONES_LOCK = threading.Lock()
+
+def _sesion_en_cache(user, token):
+    """Entrada en caché vigente (token igual y verificada hace poco) o None."""
+    ent = _SESIONES.get(user)
+    if (ent and ent["Session_Token"] == token
+            and time.monotonic() - ent["verificada"] < SESSION_VERIFICAR_SEG
+            and _session_active(None, ent)):
+        return ent
+    return None
+
+def _cachear_sesion(user, row):
+    ent = {
+        "ID_Usuario": row["ID_Usuario"],
+        "Session_Token": row["Session_Token"],
+        "Session_Expira": row["Session_Expira"],
+        "Ultimo_Visto": row.get("Ultimo_Visto"),
+        "verificada": time.monotonic(),
+    }
+    with _SESIONES_LOCK:
+        _SESIONES[user] = ent
+    return ent
+
+def _olvidar_sesion(user):
+    with _SESIONES_LOCK:
+        _SESIONES.pop(user, None)
+
+def _heartbeat_pendiente(ent):
+    """True si la ventana deslizante avanzó lo suficiente como para escribirla en BD."""
+    uv = ent.get("Ultimo_Visto")
+    if not uv:
+        return True
+    umbral = timedelta(minutes=SESSION_TTL_MIN) * SESSION_BUMP_FRACCION
+    return _now_sql() - uv >= umbral
+
+# ---------------- Barrido de sesiones vencidas ----------------
+# Una tarea de fondo limpia Session_Token/Session_Expira de las sesiones vencidas por
+# lotes con un UPDATE por rango de idx_session_expira (migraciones/004_expiracion_sesion.sql),
+# así login_requerido() solo lee: una sesión vencida se rechaza y el token queda para el
+# siguiente barrido. Session_Expira es siempre Ultimo_Visto + TTL (login y heartbeat la
+# escriben juntas), por lo que basta comparar contra ella.
+SESIONES_BARRIDO_SEG = float(os.getenv("SESIONES_BARRIDO_SEG", "60"))
+SESIONES_BARRIDO_LOTE = int(os.getenv("SESIONES_BARRIDO_LOTE", "500"))
+
+_BARRIDO_SESIONES = {"pasadas": 0, "limpiadas": 0, "ultima": None}
+_BARRIDO_LOCK = threading.Lock()   # contadores: el hilo de fondo y otra llamada a barrer_sesiones() pueden coincidir
+
+def barrer_sesiones():
+    """Limpia los tokens vencidos (por lotes, un COMMIT por lote). Devuelve cuántos limpió."""
+    ahora = _now_sql()
+    limpiadas = 0
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute("""
+                    UPDATE TBL_USUARIOS
+                       SET Session_Token = NULL,
+                           Session_Expira = NULL
+                     WHERE Session_Expira < %s
+                     ORDER BY Session_Expira
+                     LIMIT %s
+                """, (ahora, SESIONES_BARRIDO_LOTE))
+                conn.commit()
+                limpiadas += cur.rowcount
+                if cur.rowcount < SESIONES_BARRIDO_LOTE:
+                    break
+
+    # La caché tampoco guarda sesiones vencidas (ni crece con usuarios que ya no vuelven)
+    with _SESIONES_LOCK:
+        for user in [u for u, ent in _SESIONES.items() if ent["Session_Expira"] < ahora]:
+            del _SESIONES[user]
+
+    with _BARRIDO_LOCK:
+        _BARRIDO_SESIONES["pasadas"] += 1
+        _BARRIDO_SESIONES["limpiadas"] += limpiadas
+        _BARRIDO_SESIONES["ultima"] = ahora
+    if limpiadas:
+        app.logger.info("Barrido de sesiones: %d sesiones vencidas limpiadas", limpiadas)
+    return limpiadas
+
+
+CENTAVO = Decimal("0.01")
 
 def as_float(value):
     """Convierte Decimal/None a float de forma segura para JSON/render."""
@@ -132,6 +516,10 @@ def as_float(value):
         return 0.0
     return float(value) if isinstance(value, (Decimal, int, float)) else value
 
+def quiere_json():
+    """True si la petición viene de fetch() pidiendo JSON (Accept: application/json) en vez de HTML."""
+    return request.accept_mimetypes.best_match(["application/json", "text/html"]) == "application/json"
+
 def login_requerido(f):
     @wraps(f)
     def wrapped(*args, **kwargs):
@@ -141,41 +529,38 @@ def login_requerido(f):
         user  = session.get("usuario")
         token = session.get("sess_token")
 
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT ID_Usuario, Session_Token, Session_Expira, Ultimo_Visto
-                      FROM TBL_USUARIOS
-                     WHERE Nombre_Usuario=%s
-                """, (user,))
-                row = cur.fetchone()
-
-                # 1) Si no hay fila/token en BD o no coincide -> invalidar cookie
-                if not row or not row.get("Session_Token") or row["Session_Token"] != token:
-                    session.clear()
-                    flash("Tu sesión ya no es válida (iniciada en otro dispositivo o cerrada).", "warning")
-                    return redirect(url_for("login"))
+        ent = _sesion_en_cache(user, token)
+        if ent is not None and not _heartbeat_pendiente(ent):
+            # Camino rápido: sesión verificada hace poco y sin heartbeat pendiente (0 consultas)
+            return f(*args, **kwargs)
 
-                # 2) Si caducó la sesión -> invalidar
-                if not _session_active(cur, row):
-                    # limpiar en BD por consistencia
-                    cur.execute("""
-                        UPDATE TBL_USUARIOS
-                           SET Session_Token = NULL,
-                               Session_Expira = NULL
-                         WHERE ID_Usuario   = %s
-                    """, (row["ID_Usuario"],))
-                    conn.commit()
-                    session.clear()
-                    flash("Tu sesión ha expirado por inactividad.", "warning")
-                    return redirect(url_for("login"))
-
-                # 3) Heartbeat (extender vigencia deslizante)
-                _bump_session(cur, row["ID_Usuario"])
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if ent is None:
+                    cur.execute(SQL_SESION, (user,))
+                    row = cur.fetchone()
+
+                    # 1) Si no hay fila/token en BD o no coincide -> invalidar cookie
+                    if not row or not row.get("Session_Token") or row["Session_Token"] != token:
+                        _olvidar_sesion(user)
+                        session.clear()
+                        flash("Tu sesión ya no es válida (iniciada en otro dispositivo o cerrada).", "warning")
+                        return redirect(url_for("login"))
+
+                    # 2) Si caducó la sesión -> invalidar (el token lo limpia barrer_sesiones())
+                    if not _session_active(cur, row):
+                        _olvidar_sesion(user)
+                        session.clear()
+                        flash("Tu sesión ha expirado por inactividad.", "warning")
+                        return redirect(url_for("login"))
+
+                    ent = _cachear_sesion(user, row)
+
+                # 3) Heartbeat (extender vigencia deslizante) solo si la ventana avanzó
+                bump = _bump_session(cur, ent["ID_Usuario"]) if _heartbeat_pendiente(ent) else None
             conn.commit()
-        finally:
-            conn.close()
+        if bump:
+            ent["Ultimo_Visto"], ent["Session_Expira"] = bump
 
         return f(*args, **kwargs)
     return wrapped
@@ -202,56 +587,420 @@ def admin_requerido(f):
         return f(*args, **kwargs)
     return wrapped
 
+# ---------------- Resúmenes de ventas (rollups) ----------------
+# TBL_RESUMEN_PRODUCTO_DIA / _MESA_DIA / _MODO_DIA (migraciones/002_resumenes_ventas.sql)
+# se mantienen en la MISMA transacción que cada escritura (add, detalle_update,
+# detalles_guardar, update, delete) sumando diferencias; los reportes solo leen de ahí.
+# Los importes salen del detalle (Subtotal), no de los totales de cabecera.
+# Las diferencias se acumulan primero y se aplican al final, en orden fijo (producto,
+# mesa, modo; cada uno por clave): las filas de resumen del día son compartidas por
+# todas las cuentas, así se sostienen sus locks el menor tiempo posible y dos
+# transacciones nunca los piden en orden cruzado.
+def _delta_resumen():
+    return {"producto": {}, "mesa": {}, "modo": {}}
+
+def _sumar_cuenta(delta, clave, cuentas, cantidad, importe):
+    """clave: fila de TBL_COMPRA con ID_Fecha, ID_Mesa, ID_Modo_Entrega."""
+    for tabla, k in (("mesa", (clave["ID_Fecha"], int(clave["ID_Mesa"]))),
+                     ("modo", (clave["ID_Fecha"], int(clave["ID_Modo_Entrega"])))):
+        acc = delta[tabla].setdefault(k, [0, 0, Decimal("0.00")])
+        acc[0] += cuentas
+        acc[1] += cantidad
+        acc[2] += importe
+
+def _sumar_renglones(delta, clave, renglones, signo=1):
+    """Suma (signo=1) o resta (signo=-1) renglones {ID_Producto, Cantidad, Subtotal} de una cuenta."""
+    cant_total, imp_total = 0, Decimal("0.00")
+    for r in renglones:
+        acc = delta["producto"].setdefault((clave["ID_Fecha"], r["ID_Producto"]), [0, Decimal("0.00")])
+        acc[0] += signo * r["Cantidad"]
+        acc[1] += signo * r["Subtotal"]
+        cant_total += signo * r["Cantidad"]
+        imp_total += signo * r["Subtotal"]
+    return cant_total, imp_total
+
+def _sentencias_resumen(delta):
+    """[(sql, filas)] para executemany con las diferencias acumuladas, en el orden fijo."""
+    sentencias = []
+    productos = [(f, p, c, i) for (f, p), (c, i) in sorted(delta["producto"].items()) if c or i]
+    if productos:
+        sentencias.append(("""
+            INSERT INTO TBL_RESUMEN_PRODUCTO_DIA (ID_Fecha, ID_Producto, Cantidad, Importe)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE Cantidad = Cantidad + VALUES(Cantidad),
+                                    Importe  = Importe + VALUES(Importe)
+        """, productos))
+    for tabla, columna in (("MESA", "ID_Mesa"), ("MODO", "ID_Modo_Entrega")):
+        filas = [(f, k, n, c, i) for (f, k), (n, c, i) in sorted(delta[tabla.lower()].items()) if n or c or i]
+        if filas:
+            sentencias.append((f"""
+                INSERT INTO TBL_RESUMEN_{tabla}_DIA (ID_Fecha, {columna}, Cuentas, Cantidad, Importe)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE Cuentas  = Cuentas + VALUES(Cuentas),
+                                        Cantidad = Cantidad + VALUES(Cantidad),
+                                        Importe  = Importe + VALUES(Importe)
+            """, filas))
+    return sentencias
+
+def _aplicar_resumen(cur, delta):
+    """Aplica las diferencias acumuladas con INSERT ... ON DUPLICATE KEY UPDATE (suma)."""
+    for sql, filas in _sentencias_resumen(delta):
+        cur.executemany(sql, filas)
+
+def _clave_resumen(cur, folio):
+    """ID_Fecha/ID_Mesa/ID_Modo_Entrega de un folio (llamar con la cabecera ya bloqueada)."""
+    cur.execute("SELECT ID_Fecha, ID_Mesa, ID_Modo_Entrega FROM TBL_COMPRA WHERE Folio=%s", (folio,))
+    return cur.fetchone()
+
+# ---------------- Listado de ventas (paginación por Folio) ----------------
+VENTAS_POR_PAGINA = int(os.getenv("VENTAS_POR_PAGINA", "50"))
+VENTAS_POR_PAGINA_MAX = 200
+FILTROS_VENTAS = ("fecha", "mesa", "modo", "por_pagina")
+
+def _filtros_ventas(args):
+    """
+    Valida los filtros del listado desde la query string:
+      - fecha ('YYYY-MM-DD' o 'DD/MM/YYYY'), mesa (100..108), modo (1/2)
+      - antes: cursor (Folio) de la página; por_pagina: tamaño (1..VENTAS_POR_PAGINA_MAX)
+    Lanza ValueError si algún valor no es válido.
+    """
+    f = {"antes": None, "por_pagina": VENTAS_POR_PAGINA}
+    if (args.get("fecha") or "").strip():
+        f["fecha"] = parse_fecha_ui(args.get("fecha")).date()
+    if args.get("mesa"):
+        if args.get("mesa") not in [str(x) for x in range(100, 109)]:
+            raise ValueError("Mesa inválida")
+        f["mesa"] = int(args.get("mesa"))
+    if args.get("modo"):
+        if args.get("modo") not in ("1", "2"):
+            raise ValueError("Modo de entrega inválido")
+        f["modo"] = int(args.get("modo"))
+    if args.get("antes"):
+        f["antes"] = int(args.get("antes"))
+    if args.get("por_pagina"):
+        f["por_pagina"] = max(1, min(int(args.get("por_pagina")), VENTAS_POR_PAGINA_MAX))
+    return f
+
+SQL_ID_FECHA_DIA = "SELECT ID_Fecha FROM TBL_FECHA WHERE Anio=%s AND Mes=%s AND Dia=%s"
+
+SQL_TOPE_ARCHIVO = "SELECT COALESCE(MAX(Folio), 0) AS tope FROM TBL_COMPRA_HIST"
+
+def _sql_ventas(filtros, ids_fecha=None, archivo=False):
+    """
+    (sql, params) de una página del listado; 'ids_fecha' son los ID_Fecha del filtro de
+    fecha ya resueltos con SQL_ID_FECHA_DIA. Con archivo=True, la misma página sobre
+    TBL_COMPRA_HIST (Archivada = 1). Compartido con app_async.py.
+    """
+    where, params = [], []
+    if "fecha" in filtros:
+        where.append("c.ID_Fecha IN (" + ",".join(["%s"] * len(ids_fecha)) + ")")
+        params.extend(ids_fecha)
+    if "mesa" in filtros:
+        where.append("c.ID_Mesa = %s")
+        params.append(filtros["mesa"])
+    if "modo" in filtros:
+        where.append("c.ID_Modo_Entrega = %s")
+        params.append(filtros["modo"])
+    if "folios" in filtros:
+        where.append("c.Folio IN (" + ",".join(["%s"] * len(filtros["folios"])) + ")")
+        params.extend(filtros["folios"])
+    if filtros.get("antes"):
+        where.append("c.Folio < %s")
+        params.append(filtros["antes"])
+
+    sql = (
+        f"""
+        SELECT
+            c.Folio,
+            c.ID_Mesa,
+            c.Importe_Total,
+            c.Cantidad_Total,
+            c.ID_Modo_Entrega,
+            c.Version,
+            {int(archivo)} AS Archivada,
+            COALESCE(
+                m.Modo_Entrega,
+                CASE c.ID_Modo_Entrega
+                    WHEN 1 THEN 'Llevar'
+                    WHEN 2 THEN 'Comedor'
+                    ELSE '—'
+                END
+            ) AS Modo_Entrega
+        FROM {"TBL_COMPRA_HIST" if archivo else "TBL_COMPRA"} AS c
+        LEFT JOIN TBL_MODO_ENTREGA AS m
+               ON m.ID_Modo_Entrega = c.ID_Modo_Entrega
+        """
+        + ("WHERE " + " AND ".join(where) if where else "")
+        + """
+        ORDER BY c.Folio DESC
+        LIMIT %s
+        """
+    )
+    return sql, (*params, filtros["por_pagina"] + 1)
+
+def _ver_archivo(ventas, filtros, tope_archivo):
+    """
+    ¿Hace falta leer TBL_COMPRA_HIST para esta página? Solo si hay algo archivado con
+    Folio mayor que el último leído de TBL_COMPRA o si TBL_COMPRA no llenó la página
+    (lo normal en el servicio es que no: lo archivado es lo más viejo).
+    """
+    if not tope_archivo:
+        return False
+    return len(ventas) <= filtros["por_pagina"] or ventas[-1]["Folio"] < tope_archivo
+
+def _unir_archivo(ventas, archivadas, filtros):
+    return sorted([*ventas, *archivadas], key=lambda v: v["Folio"], reverse=True)[:filtros["por_pagina"] + 1]
+
+def _pagina_ventas(ventas, filtros, importes_float=True):
+    """
+    Recorta las n+1 filas leídas a (ventas, siguiente) e importes a float (para JSON;
+    index() los deja en Decimal: solo se formatean las filas que no están en caché).
+    """
+    limite = filtros["por_pagina"]
+    siguiente = None
+    if len(ventas) > limite:
+        ventas = ventas[:limite]
+        siguiente = ventas[-1]["Folio"]
+    if importes_float:
+        for v in ventas:
+            v["Importe_Total"] = as_float(v.get("Importe_Total"))
+    return ventas, siguiente
+
+def _tope_archivo(cur):
+    """Mayor Folio archivado (0 si no hay): una lectura del extremo de la PK."""
+    cur.execute(SQL_TOPE_ARCHIVO)
+    return cur.fetchone()["tope"]
+
+def _consultar_ventas(cur, filtros, tope_archivo=None, importes_float=True):
+    """
+    Una página del listado de TBL_COMPRA con paginación keyset (seek) sobre Folio:
+      WHERE Folio < :antes ORDER BY Folio DESC LIMIT n+1
+    El costo no depende de cuántas ventas haya en el historial (recorre la PK desde el cursor).
+    El filtro de fecha resuelve primero ID_Fecha con idx_fecha (Anio, Mes, Dia) y luego
+    filtra TBL_COMPRA por idx_compra_fecha. 'folios' (uso interno) limita a esos Folio.
+    Las cuentas archivadas (TBL_COMPRA_HIST) se mezclan por Folio cuando la página llega
+    hasta ellas (ver _ver_archivo); 'tope_archivo' evita releerlo si ya se tiene.
+    Devuelve (ventas, siguiente) donde 'siguiente' es el cursor de la próxima página o None.
+    Con importes_float=False, Importe_Total queda en Decimal (ver _pagina_ventas).
+    """
+    ids_fecha = None
+    if "fecha" in filtros:
+        d = filtros["fecha"]
+        cur.execute(SQL_ID_FECHA_DIA, (d.year, d.month, d.day))
+        ids_fecha = [r["ID_Fecha"] for r in cur.fetchall()]
+        if not ids_fecha:
+            return [], None
+    cur.execute(*_sql_ventas(filtros, ids_fecha))
+    ventas = cur.fetchall()
+    if tope_archivo is None:
+        tope_archivo = _tope_archivo(cur)
+    if _ver_archivo(ventas, filtros, tope_archivo):
+        cur.execute(*_sql_ventas(filtros, ids_fecha, archivo=True))
+        ventas = _unir_archivo(ventas, cur.fetchall(), filtros)
+    return _pagina_ventas(ventas, filtros, importes_float)
+
+# ---------------- Validadores HTTP (ETag / 304) ----------------
+# Versión de todo el listado: el último ID_Evento (toda escritura emite uno, ver /eventos;
+# MAX sobre la PK de TBL_EVENTOS es una sola lectura de índice). Versión de un folio: su
+# TBL_COMPRA.Version (cualquier cambio del detalle la incrementa). Con eso, un
+# If-None-Match vigente se contesta 304 sin consultar TBL_DETALLE ni renderizar nada.
+# _ARRANQUE entra en todas las ETag: un despliegue nuevo (plantillas/JSON distintos)
+# invalida lo que tengan guardado los navegadores.
+_ARRANQUE = f"{zlib.crc32(str(time.time()).encode()):08x}"
+
+def _etag(*partes):
+    return "-".join([_ARRANQUE, *map(str, partes)])
+
+def _etag_listado(ultimo_evento, tope_archivo, args, usuario, rol):
+    """
+    ETag de index(): la página depende del último evento, de hasta dónde se archivó
+    (archivar no emite eventos pero cambia las filas a solo lectura), de la URL y de quién la ve.
+    """
+    vista = repr((sorted(args.items(multi=True)), usuario, rol))
+    return _etag("v", ultimo_evento, tope_archivo, f"{zlib.crc32(vista.encode()):08x}")
+
+def _no_modificado(etag):
+    """Respuesta 304 si el cliente ya tiene 'etag' (If-None-Match), o None."""
+    if request.if_none_match.contains_weak(etag):
+        return _con_etag(Response(status=304), etag)
+    return None
+
+def _con_etag(resp, etag):
+    # no-cache: el navegador guarda la respuesta pero la revalida en cada uso
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# ---------------- Caché de filas del listado ----------------
+# index() arma la tabla con el HTML de cada fila (templates/_fila_venta.html) guardado por
+# Folio: una fila solo se vuelve a renderizar si cambió su Version (toda escritura sobre el
+# folio la incrementa), si se archivó o si la ve otro tipo de usuario (admin ve "Eliminar").
+# LRU acotada por memoria (FILAS_CACHE_MAX_BYTES); aciertos y fallos en /admin/metricas.
+FILAS_CACHE_MAX_BYTES = int(os.getenv("FILAS_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+
+_FILAS = OrderedDict()   # (Folio, es_admin) -> ((Version, Archivada), html, bytes)
+_FILAS_CACHE = {"aciertos": 0, "fallos": 0, "expulsadas": 0, "bytes": 0}
+_FILAS_LOCK = threading.Lock()
+
+def _clave_fila(v, rol):
+    """(clave, versión) de una fila del listado en la caché."""
+    return (v["Folio"], rol == "admin"), (v["Version"], bool(v["Archivada"]))
+
+def _fila_cacheada(clave, version):
+    """HTML de la fila si está en caché con esa versión, o None."""
+    with _FILAS_LOCK:
+        ent = _FILAS.get(clave)
+        if ent is not None and ent[0] == version:
+            _FILAS.move_to_end(clave)
+            _FILAS_CACHE["aciertos"] += 1
+            return ent[1]
+        _FILAS_CACHE["fallos"] += 1
+        return None
+
+def _guardar_fila(clave, version, html):
+    """Guarda (o reemplaza, si cambió la versión) la fila y expulsa las menos usadas. Devuelve html."""
+    tam = sys.getsizeof(html)
+    with _FILAS_LOCK:
+        vieja = _FILAS.pop(clave, None)
+        if vieja is not None:
+            _FILAS_CACHE["bytes"] -= vieja[2]
+        _FILAS[clave] = (version, html, tam)
+        _FILAS_CACHE["bytes"] += tam
+        while _FILAS_CACHE["bytes"] > FILAS_CACHE_MAX_BYTES and len(_FILAS) > 1:
+            _, (_, _, t) = _FILAS.popitem(last=False)
+            _FILAS_CACHE["bytes"] -= t
+            _FILAS_CACHE["expulsadas"] += 1
+    return html
+
+def _fila_html(v, rol):
+    """
+    HTML de una fila del listado: de la caché o renderizado (y guardado) si falta.
+    Es también la fila que reciben /eventos y update() por JSON: el navegador la cambia
+    tal cual (outerHTML), así que solo hay una versión del marcado de la fila.
+    """
+    clave, version = _clave_fila(v, rol)
+    html = _fila_cacheada(clave, version)
+    if html is None:
+        html = _guardar_fila(clave, version, Markup(render_template("_fila_venta.html", v=v, rol=rol)))
+    return html
+
+def _filas_ventas(ventas, rol):
+    """HTML de cada fila de la página (ver _fila_html)."""
+    return [_fila_html(v, rol) for v in ventas]
+
 # ---------------- Home ----------------
 @app.route("/")
 @login_requerido
 def index():
     """
-    Página principal: lista las compras (TBL_COMPRA), mostrando:
+    Página principal: lista las compras (TBL_COMPRA) de a una página, mostrando:
       - Folio, Mesa, Importe_Total, Cantidad_Total, ID_Modo_Entrega
     LEFT JOIN con TBL_MODO_ENTREGA (si existe):
       - Si no hay coincidencia, muestra texto por defecto con CASE.
-    Renderiza templates/index.html.
+    Filtros opcionales (?fecha=&mesa=&modo=&por_pagina=) y cursor ?antes=<Folio>.
+    Renderiza templates/index.html con las filas de la caché (ver _filas_ventas); la página
+    sigue al día con /eventos desde 'ultimo_evento' (contiguo: ver _version_eventos).
+    Responde 304 a un If-None-Match vigente (ETag = último evento + URL + usuario).
     """
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT
-                    c.Folio,
-                    c.ID_Mesa,
-                    c.Importe_Total,
-                    c.Cantidad_Total,
-                    c.ID_Modo_Entrega,
-                    COALESCE(
-                        m.Modo_Entrega,
-                        CASE c.ID_Modo_Entrega
-                            WHEN 1 THEN 'Llevar'
-                            WHEN 2 THEN 'Comedor'
-                            ELSE '—'
-                        END
-                    ) AS Modo_Entrega
-                FROM TBL_COMPRA AS c
-                LEFT JOIN TBL_MODO_ENTREGA AS m
-                       ON m.ID_Modo_Entrega = c.ID_Modo_Entrega
-                ORDER BY c.Folio DESC
-                """
-            )
-            ventas = cur.fetchall()
-            for v in ventas:
-                v["Importe_Total"] = as_float(v.get("Importe_Total"))
-    finally:
-        conn.close()
+        filtros = _filtros_ventas(request.args)
+    except ValueError:
+        flash("Filtros inválidos; se muestran todas las cuentas.", "warning")
+        filtros = _filtros_ventas({})
+    # Con avisos flash pendientes no hay validador: la página se ve una sola vez así
+    validar = not session.get("_flashes")
 
-    return render_template(
+    _iniciar_eventos()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Primero el evento: lo que pase entre ambas lecturas llega otra vez por /eventos
+            ultimo_evento = _version_eventos(cur)
+            tope_archivo = _tope_archivo(cur)
+            etag = _etag_listado(ultimo_evento, tope_archivo, request.args,
+                                 session.get("usuario"), session.get("rol"))
+            if validar:
+                no_modificado = _no_modificado(etag)
+                if no_modificado is not None:
+                    return no_modificado
+            ventas, siguiente = _consultar_ventas(cur, filtros, tope_archivo, importes_float=False)
+
+    # Filtros tal como llegaron, para reconstruir los enlaces de paginación
+    args_filtros = {k: request.args[k] for k in FILTROS_VENTAS if request.args.get(k)}
+    html = render_template(
         "index.html",
-        ventas=ventas,
+        filas=_filas_ventas(ventas, session.get("rol")),
+        siguiente=siguiente,
+        filtros=args_filtros,
+        es_primera=not filtros.get("antes"),
+        por_pagina=filtros["por_pagina"],
+        ultimo_evento=ultimo_evento,
+        diario_activo=bool(PEDIDOS_DIARIO),
         usuario=session.get("usuario"),
         rol=session.get("rol"),
     )
+    if validar:
+        return _con_etag(Response(html, mimetype="text/html"), etag)
+    return html
+
+@app.route("/ventas")
+@login_requerido
+def ventas_json():
+    """
+    Mismo listado que index() en JSON:
+      {"ventas": [...], "siguiente": <Folio para ?antes=> | null, "ultimo_evento": <ID_Evento>}
+    Con ?filas=1 agrega "filas": el HTML de cada fila (ver _fila_html). Es lo que sondea
+    index.html cuando no tiene /eventos. Misma ETag/304 que index().
+    """
+    try:
+        filtros = _filtros_ventas(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "msg": f"Filtros inválidos: {e}"}), 400
+
+    _iniciar_eventos()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            ultimo_evento = _version_eventos(cur)
+            tope_archivo = _tope_archivo(cur)
+            etag = _etag_listado(ultimo_evento, tope_archivo, request.args,
+                                 session.get("usuario"), session.get("rol"))
+            no_modificado = _no_modificado(etag)
+            if no_modificado is not None:
+                return no_modificado
+            ventas, siguiente = _consultar_ventas(cur, filtros, tope_archivo)
+
+    cuerpo = {"ventas": ventas, "siguiente": siguiente, "ultimo_evento": ultimo_evento}
+    if request.args.get("filas"):
+        cuerpo["filas"] = _filas_ventas(ventas, session.get("rol"))
+    return _con_etag(jsonify(cuerpo), etag)
 
 # ---------- Detalle (para editor inline del index) ----------
+_SQL_DETALLES = """
+    SELECT d.ID_Detalle, d.Folio, d.ID_Producto, d.Cantidad, d.Precio_Unit, d.Subtotal,
+           d.Version, c.Version AS Version_Folio, p.Nombre_Producto, {archivada} AS Archivada
+      FROM {detalle} d
+      JOIN {compra} c ON c.Folio = d.Folio
+      JOIN TBL_PRODUCTO p ON p.ID_Producto = d.ID_Producto
+     WHERE d.Folio = %s
+     ORDER BY d.ID_Detalle
+"""
+SQL_DETALLES = _SQL_DETALLES.format(archivada=0, compra="TBL_COMPRA", detalle="TBL_DETALLE")
+SQL_DETALLES_HIST = _SQL_DETALLES.format(archivada=1, compra="TBL_COMPRA_HIST", detalle="TBL_DETALLE_HIST")
+
+def _formatear_detalles(rows):
+    for r in rows:
+        r["Precio_Unit"] = as_float(r.get("Precio_Unit"))
+        r["Subtotal"] = as_float(r.get("Subtotal"))
+    return rows
+
+def _leer_detalles(cur, folio, archivo=False):
+    """
+    Renglones de un folio con nombre de producto (importes como float para JSON).
+    Version_Folio es la versión de la cabecera leída en la misma consulta (modo optimista).
+    archivo=True los lee de TBL_DETALLE_HIST (Archivada = 1: el editor los muestra sin editar).
+    """
+    cur.execute(SQL_DETALLES_HIST if archivo else SQL_DETALLES, (folio,))
+    return _formatear_detalles(cur.fetchall())
+
 @app.route("/venta/<int:folio>/detalles")
 @login_requerido
 def venta_detalles(folio):
@@ -259,29 +1008,212 @@ def venta_detalles(folio):
     Devuelve en JSON el detalle (renglones) de un folio:
       - ID_Detalle, Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal, Nombre_Producto
     (Solo lectura: sin bloqueos explícitos)
+    ETag = Version del folio + versión del catálogo (nombres de producto): si el cliente
+    ya la tiene, 304 con una sola lectura por PK de TBL_COMPRA.
+    Si el folio ya no está en TBL_COMPRA se busca en el archivo (TBL_COMPRA_HIST).
     """
-    conn = get_db_connection()
-    try:
+    catalogo = _catalogo_vigente()["version"]
+    with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT d.ID_Detalle, d.Folio, d.ID_Producto, d.Cantidad, d.Precio_Unit, d.Subtotal,
-                       p.Nombre_Producto
-                  FROM TBL_DETALLE d
-                  JOIN TBL_PRODUCTO p ON p.ID_Producto = d.ID_Producto
-                 WHERE d.Folio = %s
-                 ORDER BY d.ID_Detalle
-                """,
-                (folio,),
-            )
-            rows = cur.fetchall()
-            for r in rows:
-                r["Precio_Unit"] = as_float(r.get("Precio_Unit"))
-                r["Subtotal"] = as_float(r.get("Subtotal"))
-    finally:
-        conn.close()
+            archivo = False
+            cur.execute("SELECT Version FROM TBL_COMPRA WHERE Folio=%s", (folio,))
+            cab = cur.fetchone()
+            if cab is None:
+                archivo = True
+                cur.execute("SELECT Version FROM TBL_COMPRA_HIST WHERE Folio=%s", (folio,))
+                cab = cur.fetchone()
+                if cab is None:
+                    return jsonify([])
+            etag = _etag("f", folio, cab["Version"], int(archivo), *catalogo)
+            no_modificado = _no_modificado(etag)
+            if no_modificado is not None:
+                return no_modificado
+            rows = _leer_detalles(cur, folio, archivo)
+
+    # La versión con que se leyó el detalle (misma consulta) es la que vale para la ETag
+    if rows:
+        etag = _etag("f", folio, rows[0]["Version_Folio"], int(archivo), *catalogo)
+    return _con_etag(jsonify(rows), etag)
+
+@app.route("/catalogo")
+@login_requerido
+def catalogo_json():
+    """Catálogo categoría -> productos en JSON (desde la caché; para agregar renglones en el editor)."""
+    return jsonify(_catalogo_vigente()["catalogo"])
 
-    return jsonify(rows)
+@app.route("/venta/<int:folio>/detalles/guardar", methods=["POST"])
+@login_requerido
+def venta_detalles_guardar(folio):
+    """
+    Guarda en UNA transacción todos los cambios del editor inline para un folio.
+    Cuerpo JSON:
+      {"cambios":    [{"id_detalle", "cantidad", "precio_unit"}, ...],
+       "nuevos":     [{"id_producto", "cantidad", "precio"}, ...],
+       "eliminados": [id_detalle, ...]}
+    Con BLOQUEO PESIMISTA: bloquea cabecera y detalles del folio una sola vez,
+    aplica todo, recalcula los totales una vez y reintenta ante deadlock / timeout.
+    En modo optimista el cuerpo trae además "version" (Version_Folio leída con el detalle)
+    y en lugar de bloquear se exige que la cabecera siga en esa versión (409 si no).
+    Devuelve los renglones resultantes y los totales.
+    """
+    datos = request.get_json(silent=True) or {}
+    try:
+        cambios = {}
+        for c in datos.get("cambios") or []:
+            linea = _normalizar_lineas([{"id_producto": 0, "cantidad": c["cantidad"],
+                                         "precio": c["precio_unit"]}])[0]
+            cambios[int(c["id_detalle"])] = linea
+        nuevos = _normalizar_lineas(datos.get("nuevos") or [])
+        eliminados = {int(x) for x in datos.get("eliminados") or []}
+        version = int(datos["version"]) if _optimista("detalles_guardar") else None
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        return jsonify({"ok": False, "msg": "Datos inválidos o fuera de rango"}), 400
+
+    if not (cambios or nuevos or eliminados):
+        return jsonify({"ok": False, "msg": "Sin cambios"}), 400
+
+    def _tx():
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if version is None:
+                    # 1) Bloquea cabecera y luego todos los detalles del folio (orden estable)
+                    cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                    clave = cur.fetchone()
+                    if not clave:
+                        conn.rollback()
+                        return jsonify({"ok": False, "msg": "Folio inexistente"}), 404
+                    bloqueo = " FOR UPDATE"
+                else:
+                    # 1) Optimista: el folio no debe haber cambiado desde que se leyó el detalle
+                    cur.execute(
+                        "UPDATE TBL_COMPRA SET Version = Version + 1 WHERE Folio=%s AND Version=%s",
+                        (folio, version),
+                    )
+                    if cur.rowcount != 1:
+                        raise ConflictoVersion()
+                    clave = _clave_resumen(cur, folio)
+                    bloqueo = ""
+                cur.execute(
+                    "SELECT ID_Detalle, ID_Producto, Cantidad, Subtotal FROM TBL_DETALLE WHERE Folio=%s" + bloqueo,
+                    (folio,),
+                )
+                previos = {r["ID_Detalle"]: r for r in cur.fetchall()}
+                actuales = {i: r["ID_Producto"] for i, r in previos.items()}
+
+                ajenos = (set(cambios) | eliminados) - set(actuales)
+                if ajenos:
+                    conn.rollback()
+                    return jsonify({"ok": False, "msg": "Renglones que no son de este folio"}), 409
+                if not nuevos and eliminados >= set(actuales):
+                    conn.rollback()
+                    return jsonify({"ok": False, "msg": "El folio debe conservar al menos un producto"}), 400
+
+                # 2) Eliminados, modificados (un solo INSERT ... ON DUPLICATE KEY UPDATE) y nuevos
+                if eliminados:
+                    cur.execute(
+                        "DELETE FROM TBL_DETALLE WHERE Folio=%s AND ID_Detalle IN ("
+                        + ",".join(["%s"] * len(eliminados)) + ")",
+                        (folio, *sorted(eliminados)),
+                    )
+                modificados = [(i, l) for i, l in sorted(cambios.items()) if i not in eliminados]
+                if modificados:
+                    cur.executemany(
+                        """
+                        INSERT INTO TBL_DETALLE (ID_Detalle, Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            Cantidad = VALUES(Cantidad),
+                            Precio_Unit = VALUES(Precio_Unit),
+                            Subtotal = VALUES(Subtotal),
+                            Version = Version + 1
+                        """,
+                        [(i, folio, actuales[i], l["cantidad"], l["precio"], l["subtotal"])
+                         for i, l in modificados],
+                    )
+                if nuevos:
+                    cur.executemany(
+                        """
+                        INSERT INTO TBL_DETALLE (Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal)
+                        VALUES (%s, %s, %s, %s, %s)
+                        """,
+                        [(folio, l["id_producto"], l["cantidad"], l["precio"], l["subtotal"]) for l in nuevos],
+                    )
+
+                # 3) Totales: un solo SUM() del folio (requiere migraciones/008: el trigger
+                #    trg_compra_totales_au hacía además uno por cada renglón modificado)
+                _recalcular_totales(cur, folio)
+                rows = _leer_detalles(cur, folio)
+
+                # 4) Resúmenes: sale lo que había, entra lo que quedó (en Decimal, de los
+                #    renglones previos más los cambios y nuevos ya normalizados)
+                quedan = [
+                    dict(r, Cantidad=cambios[i]["cantidad"], Subtotal=cambios[i]["subtotal"]) if i in cambios else r
+                    for i, r in previos.items() if i not in eliminados
+                ] + [{"ID_Producto": l["id_producto"], "Cantidad": l["cantidad"], "Subtotal": l["subtotal"]}
+                     for l in nuevos]
+                delta = _delta_resumen()
+                c1, i1 = _sumar_renglones(delta, clave, previos.values(), -1)
+                c2, i2 = _sumar_renglones(delta, clave, quedan)
+                _sumar_cuenta(delta, clave, 0, c1 + c2, i1 + i2)
+                _aplicar_resumen(cur, delta)
+                _emitir_evento(cur, "editada", folio)
+
+            conn.commit()
+            return jsonify({"ok": True, "detalles": rows})
+
+    try:
+        return tx_with_retry(_tx, sitio="detalles_guardar")
+    except ConflictoVersion:
+        return jsonify({"ok": False, "conflicto": True, "msg": MSG_CONFLICTO}), 409
+    except Exception as e:
+        return jsonify({"ok": False, "msg": f"Error al guardar: {e}"}), 500
+
+# ---------- Concurrencia de edición: pesimista u optimista por ruta ----------
+# "pesimista": SELECT ... FOR UPDATE sobre cabecera/detalle (comportamiento original).
+# "optimista": sin bloqueos previos; el UPDATE/DELETE lleva "AND Version = <leída>" y si no
+#              afecta filas responde conflicto (409 / aviso) para que la UI recargue.
+# Requiere la columna Version (migraciones/001_version_compra_detalle.sql). Todas las
+# escrituras incrementan Version en ambos modos, y cualquier cambio del detalle incrementa
+# también la de la cabecera, así que TBL_COMPRA.Version sirve de versión de todo el folio.
+# Se elige por ruta con CONCURRENCIA_<RUTA>=optimista (p. ej. CONCURRENCIA_UPDATE).
+CONCURRENCIA = {
+    ruta: os.getenv(f"CONCURRENCIA_{ruta.upper()}", "pesimista")
+    for ruta in ("update", "delete", "detalle_update", "detalles_guardar")
+}
+
+def _optimista(ruta):
+    return CONCURRENCIA.get(ruta) == "optimista"
+
+MSG_CONFLICTO = "Otro usuario modificó esta cuenta mientras la editabas; se recargaron los datos."
+
+# Sentencias de las escrituras pesimistas (orden de bloqueo cabecera -> detalle), compartidas
+# con app_async.py para que los dos modos de servicio ejecuten exactamente lo mismo
+SQL_FOLIO_DETALLE = "SELECT Folio FROM TBL_DETALLE WHERE ID_Detalle=%s"
+SQL_BLOQUEAR_CABECERA = "SELECT ID_Fecha, ID_Mesa, ID_Modo_Entrega FROM TBL_COMPRA WHERE Folio=%s FOR UPDATE"
+SQL_BLOQUEAR_RENGLON = "SELECT ID_Producto, Cantidad, Subtotal FROM TBL_DETALLE WHERE ID_Detalle=%s FOR UPDATE"
+SQL_BLOQUEAR_DETALLES = "SELECT ID_Detalle, ID_Producto, Cantidad, Subtotal FROM TBL_DETALLE WHERE Folio=%s FOR UPDATE"
+SQL_SUMAR_TOTALES = """
+    UPDATE TBL_COMPRA
+       SET Cantidad_Total = Cantidad_Total + %s,
+           Importe_Total  = Importe_Total + %s,
+           Version        = Version + 1
+     WHERE Folio = %s
+"""
+SQL_ACTUALIZAR_RENGLON = """
+    UPDATE TBL_DETALLE
+       SET Cantidad = %s, Precio_Unit = %s, Subtotal = %s, Version = Version + 1
+     WHERE ID_Detalle = %s
+"""
+SQL_CAMBIAR_MESA = "UPDATE TBL_COMPRA SET ID_Mesa=%s, ID_Modo_Entrega=%s, Version=Version+1 WHERE Folio=%s"
+SQL_BORRAR_DETALLES = "DELETE FROM TBL_DETALLE WHERE Folio = %s"
+SQL_BORRAR_CABECERA = "DELETE FROM TBL_COMPRA WHERE Folio = %s"
+
+# Cómo mantiene detalle_update() los totales de TBL_COMPRA:
+#   "delta"     -> suma a la cabecera la diferencia vieja->nueva del renglón editado
+#                  (bloquea solo cabecera + ese renglón; O(1) por edición)
+#   "recalculo" -> bloquea todos los renglones del folio y vuelve a hacer SUM()
+# La deriva que pudiera dejar el modo delta la detecta conciliar_totales().
+DETALLE_MODO_TOTALES = os.getenv("DETALLE_MODO_TOTALES", "delta")
 
 @app.route("/detalle/update/<int:id_detalle>", methods=["POST"])
 @login_requerido
@@ -289,22 +1221,109 @@ def detalle_update(id_detalle):
     """
     Actualiza un renglón de detalle con BLOQUEO PESIMISTA:
       - Valida cantidad (1–50) y precio (0.01–10000)
-      - Bloquea el folio afectado (cabecera y todos los detalles) con SELECT ... FOR UPDATE
-      - Actualiza renglón, recalcula totales y actualiza cabecera
+      - Modo "delta": bloquea cabecera y el renglón editado, aplica la diferencia a los totales
+      - Modo "recalculo": bloquea cabecera y todos los detalles, recalcula totales con SUM()
+      - Concurrencia optimista (CONCURRENCIA_DETALLE_UPDATE): sin bloqueos previos; exige
+        la 'version' del renglón que leyó el cliente y responde 409 si cambió
       - Reintenta si hay deadlock / lock wait timeout
     """
     try:
         cant = int(request.form.get("cantidad", ""))
-        precio = float(request.form.get("precio_unit", ""))
-    except ValueError:
+        precio = Decimal(request.form.get("precio_unit", "")).quantize(CENTAVO, ROUND_HALF_UP)
+    except (ValueError, ArithmeticError):
         return jsonify({"ok": False, "msg": "Datos inválidos"}), 400
 
-    if not (1 <= cant <= 50) or not (0.01 <= precio <= 10000):
+    if not (1 <= cant <= 50) or not (CENTAVO <= precio <= 10000):
         return jsonify({"ok": False, "msg": "Fuera de rango"}), 400
 
-    def _tx():
-        conn = get_db_connection()
-        try:
+    subtotal = (precio * cant).quantize(CENTAVO, ROUND_HALF_UP)
+    version = request.form.get("version", type=int)
+    if _optimista("detalle_update") and version is None:
+        return jsonify({"ok": False, "msg": "Falta la versión del renglón"}), 400
+
+    def _resumir(cur, clave, viejo):
+        """Pasa el renglón de (Cantidad, Subtotal) viejos a los nuevos en los resúmenes."""
+        delta = _delta_resumen()
+        nuevo = {"ID_Producto": viejo["ID_Producto"], "Cantidad": cant, "Subtotal": subtotal}
+        c1, i1 = _sumar_renglones(delta, clave, [viejo], -1)
+        c2, i2 = _sumar_renglones(delta, clave, [nuevo])
+        _sumar_cuenta(delta, clave, 0, c1 + c2, i1 + i2)
+        _aplicar_resumen(cur, delta)
+
+    def _tx_optimista():
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # 1) Lee el renglón sin bloquear
+                cur.execute(
+                    "SELECT Folio, ID_Producto, Cantidad, Subtotal, Version FROM TBL_DETALLE WHERE ID_Detalle=%s",
+                    (id_detalle,),
+                )
+                viejo = cur.fetchone()
+                if not viejo:
+                    conn.rollback()
+                    return jsonify({"ok": False, "msg": "Detalle inexistente"}), 404
+                if viejo["Version"] != version:
+                    raise ConflictoVersion()
+
+                # 2) Diferencia a la cabecera (suma conmutativa: no compara la versión de la cabecera)
+                cur.execute(
+                    SQL_SUMAR_TOTALES,
+                    (cant - viejo["Cantidad"], subtotal - viejo["Subtotal"], viejo["Folio"]),
+                )
+                clave = _clave_resumen(cur, viejo["Folio"])
+
+                # 3) El renglón solo se escribe si sigue en la versión leída (si no, rollback de todo)
+                cur.execute(
+                    """
+                    UPDATE TBL_DETALLE
+                       SET Cantidad = %s, Precio_Unit = %s, Subtotal = %s, Version = Version + 1
+                     WHERE ID_Detalle = %s AND Version = %s
+                    """,
+                    (cant, precio, subtotal, id_detalle, version),
+                )
+                if cur.rowcount != 1:
+                    raise ConflictoVersion()
+                _resumir(cur, clave, viejo)
+                _emitir_evento(cur, "editada", viejo["Folio"])
+
+            conn.commit()
+            return jsonify({"ok": True, "version": version + 1})
+
+    def _tx_delta():
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # 1) Folio del renglón (no cambia nunca: no hace falta bloquear para leerlo)
+                cur.execute(SQL_FOLIO_DETALLE, (id_detalle,))
+                r = cur.fetchone()
+                if not r:
+                    conn.rollback()
+                    return jsonify({"ok": False, "msg": "Detalle inexistente"}), 404
+                folio = r["Folio"]
+
+                # 2) Bloquea cabecera y luego SOLO el renglón editado (mismo orden que update/delete)
+                cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = cur.fetchone()
+                cur.execute(SQL_BLOQUEAR_RENGLON, (id_detalle,))
+                viejo = cur.fetchone()
+                if not viejo:
+                    conn.rollback()
+                    return jsonify({"ok": False, "msg": "Detalle inexistente"}), 404
+
+                # 3) Aplica la diferencia a la cabecera (sin SUM() del folio: el trigger
+                #    trg_compra_totales_au que lo hacía se quitó en migraciones/008)
+                cur.execute(SQL_SUMAR_TOTALES,
+                            (cant - viejo["Cantidad"], subtotal - viejo["Subtotal"], folio))
+
+                # 4) Actualiza el renglón
+                cur.execute(SQL_ACTUALIZAR_RENGLON, (cant, precio, subtotal, id_detalle))
+                _resumir(cur, clave, viejo)
+                _emitir_evento(cur, "editada", folio)
+
+            conn.commit()
+            return jsonify({"ok": True})
+
+    def _tx_recalculo():
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
                 # 1) Identifica y BLOQUEA el folio por orden estable
                 cur.execute("SELECT Folio FROM TBL_DETALLE WHERE ID_Detalle=%s FOR UPDATE", (id_detalle,))
@@ -315,54 +1334,165 @@ def detalle_update(id_detalle):
                 folio = r["Folio"]
 
                 # 2) Bloquea cabecera y luego todos los detalles del folio (orden estable para evitar deadlocks)
-                cur.execute("SELECT Folio FROM TBL_COMPRA WHERE Folio=%s FOR UPDATE", (folio,))
-                cur.execute("SELECT ID_Detalle FROM TBL_DETALLE WHERE Folio=%s FOR UPDATE", (folio,))
+                cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = cur.fetchone()
+                cur.execute(SQL_BLOQUEAR_DETALLES, (folio,))
+                viejo = next(d for d in cur.fetchall() if d["ID_Detalle"] == id_detalle)
 
                 # 3) Actualiza el renglón
-                subtotal = cant * precio
-                cur.execute(
-                    """
-                    UPDATE TBL_DETALLE
-                       SET Cantidad = %s, Precio_Unit = %s, Subtotal = %s
-                     WHERE ID_Detalle = %s
-                    """,
-                    (cant, precio, subtotal, id_detalle),
-                )
+                cur.execute(SQL_ACTUALIZAR_RENGLON, (cant, precio, subtotal, id_detalle))
 
                 # 4) Recalcula totales y actualiza cabecera
-                cur.execute(
-                    """
-                    SELECT
-                        COALESCE(SUM(Cantidad),0) AS Cantidad_Total,
-                        COALESCE(SUM(Subtotal),0) AS Importe_Total
-                      FROM TBL_DETALLE
-                     WHERE Folio=%s
-                    """,
-                    (folio,),
-                )
-                tot = cur.fetchone() or {"Cantidad_Total": 0, "Importe_Total": 0}
-                cur.execute(
-                    """
-                    UPDATE TBL_COMPRA
-                       SET Cantidad_Total = %s, Importe_Total = %s
-                     WHERE Folio = %s
-                    """,
-                    (tot["Cantidad_Total"], tot["Importe_Total"], folio),
-                )
+                _recalcular_totales(cur, folio)
+                _resumir(cur, clave, viejo)
+                _emitir_evento(cur, "editada", folio)
 
             conn.commit()
             return jsonify({"ok": True})
-        except Exception as e:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
 
     try:
-        return tx_with_retry(_tx)
+        if _optimista("detalle_update"):
+            tx = _tx_optimista
+        else:
+            tx = _tx_delta if DETALLE_MODO_TOTALES == "delta" else _tx_recalculo
+        return tx_with_retry(tx, sitio="detalle_update")
+    except ConflictoVersion:
+        return jsonify({"ok": False, "conflicto": True, "msg": MSG_CONFLICTO}), 409
     except Exception as e:
         return jsonify({"ok": False, "msg": f"Error al actualizar: {e}"}), 500
 
+def _recalcular_totales(cur, folio):
+    """Recalcula Cantidad_Total/Importe_Total de la cabecera a partir de su detalle."""
+    cur.execute(
+        """
+        SELECT
+            COALESCE(SUM(Cantidad),0) AS Cantidad_Total,
+            COALESCE(SUM(Subtotal),0) AS Importe_Total
+          FROM TBL_DETALLE
+         WHERE Folio=%s
+        """,
+        (folio,),
+    )
+    tot = cur.fetchone() or {"Cantidad_Total": 0, "Importe_Total": 0}
+    cur.execute(
+        """
+        UPDATE TBL_COMPRA
+           SET Cantidad_Total = %s, Importe_Total = %s, Version = Version + 1
+         WHERE Folio = %s
+        """,
+        (tot["Cantidad_Total"], tot["Importe_Total"], folio),
+    )
+
+# ---------- Conciliación de totales (cabecera vs. detalle) ----------
+# Recorre el historial por tramos de Folio (CONCILIACION_LOTE por pasada, dando la
+# vuelta al llegar al final) para no escanear TBL_DETALLE completo de una vez.
+CONCILIACION_SEG = float(os.getenv("CONCILIACION_SEG", "300"))
+CONCILIACION_LOTE = int(os.getenv("CONCILIACION_LOTE", "2000"))
+
+_CONCILIACION = {"cursor": 0, "pasadas": 0, "revisados": 0, "deriva": [], "ultima": None}
+_CONCILIACION_LOCK = threading.Lock()
+
+def _con_deriva(cur, folio):
+    """True si la cabecera del folio no coincide con la suma de su detalle."""
+    cur.execute(
+        """
+        SELECT c.Cantidad_Total = COALESCE(SUM(d.Cantidad),0)
+               AND c.Importe_Total = COALESCE(SUM(d.Subtotal),0) AS cuadra
+          FROM TBL_COMPRA c
+          LEFT JOIN TBL_DETALLE d ON d.Folio = c.Folio
+         WHERE c.Folio = %s
+         GROUP BY c.Folio, c.Cantidad_Total, c.Importe_Total
+        """,
+        (folio,),
+    )
+    r = cur.fetchone()
+    return bool(r) and not r["cuadra"]
+
+def conciliar_totales(corregir=False):
+    """
+    Compara Cantidad_Total/Importe_Total de un tramo de TBL_COMPRA contra la suma de su
+    detalle y reporta (en log y en _CONCILIACION) los folios con deriva.
+    Con corregir=True recalcula la cabecera de esos folios.
+    """
+    with _CONCILIACION_LOCK:
+        desde = _CONCILIACION["cursor"]
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT c.Folio, c.Cantidad_Total, c.Importe_Total,
+                           COALESCE(SUM(d.Cantidad),0) AS Cantidad_Detalle,
+                           COALESCE(SUM(d.Subtotal),0) AS Importe_Detalle
+                      FROM (SELECT Folio, Cantidad_Total, Importe_Total
+                              FROM TBL_COMPRA
+                             WHERE Folio > %s
+                             ORDER BY Folio
+                             LIMIT %s) AS c
+                      LEFT JOIN TBL_DETALLE d ON d.Folio = c.Folio
+                     GROUP BY c.Folio, c.Cantidad_Total, c.Importe_Total
+                     ORDER BY c.Folio
+                    """,
+                    (desde, CONCILIACION_LOTE),
+                )
+                filas = cur.fetchall()
+                deriva = [
+                    {
+                        "Folio": f["Folio"],
+                        "Cantidad_Total": f["Cantidad_Total"],
+                        "Cantidad_Detalle": int(f["Cantidad_Detalle"]),
+                        "Importe_Total": as_float(f["Importe_Total"]),
+                        "Importe_Detalle": as_float(f["Importe_Detalle"]),
+                    }
+                    for f in filas
+                    if f["Cantidad_Total"] != f["Cantidad_Detalle"] or f["Importe_Total"] != f["Importe_Detalle"]
+                ]
+            conn.commit()
+            if corregir:
+                for f in deriva:
+                    with conn.cursor() as cur:
+                        # La lectura de arriba no bloquea: se bloquea la cabecera (mismo orden que
+                        # update/delete) y se vuelve a comparar antes de escribir, para no pisar
+                        # con un total viejo un detalle_update que confirmó en medio
+                        cur.execute(SQL_BLOQUEAR_CABECERA, (f["Folio"],))
+                        if cur.fetchone() and _con_deriva(cur, f["Folio"]):
+                            _recalcular_totales(cur, f["Folio"])
+                            _emitir_evento(cur, "editada", f["Folio"])
+                    conn.commit()
+
+        c = _CONCILIACION
+        if len(filas) < CONCILIACION_LOTE:
+            c["cursor"] = 0          # llegó al final: la próxima pasada empieza de nuevo
+            c["pasadas"] += 1
+        else:
+            c["cursor"] = filas[-1]["Folio"]
+        c["revisados"] += len(filas)
+        c["ultima"] = datetime.now().isoformat(timespec="seconds")
+        # deriva acumulada de la pasada en curso (se reinicia al empezar desde el Folio 0)
+        if desde == 0:
+            c["deriva"] = []
+        if not corregir:
+            c["deriva"] = (c["deriva"] + deriva)[-500:]
+        for f in deriva:
+            app.logger.warning("Deriva de totales en folio %s: %s", f["Folio"], f)
+        return deriva
+
+@app.route("/admin/conciliacion", methods=["GET", "POST"])
+@admin_requerido
+def conciliacion():
+    """
+    GET: estado de la conciliación de fondo (último tramo, folios con deriva).
+    POST: revisa el siguiente tramo ahora; con ?corregir=1 recalcula las cabeceras con deriva.
+    """
+    if request.method == "POST":
+        conciliar_totales(corregir=request.args.get("corregir") == "1")
+    return jsonify(_CONCILIACION)
+
+@app.route("/admin/reintentos")
+@admin_requerido
+def reintentos():
+    """Contadores de tx_with_retry por sitio: intentos, deadlocks, lock timeouts, fallos y espera."""
+    return jsonify(estadisticas_reintentos())
+
 # ---------- Editar cabecera ----------
 @app.route("/update/<int:folio>", methods=["POST"])
 @login_requerido
@@ -372,42 +1502,99 @@ def update(folio):
       - Bloquea cabecera y todos los detalles del folio con SELECT ... FOR UPDATE
       - Actualiza cabecera
       - Reintenta si hay deadlock / timeout
+    En modo optimista (CONCURRENCIA_UPDATE) no bloquea: actualiza solo si la cabecera
+    sigue en la 'version' que envió el formulario.
+    Desde fetch (Accept: application/json) responde {"ok", "msg", "venta", "html"} en vez de
+    redirigir ('html': la fila renderizada, ver _fila_html).
     """
     id_mesa = request.form.get("ID_Mesa")
     id_modo = request.form.get("ID_Modo_Entrega")
+    version = request.form.get("version", type=int)
 
+    msg = None
     if id_mesa not in [str(x) for x in range(100, 109)]:
-        flash("Mesa inválida.", "warning")
-        return redirect(url_for("index"))
-    if id_modo not in ("1", "2"):
-        flash("Modo de entrega inválido.", "warning")
+        msg = "Mesa inválida."
+    elif id_modo not in ("1", "2"):
+        msg = "Modo de entrega inválido."
+    elif _optimista("update") and version is None:
+        msg = "Falta la versión de la cuenta."   # sin ella el UPDATE por Version daría un falso 409
+    if msg:
+        if quiere_json():
+            return jsonify({"ok": False, "msg": msg}), 400
+        flash(msg, "warning")
         return redirect(url_for("index"))
 
+    def _mover_resumen(cur, clave, renglones):
+        """Pasa la cuenta (y lo que suma su detalle) de la mesa/modo anteriores a los nuevos."""
+        nueva = dict(clave, ID_Mesa=id_mesa, ID_Modo_Entrega=id_modo)
+        if (int(clave["ID_Mesa"]), int(clave["ID_Modo_Entrega"])) == (int(id_mesa), int(id_modo)):
+            return
+        cant = sum(r["Cantidad"] for r in renglones)
+        imp = sum((r["Subtotal"] for r in renglones), Decimal("0.00"))
+        delta = _delta_resumen()
+        _sumar_cuenta(delta, clave, -1, -cant, -imp)
+        _sumar_cuenta(delta, nueva, 1, cant, imp)
+        _aplicar_resumen(cur, delta)
+
     def _tx():
-        conn = get_db_connection()
-        try:
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
                 # Bloquea cabecera y detalles (orden estable)
-                cur.execute("SELECT Folio FROM TBL_COMPRA WHERE Folio=%s FOR UPDATE", (folio,))
-                cur.execute("SELECT ID_Detalle FROM TBL_DETALLE WHERE Folio=%s FOR UPDATE", (folio,))
+                cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = cur.fetchone()
+                cur.execute(SQL_BLOQUEAR_DETALLES, (folio,))
+                renglones = cur.fetchall()
                 # Actualiza cabecera
+                cur.execute(SQL_CAMBIAR_MESA, (id_mesa, id_modo, folio))
+                if clave:
+                    _mover_resumen(cur, clave, renglones)
+                    _emitir_evento(cur, "editada", folio)
+            conn.commit()
+
+    def _tx_optimista():
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # Lectura sin bloqueo; si alguien la cambia antes, el UPDATE por Version no aplica
+                cur.execute(
+                    "SELECT ID_Fecha, ID_Mesa, ID_Modo_Entrega FROM TBL_COMPRA WHERE Folio=%s AND Version=%s",
+                    (folio, version),
+                )
+                clave = cur.fetchone()
+                cur.execute("SELECT Cantidad, Subtotal FROM TBL_DETALLE WHERE Folio=%s", (folio,))
+                renglones = cur.fetchall()
                 cur.execute(
-                    "UPDATE TBL_COMPRA SET ID_Mesa=%s, ID_Modo_Entrega=%s WHERE Folio=%s",
-                    (id_mesa, id_modo, folio),
+                    """
+                    UPDATE TBL_COMPRA SET ID_Mesa=%s, ID_Modo_Entrega=%s, Version=Version+1
+                     WHERE Folio=%s AND Version=%s
+                    """,
+                    (id_mesa, id_modo, folio, version),
                 )
+                if cur.rowcount != 1 or not clave:
+                    raise ConflictoVersion()
+                _mover_resumen(cur, clave, renglones)
+                _emitir_evento(cur, "editada", folio)
             conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
 
     try:
-        tx_with_retry(_tx)
-        flash(f"Cuenta #{folio} actualizada.", "success")
+        tx_with_retry(_tx_optimista if _optimista("update") else _tx, sitio="update")
+    except ConflictoVersion:
+        resultado = ({"ok": False, "conflicto": True, "msg": MSG_CONFLICTO}, 409, "warning")
     except Exception as e:
-        flash(f"Error al actualizar: {e}", "danger")
-
+        resultado = ({"ok": False, "msg": f"Error al actualizar: {e}"}, 500, "danger")
+    else:
+        resultado = ({"ok": True, "msg": f"Cuenta #{folio} actualizada."}, 200, "success")
+
+    cuerpo, estado, categoria = resultado
+    if quiere_json():
+        # El listado se parcha en el navegador: se devuelve la fila nueva (Version incluida)
+        if cuerpo["ok"]:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    filas, _ = _consultar_ventas(cur, {"folios": [folio], "antes": None, "por_pagina": 1})
+            cuerpo["venta"] = filas[0] if filas else None
+            cuerpo["html"] = _fila_html(cuerpo["venta"], session.get("rol")) if cuerpo["venta"] else None
+        return jsonify(cuerpo), estado
+    flash(cuerpo["msg"], categoria)
     return redirect(url_for("index"))
 
 # ---------- Eliminar cuenta (solo admin) ----------
@@ -420,79 +1607,748 @@ def delete(folio):
       - Bloquea cabecera y detalles del folio con SELECT ... FOR UPDATE
       - Elimina detalle y luego cabecera
       - Reintenta si hay deadlock / timeout
+    En modo optimista (CONCURRENCIA_DELETE) no bloquea: borra la cabecera solo si sigue
+    en la ?version= leída (el detalle cae por ON DELETE CASCADE de fk_detalle_compra).
+    Desde fetch (Accept: application/json) responde {"ok", "msg"} en vez de redirigir.
     """
     if session.get("rol") != "admin":
+        if quiere_json():
+            return jsonify({"ok": False, "msg": "Solo administradores pueden eliminar."}), 403
         flash("Solo administradores pueden eliminar.", "danger")
         return redirect(url_for("index"))
 
+    def _restar_cuenta(cur, clave, renglones):
+        delta = _delta_resumen()
+        cant, imp = _sumar_renglones(delta, clave, renglones, -1)
+        _sumar_cuenta(delta, clave, -1, cant, imp)
+        _aplicar_resumen(cur, delta)
+
     def _tx():
-        conn = get_db_connection()
-        try:
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
                 # Bloquear en orden: cabecera -> detalles
-                cur.execute("SELECT Folio FROM TBL_COMPRA WHERE Folio=%s FOR UPDATE", (folio,))
-                cur.execute("SELECT ID_Detalle FROM TBL_DETALLE WHERE Folio=%s FOR UPDATE", (folio,))
+                cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = cur.fetchone()
+                cur.execute(SQL_BLOQUEAR_DETALLES, (folio,))
+                renglones = cur.fetchall()
 
                 # Eliminar primero detalles, luego cabecera
-                cur.execute("DELETE FROM TBL_DETALLE WHERE Folio = %s", (folio,))
-                cur.execute("DELETE FROM TBL_COMPRA  WHERE Folio = %s", (folio,))
+                cur.execute(SQL_BORRAR_DETALLES, (folio,))
+                cur.execute(SQL_BORRAR_CABECERA, (folio,))
+                if clave:
+                    _restar_cuenta(cur, clave, renglones)
+                    _emitir_evento(cur, "eliminada", folio)
+            conn.commit()
+
+    version = request.args.get("version", type=int)
+    if _optimista("delete") and version is None:
+        # Sin ?version= el DELETE por Version no borraría nada y parecería un conflicto
+        if quiere_json():
+            return jsonify({"ok": False, "msg": "Falta la versión de la cuenta."}), 400
+        flash("Falta la versión de la cuenta.", "warning")
+        return redirect(url_for("index"))
+
+    def _tx_optimista():
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # Lectura sin bloqueo; el DELETE por Version confirma que seguía igual
+                cur.execute(
+                    "SELECT ID_Fecha, ID_Mesa, ID_Modo_Entrega FROM TBL_COMPRA WHERE Folio=%s AND Version=%s",
+                    (folio, version),
+                )
+                clave = cur.fetchone()
+                cur.execute(
+                    "SELECT ID_Producto, Cantidad, Subtotal FROM TBL_DETALLE WHERE Folio=%s", (folio,)
+                )
+                renglones = cur.fetchall()
+                cur.execute("DELETE FROM TBL_COMPRA WHERE Folio = %s AND Version = %s", (folio, version))
+                if cur.rowcount != 1 or not clave:
+                    raise ConflictoVersion()
+                _restar_cuenta(cur, clave, renglones)
+                _emitir_evento(cur, "eliminada", folio)
             conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
 
     try:
-        tx_with_retry(_tx)
-        flash(f"Folio #{folio} eliminado.", "success")
+        tx_with_retry(_tx_optimista if _optimista("delete") else _tx, sitio="delete")
+    except ConflictoVersion:
+        resultado = ({"ok": False, "conflicto": True, "msg": MSG_CONFLICTO}, 409, "warning")
     except Exception as e:
-        flash(f"Error al eliminar: {e}", "danger")
+        resultado = ({"ok": False, "msg": f"Error al eliminar: {e}"}, 500, "danger")
+    else:
+        resultado = ({"ok": True, "msg": f"Folio #{folio} eliminado."}, 200, "success")
 
+    cuerpo, estado, categoria = resultado
+    if quiere_json():
+        return jsonify(cuerpo), estado
+    flash(cuerpo["msg"], categoria)
     return redirect(url_for("index"))
 
-# ---------------- Nueva cuenta (form) ----------------
-@app.route("/pagina2")
-@login_requerido
-def pagina2():
+# ---------- Exportación del historial de ventas (solo admin) ----------
+# Un solo SELECT con cursor NO bufferizado (SSDictCursor): las filas llegan del servidor
+# conforme se escriben en la respuesta, así que la memoria no depende del rango exportado
+# y los primeros bytes salen de inmediato. Orden: ID_Fecha, Folio (idx_compra_fecha ya
+# trae ese orden porque incluye la PK), sin filesort aunque sean años de historial.
+EXPORTAR_FILAS_POR_TROZO = 500   # filas CSV acumuladas antes de mandar un trozo
+
+COLUMNAS_EXPORTACION = [
+    "Folio", "Fecha", "Hora", "ID_Mesa", "ID_Modo_Entrega", "Modo_Entrega",
+    "Cantidad_Total", "Importe_Total", "ID_Detalle", "ID_Producto", "Nombre_Producto",
+    "Categoria", "Cantidad", "Precio_Unit", "Subtotal",
+]
+COLUMNAS_CUENTA = COLUMNAS_EXPORTACION[:8]
+COLUMNAS_RENGLON = COLUMNAS_EXPORTACION[8:]
+
+def _ids_fecha_rango(cur, desde, hasta):
     """
-    Muestra el formulario para crear una cuenta:
-      - Carga catálogo de productos por categoría
-      - Pasa 'hoy' como fecha (usa min=max en el input del template para solo hoy).
+    ID_Fecha de los días en [desde, hasta] (TBL_FECHA tiene una fila por día: es chica).
+    La condición sobre Anio sola deja usar idx_fecha (Anio, Mes, Dia) como rango; la
+    expresión completa afina el día dentro de los años de los extremos.
+    """
+    where, params = [], []
+    if desde:
+        where.append("Anio >= %s AND (Anio*10000 + Mes*100 + Dia) >= %s")
+        params += [desde.year, desde.year * 10000 + desde.month * 100 + desde.day]
+    if hasta:
+        where.append("Anio <= %s AND (Anio*10000 + Mes*100 + Dia) <= %s")
+        params += [hasta.year, hasta.year * 10000 + hasta.month * 100 + hasta.day]
+    cur.execute("SELECT ID_Fecha FROM TBL_FECHA WHERE " + " AND ".join(where), params)
+    return [r["ID_Fecha"] for r in cur.fetchall()]
+
+def _sql_exportacion(ids_fecha, archivo=False):
+    """
+    SELECT de cuentas + renglones + producto + fecha; ids_fecha=None exporta todo.
+    archivo=True lee TBL_COMPRA_HIST/TBL_DETALLE_HIST en vez de las tablas del servicio.
+    """
+    compra, detalle = ("TBL_COMPRA_HIST", "TBL_DETALLE_HIST") if archivo else ("TBL_COMPRA", "TBL_DETALLE")
+    where = ""
+    if ids_fecha is not None:
+        where = "WHERE c.ID_Fecha IN (" + ",".join(["%s"] * len(ids_fecha)) + ")"
+    return f"""
+        SELECT c.Folio, f.Anio, f.Mes, f.Dia, c.Hora, c.ID_Mesa, c.ID_Modo_Entrega,
+               m.Modo_Entrega, c.Cantidad_Total, c.Importe_Total,
+               d.ID_Detalle, d.ID_Producto, p.Nombre_Producto, p.Categoria,
+               d.Cantidad, d.Precio_Unit, d.Subtotal
+          FROM {compra} c
+          JOIN TBL_FECHA f        ON f.ID_Fecha = c.ID_Fecha
+          JOIN TBL_MODO_ENTREGA m ON m.ID_Modo_Entrega = c.ID_Modo_Entrega
+          JOIN {detalle} d      ON d.Folio = c.Folio
+          JOIN TBL_PRODUCTO p     ON p.ID_Producto = d.ID_Producto
+          {where}
+         ORDER BY c.ID_Fecha, c.Folio
+    """
+
+def _fila_exportacion(r):
+    r["Fecha"] = f"{r.pop('Anio'):04d}-{r.pop('Mes'):02d}-{r.pop('Dia'):02d}"
+    r["Hora"] = str(r["Hora"])
+    for k in ("Importe_Total", "Precio_Unit", "Subtotal"):
+        r[k] = str(r[k])   # importes exactos (Decimal), sin pasar por float
+    return r
+
+def _trozos_csv(filas):
+    buf = io.StringIO()
+    w = csv.DictWriter(buf, fieldnames=COLUMNAS_EXPORTACION, extrasaction="ignore")
+    buf.write("\ufeff")   # BOM: Excel abre el UTF-8 con acentos correctamente
+    w.writeheader()
+    for i, r in enumerate(filas, 1):
+        w.writerow(r)
+        if i % EXPORTAR_FILAS_POR_TROZO == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def _trozos_ndjson(filas):
+    """Una línea JSON por cuenta con sus renglones en "detalles" (las filas llegan por Folio)."""
+    cuenta = None
+    for r in filas:
+        if cuenta is None or cuenta["Folio"] != r["Folio"]:
+            if cuenta is not None:
+                yield json.dumps(cuenta, ensure_ascii=False) + "\n"
+            cuenta = {k: r[k] for k in COLUMNAS_CUENTA}
+            cuenta["detalles"] = []
+        cuenta["detalles"].append({k: r[k] for k in COLUMNAS_RENGLON})
+    if cuenta is not None:
+        yield json.dumps(cuenta, ensure_ascii=False) + "\n"
+
+@app.route("/admin/exportar")
+@admin_requerido
+def exportar_ventas():
+    """
+    Descarga el historial de ventas con su detalle:
+      ?formato=csv (un renglón por línea de detalle) | ndjson (una cuenta por línea)
+      ?desde=YYYY-MM-DD &hasta=YYYY-MM-DD (opcionales, inclusivos)
+    Primero lo archivado y luego lo del servicio (cada parte en orden de fecha y Folio):
+    lo archivado siempre es de días anteriores.
     """
-    conn = get_db_connection()
+    formato = request.args.get("formato", "csv")
     try:
+        if formato not in ("csv", "ndjson"):
+            raise ValueError("Formato desconocido")
+        desde = parse_fecha_ui(request.args["desde"]).date() if request.args.get("desde") else None
+        hasta = parse_fecha_ui(request.args["hasta"]).date() if request.args.get("hasta") else None
+    except ValueError as e:
+        flash(f"Exportación inválida: {e}", "warning")
+        return redirect(url_for("index"))
+
+    ids_fecha = None
+    if desde or hasta:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                ids_fecha = _ids_fecha_rango(cur, desde, hasta)
+
+    def _filas(conn):
+        for archivo in (True, False):
+            # Sin "with" para el cursor: cerrarlo leería (y descartaría) todo el resto del resultado
+            cur = conn.cursor(SSDictCursor)
+            cur.execute(_sql_exportacion(ids_fecha, archivo), ids_fecha or ())
+            for r in cur:
+                yield _fila_exportacion(r)
+            cur.close()
+
+    def _generar():
+        if ids_fecha == []:
+            yield from (_trozos_csv if formato == "csv" else _trozos_ndjson)(iter(()))
+            return
+        with get_db_connection() as conn:
+            try:
+                yield from (_trozos_csv if formato == "csv" else _trozos_ndjson)(_filas(conn))
+            except GeneratorExit:
+                # El cliente cortó la descarga: se cierra la conexión en lugar de drenar
+                # el resultado pendiente (el pool la descarta al verla cerrada)
+                conn.close()
+                raise
+
+    nombre = f"ventas_{desde or 'inicio'}_{hasta or 'hoy'}.{formato}"
+    return Response(
+        stream_with_context(_generar()),
+        mimetype="text/csv" if formato == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
+
+# ---------- Reportes de ventas (leen solo los resúmenes) ----------
+# Sumas por producto / mesa / modo / día sobre TBL_RESUMEN_*_DIA: a lo más una fila por
+# día y clave, sin importar cuántas cuentas o renglones tenga el historial.
+REPORTES_POR = {
+    "producto": """
+        SELECT r.ID_Producto, p.Nombre_Producto, p.Categoria,
+               SUM(r.Cantidad) AS Cantidad, SUM(r.Importe) AS Importe
+          FROM TBL_RESUMEN_PRODUCTO_DIA r
+          JOIN TBL_PRODUCTO p ON p.ID_Producto = r.ID_Producto
+         WHERE r.ID_Fecha IN ({ids})
+         GROUP BY r.ID_Producto, p.Nombre_Producto, p.Categoria
+        HAVING SUM(r.Cantidad) <> 0 OR SUM(r.Importe) <> 0
+         ORDER BY Importe DESC
+    """,
+    "mesa": """
+        SELECT r.ID_Mesa, m.Mesa,
+               SUM(r.Cuentas) AS Cuentas, SUM(r.Cantidad) AS Cantidad, SUM(r.Importe) AS Importe
+          FROM TBL_RESUMEN_MESA_DIA r
+          JOIN TBL_MESA m ON m.ID_Mesa = r.ID_Mesa
+         WHERE r.ID_Fecha IN ({ids})
+         GROUP BY r.ID_Mesa, m.Mesa
+        HAVING SUM(r.Cuentas) <> 0
+         ORDER BY r.ID_Mesa
+    """,
+    "modo": """
+        SELECT r.ID_Modo_Entrega, m.Modo_Entrega,
+               SUM(r.Cuentas) AS Cuentas, SUM(r.Cantidad) AS Cantidad, SUM(r.Importe) AS Importe
+          FROM TBL_RESUMEN_MODO_DIA r
+          JOIN TBL_MODO_ENTREGA m ON m.ID_Modo_Entrega = r.ID_Modo_Entrega
+         WHERE r.ID_Fecha IN ({ids})
+         GROUP BY r.ID_Modo_Entrega, m.Modo_Entrega
+        HAVING SUM(r.Cuentas) <> 0
+         ORDER BY r.ID_Modo_Entrega
+    """,
+    "dia": """
+        SELECT f.Anio, f.Mes, f.Dia,
+               SUM(r.Cuentas) AS Cuentas, SUM(r.Cantidad) AS Cantidad, SUM(r.Importe) AS Importe
+          FROM TBL_RESUMEN_MODO_DIA r
+          JOIN TBL_FECHA f ON f.ID_Fecha = r.ID_Fecha
+         WHERE r.ID_Fecha IN ({ids})
+         GROUP BY f.Anio, f.Mes, f.Dia
+        HAVING SUM(r.Cuentas) <> 0
+         ORDER BY f.Anio, f.Mes, f.Dia
+    """,
+}
+
+def _reporte(cur, por, ids_fecha):
+    """Filas del reporte 'por' (producto/mesa/modo/dia) para los ID_Fecha dados."""
+    if not ids_fecha:
+        return []
+    cur.execute(REPORTES_POR[por].format(ids=",".join(["%s"] * len(ids_fecha))), ids_fecha)
+    filas = cur.fetchall()
+    for r in filas:
+        r["Cantidad"] = int(r["Cantidad"])
+        r["Importe"] = as_float(r["Importe"])
+        if "Cuentas" in r:
+            r["Cuentas"] = int(r["Cuentas"])
+        if por == "dia":
+            r["Fecha"] = f"{r.pop('Anio'):04d}-{r.pop('Mes'):02d}-{r.pop('Dia'):02d}"
+    return filas
+
+def _rango_reporte(args):
+    """?desde=&hasta= (inclusivos); sin fechas, el día de hoy. Lanza ValueError si no son válidas."""
+    hoy = date.today()
+    desde = parse_fecha_ui(args["desde"]).date() if args.get("desde") else hoy
+    hasta = parse_fecha_ui(args["hasta"]).date() if args.get("hasta") else desde if args.get("desde") else hoy
+    if desde > hasta:
+        raise ValueError("'desde' es posterior a 'hasta'")
+    return desde, hasta
+
+@app.route("/admin/reportes")
+@admin_requerido
+def reportes():
+    """Reporte de ventas por modo de entrega, mesa y producto en un rango de fechas."""
+    try:
+        desde, hasta = _rango_reporte(request.args)
+    except ValueError as e:
+        flash(f"Rango inválido: {e}", "warning")
+        desde = hasta = date.today()
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            ids_fecha = _ids_fecha_rango(cur, desde, hasta)
+            datos = {por: _reporte(cur, por, ids_fecha) for por in ("modo", "mesa", "producto")}
+
+    total = {k: sum(r[k] for r in datos["modo"]) for k in ("Cuentas", "Cantidad", "Importe")}
+    return render_template(
+        "reportes.html",
+        desde=desde.isoformat(),
+        hasta=hasta.isoformat(),
+        total=total,
+        usuario=session.get("usuario"),
+        rol=session.get("rol"),
+        **datos,
+    )
+
+@app.route("/admin/reportes/ventas.json")
+@admin_requerido
+def reportes_json():
+    """
+    Mismo origen que reportes() en JSON:
+      ?por=producto|mesa|modo|dia  &desde=YYYY-MM-DD &hasta=YYYY-MM-DD
+    """
+    por = request.args.get("por", "producto")
+    if por not in REPORTES_POR:
+        return jsonify({"ok": False, "msg": f"'por' debe ser uno de: {', '.join(REPORTES_POR)}"}), 400
+    try:
+        desde, hasta = _rango_reporte(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "msg": f"Rango inválido: {e}"}), 400
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            filas = _reporte(cur, por, _ids_fecha_rango(cur, desde, hasta))
+
+    return jsonify({"por": por, "desde": desde.isoformat(), "hasta": hasta.isoformat(), "filas": filas})
+
+def reconstruir_resumenes(desde=None, hasta=None):
+    """
+    Vuelve a calcular los resúmenes desde TBL_COMPRA/TBL_DETALLE y su archivo (_HIST), un
+    día por transacción (DELETE de las filas del día + INSERT ... SELECT ... GROUP BY de
+    cada par de tablas, sumando si un día quedó repartido entre ambas). Sirve para llenarlas
+    la primera vez o después de cargar datos por fuera de app.py. Bloquea las cabeceras
+    del día mientras tanto; conviene correrla sin tráfico de escritura en esos días.
+    Devuelve cuántos días procesó.
+    """
+    with get_db_connection() as conn:
         with conn.cursor() as cur:
+            if desde or hasta:
+                ids_fecha = _ids_fecha_rango(cur, desde, hasta)
+            else:
+                cur.execute("SELECT ID_Fecha FROM TBL_FECHA")
+                ids_fecha = [r["ID_Fecha"] for r in cur.fetchall()]
+        conn.commit()
+
+        for id_fecha in sorted(ids_fecha):
+            with conn.cursor() as cur:
+                _reconstruir_dia(cur, id_fecha)
+            conn.commit()
+    return len(ids_fecha)
+
+def _reconstruir_dia(cur, id_fecha):
+    """Sentencias de reconstruir_resumenes() para un día (el commit lo hace quien llama)."""
+    cur.execute("SELECT Folio FROM TBL_COMPRA WHERE ID_Fecha=%s FOR UPDATE", (id_fecha,))
+    for tabla in ("PRODUCTO", "MESA", "MODO"):
+        cur.execute(f"DELETE FROM TBL_RESUMEN_{tabla}_DIA WHERE ID_Fecha=%s", (id_fecha,))
+    for compra, detalle in (("TBL_COMPRA", "TBL_DETALLE"), ("TBL_COMPRA_HIST", "TBL_DETALLE_HIST")):
+        cur.execute(f"""
+            INSERT INTO TBL_RESUMEN_PRODUCTO_DIA (ID_Fecha, ID_Producto, Cantidad, Importe)
+            SELECT c.ID_Fecha, d.ID_Producto, SUM(d.Cantidad), SUM(d.Subtotal)
+              FROM {compra} c
+              JOIN {detalle} d ON d.Folio = c.Folio
+             WHERE c.ID_Fecha = %s
+             GROUP BY c.ID_Fecha, d.ID_Producto
+            ON DUPLICATE KEY UPDATE Cantidad = Cantidad + VALUES(Cantidad),
+                                    Importe  = Importe + VALUES(Importe)
+        """, (id_fecha,))
+        for tabla, columna in (("MESA", "ID_Mesa"), ("MODO", "ID_Modo_Entrega")):
+            cur.execute(f"""
+                INSERT INTO TBL_RESUMEN_{tabla}_DIA (ID_Fecha, {columna}, Cuentas, Cantidad, Importe)
+                SELECT c.ID_Fecha, c.{columna}, COUNT(DISTINCT c.Folio),
+                       COALESCE(SUM(d.Cantidad),0), COALESCE(SUM(d.Subtotal),0)
+                  FROM {compra} c
+                  LEFT JOIN {detalle} d ON d.Folio = c.Folio
+                 WHERE c.ID_Fecha = %s
+                 GROUP BY c.ID_Fecha, c.{columna}
+                ON DUPLICATE KEY UPDATE Cuentas  = Cuentas + VALUES(Cuentas),
+                                        Cantidad = Cantidad + VALUES(Cantidad),
+                                        Importe  = Importe + VALUES(Importe)
+            """, (id_fecha,))
+
+@app.cli.command("reconstruir-resumenes")
+@click.option("--desde", default=None, help="YYYY-MM-DD (inclusivo); sin fechas, todo el historial")
+@click.option("--hasta", default=None, help="YYYY-MM-DD (inclusivo)")
+def reconstruir_resumenes_cli(desde, hasta):
+    """Recalcula TBL_RESUMEN_*_DIA desde el detalle: flask --app app reconstruir-resumenes"""
+    try:
+        desde = parse_fecha_ui(desde).date() if desde else None
+        hasta = parse_fecha_ui(hasta).date() if hasta else None
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    dias = reconstruir_resumenes(desde, hasta)
+    click.echo(f"Resúmenes reconstruidos: {dias} día(s).")
+
+# ---------- Archivo de cuentas cerradas (TBL_COMPRA_HIST / TBL_DETALLE_HIST) ----------
+# Las cuentas de días anteriores a ARCHIVO_HORIZONTE_DIAS se mueven al archivo
+# (migraciones/005_archivo_ventas.sql) para que las tablas del servicio solo tengan lo
+# reciente. Cada lote es su propia transacción corta: bloquea ARCHIVO_LOTE cabeceras
+# con FOR UPDATE (el mismo orden cabecera -> detalle que update/delete), copia cabeceras
+# y renglones y borra la cabecera: fk_detalle_compra (ON DELETE CASCADE) borra el detalle.
+# Entre lotes espera ARCHIVO_PAUSA_SEG para dejar pasar al servicio. Los resúmenes no
+# cambian (las ventas siguen siendo las mismas) y no se emiten eventos: la ETag del
+# listado incluye el tope del archivo.
+ARCHIVO_HORIZONTE_DIAS = int(os.getenv("ARCHIVO_HORIZONTE_DIAS", "90"))
+ARCHIVO_LOTE = int(os.getenv("ARCHIVO_LOTE", "200"))            # cuentas por transacción
+ARCHIVO_PAUSA_SEG = float(os.getenv("ARCHIVO_PAUSA_SEG", "0.05"))
+# Tarea de fondo opcional: mueve filas de producción, así que solo corre con ARCHIVO_SEG > 0
+# (p. ej. 3600). Sin ella se archiva a mano con "flask --app app archivar-ventas".
+ARCHIVO_SEG = float(os.getenv("ARCHIVO_SEG", "0"))
+
+COLUMNAS_COMPRA = ("Folio, Importe_Total, Cantidad_Total, Hora, ID_Modo_Entrega, ID_Fecha, ID_Mesa, Version, "
+                   "ID_Pedido_Cliente")
+COLUMNAS_DETALLE = "ID_Detalle, Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal, Version"
+
+_ARCHIVO = {"pasadas": 0, "cuentas": 0, "ultima": None}
+_ARCHIVO_LOCK = threading.Lock()   # contadores: la tarea de fondo y archivar-ventas pueden coincidir
+
+def _archivar_lote(id_fecha, lote):
+    """Mueve hasta 'lote' cuentas del día al archivo en una transacción. Devuelve cuántas movió."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # idx_compra_fecha (ID_Fecha, Folio): sin filesort y solo bloquea las filas del lote
             cur.execute(
-                """
-                SELECT ID_Producto, Nombre_Producto, Precio_Producto,
-                       COALESCE(Categoria,'Otros') AS Categoria
-                  FROM TBL_PRODUCTO
-                 ORDER BY Categoria, Nombre_Producto
-                """
+                "SELECT Folio FROM TBL_COMPRA WHERE ID_Fecha=%s ORDER BY Folio LIMIT %s FOR UPDATE",
+                (id_fecha, lote),
             )
-            rows = cur.fetchall()
-    finally:
-        conn.close()
+            folios = [r["Folio"] for r in cur.fetchall()]
+            if not folios:
+                conn.rollback()
+                return 0
+            _mover_al_archivo(cur, folios)
+        conn.commit()
+        return len(folios)
+
+def _mover_al_archivo(cur, folios):
+    """Copia cabeceras y renglones de 'folios' (ya bloqueados) al archivo y borra las cabeceras."""
+    en = ",".join(["%s"] * len(folios))
+    cur.execute(f"INSERT INTO TBL_COMPRA_HIST ({COLUMNAS_COMPRA}) "
+                f"SELECT {COLUMNAS_COMPRA} FROM TBL_COMPRA WHERE Folio IN ({en})", folios)
+    cur.execute(f"INSERT INTO TBL_DETALLE_HIST ({COLUMNAS_DETALLE}) "
+                f"SELECT {COLUMNAS_DETALLE} FROM TBL_DETALLE WHERE Folio IN ({en})", folios)
+    cur.execute(f"DELETE FROM TBL_COMPRA WHERE Folio IN ({en})", folios)
+
+def archivar_ventas(horizonte_dias=None, lote=None):
+    """
+    Mueve al archivo las cuentas de los días anteriores a hoy - horizonte_dias, por lotes.
+    Devuelve cuántas cuentas movió.
+    """
+    horizonte_dias = ARCHIVO_HORIZONTE_DIAS if horizonte_dias is None else horizonte_dias
+    lote = lote or ARCHIVO_LOTE
+    ultimo_dia = date.today() - timedelta(days=horizonte_dias + 1)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            ids_fecha = _ids_fecha_rango(cur, None, ultimo_dia)
+        conn.commit()
 
+    movidas = 0
+    for id_fecha in sorted(ids_fecha):
+        while True:
+            n = tx_with_retry(lambda: _archivar_lote(id_fecha, lote), sitio="archivo")
+            movidas += n
+            if n < lote:
+                break
+            time.sleep(ARCHIVO_PAUSA_SEG)
+
+    with _ARCHIVO_LOCK:
+        _ARCHIVO["pasadas"] += 1
+        _ARCHIVO["cuentas"] += movidas
+        _ARCHIVO["ultima"] = datetime.now()
+    if movidas:
+        app.logger.info("Archivo: %d cuentas anteriores a %s movidas a TBL_COMPRA_HIST", movidas, ultimo_dia)
+    return movidas
+
+@app.cli.command("archivar-ventas")
+@click.option("--horizonte", type=int, default=None,
+              help=f"días que se quedan en las tablas del servicio (por defecto {ARCHIVO_HORIZONTE_DIAS})")
+@click.option("--lote", type=int, default=None, help=f"cuentas por transacción (por defecto {ARCHIVO_LOTE})")
+def archivar_ventas_cli(horizonte, lote):
+    """Mueve las cuentas viejas al archivo: flask --app app archivar-ventas"""
+    movidas = archivar_ventas(horizonte, lote)
+    click.echo(f"Cuentas archivadas: {movidas}.")
+
+# ---------------- Caché del catálogo de productos ----------------
+# El menú cambia muy pocas veces: se guarda en memoria el catálogo agrupado por
+# categoría y su fragmento HTML ya renderizado. Como mucho cada CATALOGO_REVISAR_SEG
+# se lee de BD una "versión" barata (conteo + checksum de TBL_PRODUCTO); solo si
+# cambió se vuelve a leer el catálogo completo. Entre revisiones: cero consultas.
+CATALOGO_REVISAR_SEG = float(os.getenv("CATALOGO_REVISAR_SEG", "60"))
+
+_CATALOGO = {"version": None, "catalogo": None, "html": None, "revisado": 0.0}
+_CATALOGO_LOCK = threading.Lock()
+
+def _leer_catalogo(cur):
+    """Lee TBL_PRODUCTO y arma el dict categoría -> productos."""
+    cur.execute(
+        """
+        SELECT ID_Producto, Nombre_Producto, Precio_Producto,
+               COALESCE(Categoria,'Otros') AS Categoria
+          FROM TBL_PRODUCTO
+         ORDER BY Categoria, Nombre_Producto
+        """
+    )
     catalogo = {}
-    for r in rows:
+    for r in cur.fetchall():
         catalogo.setdefault(r["Categoria"], []).append({
             "id": r["ID_Producto"],
             "nombre": r["Nombre_Producto"],
             "precio": as_float(r["Precio_Producto"]),
         })
+    return catalogo
+
+def _catalogo_vigente():
+    """
+    Devuelve la entrada de caché {catalogo, html, ...} vigente.
+    Solo un hilo revisa la versión a la vez; los demás usan su resultado.
+    """
+    c = _CATALOGO
+    if c["html"] is not None and time.monotonic() - c["revisado"] < CATALOGO_REVISAR_SEG:
+        return c
+    with _CATALOGO_LOCK:
+        c = _CATALOGO
+        if c["html"] is not None and time.monotonic() - c["revisado"] < CATALOGO_REVISAR_SEG:
+            return c
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT COUNT(*) AS n,
+                           COALESCE(BIT_XOR(CRC32(CONCAT_WS('|', ID_Producto, Nombre_Producto,
+                                                             Precio_Producto, Categoria))), 0) AS crc
+                      FROM TBL_PRODUCTO
+                    """
+                )
+                v = cur.fetchone()
+                version = (v["n"], int(v["crc"]))
+                if version == c["version"] and c["html"] is not None:
+                    c["revisado"] = time.monotonic()
+                    return c
+                catalogo = _leer_catalogo(cur)
+        nuevo = {
+            "version": version,
+            "catalogo": catalogo,
+            "html": Markup(render_template("_catalogo.html", catalogo=catalogo)),
+            "revisado": time.monotonic(),
+        }
+        _CATALOGO.update(nuevo)
+        return nuevo
+
+def invalidar_catalogo():
+    """Fuerza que la próxima apertura de /pagina2 revise (y recargue) el catálogo."""
+    with _CATALOGO_LOCK:
+        _CATALOGO.update(version=None, catalogo=None, html=None, revisado=0.0)
+
+@app.route("/admin/catalogo/invalidar", methods=["POST"])
+@admin_requerido
+def catalogo_invalidar():
+    """Invalidación explícita del catálogo en memoria (p. ej. tras editar precios en la BD)."""
+    invalidar_catalogo()
+    flash("Catálogo recargado.", "success")
+    return redirect(url_for("index"))
+
+# ---------------- Nueva cuenta (form) ----------------
+@app.route("/pagina2")
+@login_requerido
+def pagina2():
+    """
+    Muestra el formulario para crear una cuenta:
+      - Catálogo de productos por categoría desde la caché en memoria (ver _catalogo_vigente)
+      - Pasa 'hoy' como fecha (usa min=max en el input del template para solo hoy).
+    """
+    c = _catalogo_vigente()
 
     hoy = date.today().isoformat()
     return render_template(
         "pagina2.html",
-        catalogo=catalogo,
+        catalogo=c["catalogo"],
+        catalogo_html=c["html"],
         hoy=hoy,  # En el template: <input type="date" min="{{hoy}}" max="{{hoy}}" ...>
         usuario=session.get("usuario"),
         rol=session.get("rol"),
     )
 
+# ---------------- Dimensión fecha (TBL_FECHA) ----------------
+# ID_Fecha del día en curso cacheado en el proceso: una cuenta nueva ya no hace
+# SELECT (ni INSERT) en TBL_FECHA salvo la primera del día.
+_FECHA_HOY = {"dia": None, "id": None}
+_FECHA_LOCK = threading.Lock()
+
+def _id_fecha(conn, dia):
+    """
+    Devuelve el ID_Fecha de 'dia' (date), creándolo si no existe.
+    - Solo se cachea el día en curso (otra fecha se resuelve sin tocar la caché); al pasar la
+      medianoche la clave cambia y se resuelve de nuevo.
+    - La resolución va bajo lock y en su propia transacción corta (COMMIT antes de la cuenta):
+      dos primeras cuentas simultáneas del día no duplican la fila en este proceso, y el ID
+      se cachea solo ya confirmado (un rollback de la cuenta no deja en caché un ID inexistente).
+    - TBL_FECHA no tiene UNIQUE (Anio, Mes, Dia): si otro proceso duplicó el día, se toma
+      siempre el ID menor.
+    """
+    c = _FECHA_HOY
+    if c["dia"] == dia:
+        return c["id"]
+    with _FECHA_LOCK:
+        if _FECHA_HOY["dia"] == dia:
+            return _FECHA_HOY["id"]
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT ID_Fecha FROM TBL_FECHA
+                WHERE Anio=%s AND Mes=%s AND Dia=%s
+                ORDER BY ID_Fecha
+                LIMIT 1
+            """, (dia.year, dia.month, dia.day))
+            row = cur.fetchone()
+            if row:
+                id_fecha = row["ID_Fecha"]
+            else:
+                cur.execute("INSERT INTO TBL_FECHA (Dia, Mes, Anio) VALUES (%s,%s,%s)",
+                            (dia.day, dia.month, dia.year))
+                id_fecha = cur.lastrowid
+        conn.commit()
+        if dia == date.today():
+            # Solo hoy (se publica ya con el ID confirmado): reaplicar el diario o archivar y
+            # exportar días pasados no debe sacar de la caché al día en curso
+            _FECHA_HOY.update(dia=dia, id=id_fecha)
+        return id_fecha
+
 # ---------------- Guardar nueva cuenta ----------------
+def _normalizar_lineas(detalles):
+    """
+    Valida los renglones enviados por pagina2 y calcula su Subtotal en el servidor:
+      - cantidad 1..50, precio 0.01..10000 (mismos límites que el editor inline)
+      - Subtotal = Cantidad * Precio_Unit con Decimal (a centavos)
+    Lanza ValueError/KeyError/TypeError si un renglón no es válido.
+    """
+    lineas = []
+    for d in detalles:
+        cant = int(d["cantidad"])
+        precio = Decimal(str(d["precio"])).quantize(CENTAVO, ROUND_HALF_UP)
+        if not (1 <= cant <= 50) or not (CENTAVO <= precio <= 10000):
+            raise ValueError("Cantidad o precio fuera de rango")
+        lineas.append({
+            "id_producto": int(d["id_producto"]),
+            "cantidad": cant,
+            "precio": precio,
+            "subtotal": (precio * cant).quantize(CENTAVO, ROUND_HALF_UP),
+        })
+    return lineas
+
+def _insertar_cuenta(cur, id_fecha, id_mesa, id_modo, hora, lineas, id_pedido=None):
+    """
+    Inserta cabecera + detalle de una cuenta y devuelve su Folio.
+    Los totales de la cabecera son la suma de los mismos Subtotal que se guardan en
+    TBL_DETALLE, y el detalle va en un solo INSERT multi-fila (executemany).
+    También suma la cuenta a los resúmenes del día y emite el evento 'creada'.
+    'id_pedido' (ID_Pedido_Cliente, UNIQUE) hace que repetir el mismo pedido falle con 1062.
+    """
+    cantidad_total = sum(l["cantidad"] for l in lineas)
+    importe_total = sum((l["subtotal"] for l in lineas), Decimal("0.00"))
+    cur.execute("""
+         INSERT INTO TBL_COMPRA (ID_Fecha, ID_Mesa, Hora, Cantidad_Total, Importe_Total, ID_Modo_Entrega,
+                                 ID_Pedido_Cliente)
+         VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                (id_fecha, id_mesa, hora, cantidad_total, importe_total, id_modo, id_pedido))
+    folio = cur.lastrowid
+    cur.executemany("""
+        INSERT INTO TBL_DETALLE (Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal)
+        VALUES (%s, %s, %s, %s, %s)
+    """, [(folio, l["id_producto"], l["cantidad"], l["precio"], l["subtotal"]) for l in lineas])
+
+    clave = {"ID_Fecha": id_fecha, "ID_Mesa": id_mesa, "ID_Modo_Entrega": id_modo}
+    delta = _delta_resumen()
+    _sumar_renglones(delta, clave, [
+        {"ID_Producto": l["id_producto"], "Cantidad": l["cantidad"], "Subtotal": l["subtotal"]} for l in lineas
+    ])
+    _sumar_cuenta(delta, clave, 1, cantidad_total, importe_total)
+    _aplicar_resumen(cur, delta)
+    _emitir_evento(cur, "creada", folio)
+    return folio
+
+def _insertar_cuentas(cur, cuentas):
+    """
+    Varias cuentas con un INSERT multi-fila por tabla (commit en grupo); devuelve sus Folio
+    en el mismo orden. Cada cuenta es un dict con id_fecha, id_mesa, id_modo, hora, lineas e
+    id_pedido, obligatorio: el Folio se recupera por ID_Pedido_Cliente, porque los
+    AUTO_INCREMENT de un INSERT multi-fila no son necesariamente consecutivos.
+    Resúmenes y eventos como en _insertar_cuenta, pero sin avisar al hilo de /eventos
+    (no hay petición): lo despierta quien confirma la transacción.
+    """
+    totales = [(sum(l["cantidad"] for l in c["lineas"]),
+                sum((l["subtotal"] for l in c["lineas"]), Decimal("0.00"))) for c in cuentas]
+    cur.executemany("""
+         INSERT INTO TBL_COMPRA (ID_Fecha, ID_Mesa, Hora, Cantidad_Total, Importe_Total, ID_Modo_Entrega,
+                                 ID_Pedido_Cliente)
+         VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    [(c["id_fecha"], c["id_mesa"], c["hora"], cantidad, importe, c["id_modo"], c["id_pedido"])
+                     for c, (cantidad, importe) in zip(cuentas, totales)])
+    ids_pedido = [c["id_pedido"] for c in cuentas]
+    cur.execute("SELECT Folio, ID_Pedido_Cliente FROM TBL_COMPRA WHERE ID_Pedido_Cliente IN ("
+                + ",".join(["%s"] * len(ids_pedido)) + ")", ids_pedido)
+    por_pedido = {r["ID_Pedido_Cliente"]: r["Folio"] for r in cur.fetchall()}
+    folios = [por_pedido[i] for i in ids_pedido]
+    cur.executemany("""
+        INSERT INTO TBL_DETALLE (Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal)
+        VALUES (%s, %s, %s, %s, %s)
+    """, [(folio, l["id_producto"], l["cantidad"], l["precio"], l["subtotal"])
+          for folio, c in zip(folios, cuentas) for l in c["lineas"]])
+
+    delta = _delta_resumen()
+    for c, (cantidad, importe) in zip(cuentas, totales):
+        clave = {"ID_Fecha": c["id_fecha"], "ID_Mesa": c["id_mesa"], "ID_Modo_Entrega": c["id_modo"]}
+        _sumar_renglones(delta, clave, [
+            {"ID_Producto": l["id_producto"], "Cantidad": l["cantidad"], "Subtotal": l["subtotal"]}
+            for l in c["lineas"]
+        ])
+        _sumar_cuenta(delta, clave, 1, cantidad, importe)
+    _aplicar_resumen(cur, delta)
+    cur.executemany(SQL_EVENTO, [("creada", folio) for folio in folios])
+    return folios
+
+def _guardar_cuenta(momento, id_mesa, id_modo, lineas, id_pedido, rol=None):
+    """Guarda una cuenta en su propia transacción (camino normal de /add). Devuelve su Folio."""
+    with get_db_connection(rol) as conn:
+        try:
+            # ---- Fecha/Hora normalizada (fecha en TBL_FECHA, hora en COMPRA)
+            id_fecha = _id_fecha(conn, momento.date())
+            with conn.cursor() as cur:
+                folio = _insertar_cuenta(cur, id_fecha, id_mesa, id_modo,
+                                         momento.strftime("%H:%M:%S"), lineas, id_pedido)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return folio
+
 @app.route("/add", methods=["POST"])
 @login_requerido
 def add():
@@ -503,62 +2359,428 @@ def add():
     if not id_mesa or not detalles_json:
         flash("Datos incompletos para registrar la cuenta.", "warning")
         return redirect(url_for("pagina2"))
+    if id_mesa not in [str(x) for x in range(100, 109)] or id_modo_entrega not in ("1", "2"):
+        flash("Mesa o modo de entrega inválido.", "warning")
+        return redirect(url_for("pagina2"))
 
     try:
         detalles = json.loads(detalles_json)
-    except json.JSONDecodeError:
+        lineas = _normalizar_lineas(detalles)
+    except (json.JSONDecodeError, ValueError, KeyError, TypeError, ArithmeticError):
         flash("Error en los detalles del pedido.", "danger")
         return redirect(url_for("pagina2"))
 
-    if not detalles:
+    if not lineas:
         flash("Agrega al menos un producto.", "warning")
         return redirect(url_for("pagina2"))
 
-    conn = get_db_connection()
+    # ID del pedido generado por el formulario: reenviarlo no duplica la cuenta
+    id_pedido = _id_pedido(request.form.get("id_pedido"))
+    now = datetime.now()
+
+    if PEDIDOS_DIARIO:
+        try:
+            nuevo = _encolar_pedido(id_pedido, int(id_mesa), int(id_modo_entrega), now, lineas)
+        except OSError:
+            # Sin diario (disco lleno, permisos): se guarda directo en la BD como antes
+            app.logger.exception("No se pudo escribir el diario de pedidos %s", PEDIDOS_DIARIO)
+        else:
+            if nuevo:
+                flash(f"Pedido de la mesa {id_mesa} recibido; aparecerá en el listado en cuanto se guarde.",
+                      "success")
+            else:
+                flash("Ese pedido ya se había recibido.", "info")
+            return redirect(url_for("index"))
+
     try:
+        if COMMIT_GRUPO_MS > 0:
+            _guardar_en_grupo(now, int(id_mesa), int(id_modo_entrega), lineas, id_pedido)
+        else:
+            _guardar_cuenta(now, id_mesa, id_modo_entrega, lineas, id_pedido)
+        flash("Cuenta registrada correctamente.", "success")
+    except IntegrityError as e:
+        if e.args and e.args[0] == 1062:   # ux_compra_pedido: el mismo pedido ya está guardado
+            flash("Ese pedido ya estaba registrado.", "info")
+        else:
+            flash(f"Error al registrar la cuenta: {e}", "danger")
+    except Exception as e:
+        flash(f"Error al registrar la cuenta: {e}", "danger")
+
+    return redirect(url_for("index"))
+
+# ---------------- Commit en grupo (/add en hora pico) ----------------
+# Con COMMIT_GRUPO_MS > 0, /add no abre su propia transacción: deja la cuenta en una cola y
+# espera. Un hilo escritor junta las cuentas que llegan durante COMMIT_GRUPO_MS (o hasta
+# COMMIT_GRUPO_MAX) y las guarda en una sola transacción con INSERT multi-fila
+# (_insertar_cuentas): un COMMIT, y un flush del redo log, por lote en lugar de por cuenta.
+# Cada /add recibe el Folio de su cuenta. Si el lote falla (p. ej. un pedido reenviado,
+# 1062 en ID_Pedido_Cliente), sus cuentas se guardan una por una como en el camino normal,
+# para que el error le llegue solo a la petición que lo causó.
+# COMMIT_GRUPO_MS es la latencia que se agrega a una cuenta que llega sola.
+COMMIT_GRUPO_MS = float(os.getenv("COMMIT_GRUPO_MS", "0"))    # 0 = cada /add confirma lo suyo
+COMMIT_GRUPO_MAX = int(os.getenv("COMMIT_GRUPO_MAX", "32"))   # cuentas por lote como máximo
+COMMIT_GRUPO_ESPERA_SEG = float(os.getenv("COMMIT_GRUPO_ESPERA_SEG", "30"))  # tope de espera de /add
+
+_GRUPO = {"hilo": None, "lotes": 0, "cuentas": 0, "separadas": 0}
+_GRUPO_LOCK = threading.Lock()   # arranque del escritor y contadores de _GRUPO
+_GRUPO_COLA = queue.Queue()
+
+def iniciar_grupo():
+    """Arranca el hilo escritor en grupo (una vez por proceso)."""
+    with _GRUPO_LOCK:
+        if _GRUPO["hilo"] is None:
+            _GRUPO["hilo"] = threading.Thread(target=_bucle_grupo, name="commit-grupo", daemon=True)
+            _GRUPO["hilo"].start()
+
+def _guardar_en_grupo(momento, id_mesa, id_modo, lineas, id_pedido):
+    """Deja la cuenta al escritor en grupo y espera su Folio; relanza el error de su cuenta."""
+    iniciar_grupo()
+    cuenta = {"momento": momento, "id_mesa": id_mesa, "id_modo": id_modo, "lineas": lineas,
+              "id_pedido": id_pedido, "rol": session.get("rol"),
+              "listo": threading.Event(), "folio": None, "error": None}
+    _GRUPO_COLA.put(cuenta)
+    if not cuenta["listo"].wait(COMMIT_GRUPO_ESPERA_SEG):
+        # Puede guardarse después: reenviar el mismo formulario no la duplica (ID_Pedido_Cliente)
+        raise TimeoutError("la cuenta no se confirmó a tiempo")
+    if cuenta["error"] is not None:
+        raise cuenta["error"]
+    return cuenta["folio"]
+
+def _insertar_lote(rol, lote):
+    with get_db_connection(rol) as conn:
+        ids_fecha = {}
+        for c in lote:
+            dia = c["momento"].date()
+            if dia not in ids_fecha:
+                ids_fecha[dia] = _id_fecha(conn, dia)
+        cuentas = [dict(c, id_fecha=ids_fecha[c["momento"].date()], hora=c["momento"].strftime("%H:%M:%S"))
+                   for c in lote]
         with conn.cursor() as cur:
-            # ---- Fecha/Hora normalizada (fecha en TBL_FECHA, hora en COMPRA)
-            now = datetime.now()
-            dia, mes, anio = now.day, now.month, now.year
-            hora_str = now.strftime("%H:%M:%S")
+            folios = _insertar_cuentas(cur, cuentas)
+        conn.commit()
+        return folios
 
-            cur.execute("""
-                SELECT ID_Fecha FROM TBL_FECHA
-                WHERE Dia=%s AND Mes=%s AND Anio=%s
-            """, (dia, mes, anio))
+def _guardar_lote(rol, lote):
+    """Un lote (mismo rol de BD) en una transacción; si falla, cada cuenta por separado."""
+    try:
+        folios = tx_with_retry(lambda: _insertar_lote(rol, lote), sitio="grupo")
+    except Exception as e:
+        if len(lote) == 1:
+            lote[0]["error"] = e
+        else:
+            app.logger.warning("Lote de %d cuentas falló (%s); se guardan por separado", len(lote), e)
+            for c in lote:
+                try:
+                    c["folio"] = _guardar_cuenta(c["momento"], c["id_mesa"], c["id_modo"],
+                                                 c["lineas"], c["id_pedido"], rol)
+                except Exception as e_cuenta:
+                    c["error"] = e_cuenta
+            with _GRUPO_LOCK:
+                _GRUPO["separadas"] += len(lote)
+    else:
+        for c, folio in zip(lote, folios):
+            c["folio"] = folio
+        with _GRUPO_LOCK:
+            _GRUPO["lotes"] += 1
+            _GRUPO["cuentas"] += len(lote)
+
+def _bucle_grupo():
+    while True:
+        lote = [_GRUPO_COLA.get()]
+        limite = time.monotonic() + COMMIT_GRUPO_MS / 1000
+        while len(lote) < COMMIT_GRUPO_MAX:
+            resto = limite - time.monotonic()
+            try:
+                lote.append(_GRUPO_COLA.get(timeout=resto) if resto > 0 else _GRUPO_COLA.get_nowait())
+            except queue.Empty:
+                break
+        por_rol = {}
+        for c in lote:
+            por_rol.setdefault(c["rol"], []).append(c)
+        try:
+            for rol, cuentas in por_rol.items():
+                _guardar_lote(rol, cuentas)
+        except Exception as e:
+            app.logger.exception("Falló el escritor en grupo")
+            for c in lote:
+                if c["folio"] is None and c["error"] is None:
+                    c["error"] = e
+        _EVENTOS_DESPERTAR.set()   # las cuentas nuevas ya están confirmadas
+        for c in lote:
+            c["listo"].set()
+
+# ---------------- Diario de pedidos (/add sin esperar a la BD) ----------------
+# Con PEDIDOS_DIARIO=<ruta>, /add valida el pedido, lo agrega como una línea JSON al
+# final del diario y responde en cuanto la línea está en disco (fsync), sin tocar la BD.
+# Varias peticiones simultáneas comparten un fsync: la primera sincroniza todo lo escrito
+# hasta ese momento y las demás solo esperan a que termine.
+# Un hilo aplicador pasa los pedidos a TBL_COMPRA/TBL_DETALLE en el orden del diario y
+# anota en él el Folio de cada uno. Cada pedido lleva su ID_Pedido_Cliente (UNIQUE,
+# migraciones/007_id_pedido_cliente.sql): aplicarlo de nuevo tras un reintento o un
+# reinicio encuentra la cuenta ya guardada en lugar de duplicarla. Al arrancar se relee
+# el diario y se aplica lo que no tenga marca. Un diario por proceso (no compartir la ruta).
+PEDIDOS_DIARIO = os.getenv("PEDIDOS_DIARIO", "")
+PEDIDOS_REINTENTO_SEG = float(os.getenv("PEDIDOS_REINTENTO_SEG", "2"))
+PEDIDOS_DIARIO_MAX_BYTES = int(os.getenv("PEDIDOS_DIARIO_MAX_BYTES", str(4 * 1024 * 1024)))
+PEDIDOS_RESUELTOS_MAX = 500          # pedidos ya aplicados/rechazados que se recuerdan
+PEDIDOS_RECHAZOS_VISIBLES_SEG = 600  # cuánto tiempo muestra el listado un pedido rechazado
+
+RE_ID_PEDIDO = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+SQL_FOLIO_PEDIDO = "SELECT Folio FROM TBL_COMPRA WHERE ID_Pedido_Cliente=%s"
+
+_DIARIO = {"fd": None, "hilo": None, "escritos": 0, "sincronizados": 0, "fsyncs": 0,
+           "aplicados": 0, "rechazados": 0, "ultimo_error": None}
+_DIARIO_LOCK = threading.Lock()        # escritura al final del diario + _PEDIDOS + contadores
+_DIARIO_FSYNC_LOCK = threading.Lock()  # un fsync a la vez; los que esperan quedan cubiertos
+_DIARIO_AVISO = threading.Event()      # despierta al aplicador
+_PEDIDOS = OrderedDict()               # ID_Pedido_Cliente -> pedido pendiente (orden del diario)
+_PEDIDOS_RESUELTOS = OrderedDict()     # ID_Pedido_Cliente -> pedido aplicado/rechazado
+
+def _id_pedido(valor):
+    """ID_Pedido_Cliente enviado por el formulario (UUID) o uno nuevo si falta o no es válido."""
+    valor = (valor or "").strip().lower()
+    return valor if RE_ID_PEDIDO.fullmatch(valor) else str(uuid.uuid4())
+
+def _diario_agregar(registro):
+    """Escribe una línea al final del diario (llamar con _DIARIO_LOCK). Devuelve su número."""
+    linea = json.dumps(registro, ensure_ascii=False, separators=(",", ":")) + "\n"
+    os.write(_DIARIO["fd"], linea.encode("utf-8"))
+    _DIARIO["escritos"] += 1
+    return _DIARIO["escritos"]
+
+def _diario_sincronizar(n):
+    """Vuelve cuando la escritura 'n' ya está en disco; un fsync cubre todo lo escrito antes."""
+    if _DIARIO["sincronizados"] >= n:
+        return
+    with _DIARIO_FSYNC_LOCK:
+        if _DIARIO["sincronizados"] >= n:
+            return   # el fsync de otra petición ya la cubrió
+        hasta = _DIARIO["escritos"]
+        os.fsync(_DIARIO["fd"])
+        _DIARIO["sincronizados"] = hasta
+        _DIARIO["fsyncs"] += 1
+
+def _leer_diario(ruta):
+    """
+    Pedidos del diario sin marca de aplicado/rechazado, en orden. Si la última línea quedó
+    a medias (caída durante la escritura) se recorta: su /add nunca llegó a responder.
+    """
+    with open(ruta, "rb") as f:
+        datos = f.read()
+    completo = datos.rfind(b"\n") + 1
+    if completo < len(datos):
+        os.truncate(ruta, completo)
+    pendientes = OrderedDict()
+    for linea in datos[:completo].splitlines():
+        try:
+            r = json.loads(linea)
+        except ValueError:
+            app.logger.warning("Línea ilegible en el diario de pedidos: %r", linea[:200])
+            continue
+        if "lineas" in r:
+            pendientes[r["id"]] = r
+        else:
+            pendientes.pop(r["id"], None)
+    return pendientes
+
+def iniciar_diario():
+    """Abre el diario, recupera lo pendiente y arranca el aplicador (una vez por proceso)."""
+    with _DIARIO_LOCK:
+        if _DIARIO["fd"] is not None:
+            return
+        pendientes = _leer_diario(PEDIDOS_DIARIO) if os.path.exists(PEDIDOS_DIARIO) else {}
+        _DIARIO["fd"] = os.open(PEDIDOS_DIARIO, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        for id_pedido, r in pendientes.items():
+            _PEDIDOS[id_pedido] = dict(r, estado="pendiente", error=None)
+        _DIARIO["hilo"] = threading.Thread(target=_bucle_diario, name="diario-pedidos", daemon=True)
+        _DIARIO["hilo"].start()
+    if pendientes:
+        app.logger.info("Diario de pedidos: %d pedido(s) sin aplicar recuperados", len(pendientes))
+
+def _encolar_pedido(id_pedido, id_mesa, id_modo, momento, lineas):
+    """
+    Agrega el pedido al diario y espera su fsync. Devuelve False si ese ID_Pedido_Cliente
+    ya estaba en el diario (doble envío). Lanza OSError si no se pudo escribir.
+    """
+    iniciar_diario()
+    registro = {
+        "id": id_pedido, "mesa": id_mesa, "modo": id_modo,
+        "fecha": momento.date().isoformat(), "hora": momento.strftime("%H:%M:%S"),
+        "usuario": session.get("usuario"),
+        "lineas": [{"id_producto": l["id_producto"], "cantidad": l["cantidad"],
+                    "precio": str(l["precio"]), "subtotal": str(l["subtotal"])} for l in lineas],
+    }
+    with _DIARIO_LOCK:
+        if id_pedido in _PEDIDOS or id_pedido in _PEDIDOS_RESUELTOS:
+            return False
+        n = _diario_agregar(registro)
+        _PEDIDOS[id_pedido] = dict(registro, estado="pendiente", error=None)
+    _diario_sincronizar(n)
+    _DIARIO_AVISO.set()
+    return True
+
+def _aplicar_pedido(p):
+    """Guarda un pedido del diario si su ID_Pedido_Cliente no está ya en TBL_COMPRA. Devuelve el Folio."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SQL_FOLIO_PEDIDO, (p["id"],))
             row = cur.fetchone()
-            if row: id_fecha = row["ID_Fecha"]
-            else:
-                cur.execute("INSERT INTO TBL_FECHA (Dia, Mes, Anio) VALUES (%s,%s,%s)", (dia, mes, anio))
-                id_fecha = cur.lastrowid
-
-            # ---- Totales
-            suma_cantidades = sum(int(d["cantidad"]) for d in detalles)
-            total_importe   = sum(float(d["precio"]) * int(d["cantidad"]) for d in detalles)
+        if row:
+            conn.rollback()
+            return row["Folio"]   # ya se había aplicado (caída antes de anotarlo)
+        lineas = [dict(l, precio=Decimal(l["precio"]), subtotal=Decimal(l["subtotal"])) for l in p["lineas"]]
+        id_fecha = _id_fecha(conn, date.fromisoformat(p["fecha"]))
+        with conn.cursor() as cur:
+            folio = _insertar_cuenta(cur, id_fecha, p["mesa"], p["modo"], p["hora"], lineas, p["id"])
+        conn.commit()
+        return folio
+
+def _resolver_pedido(p, folio=None, rechazo=None):
+    """Anota en el diario el Folio (o el rechazo) del pedido y lo pasa a _PEDIDOS_RESUELTOS."""
+    marca = {"id": p["id"], "folio": folio} if rechazo is None else {"id": p["id"], "rechazo": rechazo}
+    with _DIARIO_LOCK:
+        _diario_agregar(marca)   # sin fsync propio: si se pierde, reaplicar encuentra el Folio
+        _PEDIDOS.pop(p["id"], None)
+        p.update(estado="aplicado" if rechazo is None else "rechazado", folio=folio, error=rechazo,
+                 resuelto=time.time())
+        _PEDIDOS_RESUELTOS[p["id"]] = p
+        while len(_PEDIDOS_RESUELTOS) > PEDIDOS_RESUELTOS_MAX:
+            _PEDIDOS_RESUELTOS.popitem(last=False)
+        _DIARIO["aplicados" if rechazo is None else "rechazados"] += 1
+
+def _compactar_diario():
+    """Vacía el diario si ya no queda nada pendiente y pasó de PEDIDOS_DIARIO_MAX_BYTES."""
+    if os.fstat(_DIARIO["fd"]).st_size < PEDIDOS_DIARIO_MAX_BYTES:
+        return
+    with _DIARIO_LOCK, _DIARIO_FSYNC_LOCK:
+        if _PEDIDOS:
+            return
+        os.ftruncate(_DIARIO["fd"], 0)
+        os.fsync(_DIARIO["fd"])
+        _DIARIO["sincronizados"] = _DIARIO["escritos"]
+
+def _aplicar_pendientes():
+    """Aplica los pedidos pendientes en orden; se detiene en el primero que no pudo guardar."""
+    with _DIARIO_LOCK:
+        pendientes = list(_PEDIDOS.values())
+    for p in pendientes:
+        try:
+            folio = tx_with_retry(lambda: _aplicar_pedido(p), sitio="diario")
+        except IntegrityError as e:
+            if e.args and e.args[0] == 1062:
+                continue   # otra vía lo guardó en ese instante: la próxima vuelta toma su Folio
+            # Datos que la BD no acepta (p. ej. un producto borrado): no se reintenta
+            app.logger.error("Pedido %s rechazado por la BD: %s", p["id"], e)
+            _resolver_pedido(p, rechazo=str(e))
+            continue
+        except Exception as e:
+            # BD caída o lenta: se reintenta todo en orden en PEDIDOS_REINTENTO_SEG
+            p["error"] = _DIARIO["ultimo_error"] = str(e)
+            app.logger.warning("No se pudo aplicar el pedido %s: %s", p["id"], e)
+            return
+        _resolver_pedido(p, folio=folio)
+        _DIARIO["ultimo_error"] = None
+
+def _bucle_diario():
+    while True:
+        _DIARIO_AVISO.wait(PEDIDOS_REINTENTO_SEG)
+        _DIARIO_AVISO.clear()
+        try:
+            _aplicar_pendientes()
+            _compactar_diario()
+        except Exception:
+            app.logger.exception("Falló el aplicador del diario de pedidos")
 
-            cur.execute("""
-                 INSERT INTO TBL_COMPRA (ID_Fecha, ID_Mesa, Hora, Cantidad_Total, Importe_Total, ID_Modo_Entrega)
-                 VALUES (%s, %s, %s, %s, %s, %s)""", (id_fecha, id_mesa, hora_str, suma_cantidades, total_importe, id_modo_entrega))
-            # ==========================================================
+@app.route("/pedidos/estado")
+@login_requerido
+def pedidos_estado():
+    """Pedidos del diario sin guardar todavía y los rechazados recientes (aviso del listado)."""
+    campos = ("id", "mesa", "hora", "usuario", "error")
+    limite = time.time() - PEDIDOS_RECHAZOS_VISIBLES_SEG
+    with _DIARIO_LOCK:
+        pendientes = [{c: p.get(c) for c in campos} for p in _PEDIDOS.values()]
+        rechazados = [{c: p.get(c) for c in campos} for p in _PEDIDOS_RESUELTOS.values()
+                      if p["estado"] == "rechazado" and p["resuelto"] >= limite]
+    resp = jsonify({"activo": bool(PEDIDOS_DIARIO), "pendientes": pendientes, "rechazados": rechazados})
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# ---------------- Hash de contraseñas (pool de procesos) ----------------
+# generate/check_password_hash son caros a propósito (scrypt/PBKDF2). Se calculan en
+# procesos aparte (no compiten por la CPU/GIL de los hilos de waitress) y con tope: a lo
+# más PASSWORD_CONCURRENCIA hashes en vuelo; el que no consigue lugar en
+# PASSWORD_ESPERA_SEG recibe HashSaturado (503) en vez de ocupar un hilo más. Así una ola
+# de inicios de sesión en el cambio de turno no deja sin hilos a las comandas.
+# PASSWORD_METODO es el 'method' de werkzeug ("scrypt", "pbkdf2:sha256:600000"...). Si un
+# hash guardado no empieza con el prefijo que ese método escribe de verdad (werkzeug completa
+# los parámetros omitidos: "pbkdf2" -> "pbkdf2:sha256:1000000"), se recalcula con el método
+# vigente al iniciar sesión (rehash transparente).
+PASSWORD_METODO = os.getenv("PASSWORD_METODO", "scrypt:32768:8:1")
+PASSWORD_PROCESOS = int(os.getenv("PASSWORD_PROCESOS", max(1, (os.cpu_count() or 2) // 2)))  # 0 = en el hilo
+PASSWORD_CONCURRENCIA = int(os.getenv("PASSWORD_CONCURRENCIA", max(1, WAITRESS_THREADS // 4)))
+PASSWORD_ESPERA_SEG = float(os.getenv("PASSWORD_ESPERA_SEG", "3"))    # espera máx. por un lugar libre
+PASSWORD_CALCULO_SEG = float(os.getenv("PASSWORD_CALCULO_SEG", "10"))  # espera máx. por el resultado
+
+class HashSaturado(Exception):
+    """No hubo lugar en el pool de hash dentro de PASSWORD_ESPERA_SEG (o el cálculo no terminó)."""
+
+_HASH = {"pool": None, "en_curso": 0, "rechazados": 0, "rehash": 0, "prefijo": None}
+_HASH_LOCK = threading.Lock()
+_HASH_LUGARES = threading.BoundedSemaphore(PASSWORD_CONCURRENCIA)
+
+def _pool_hash():
+    if _HASH["pool"] is None:
+        with _HASH_LOCK:
+            if _HASH["pool"] is None:
+                # "spawn": no hereda los hilos ni las conexiones abiertas del servidor
+                _HASH["pool"] = ProcessPoolExecutor(PASSWORD_PROCESOS,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+    return _HASH["pool"]
+
+def _soltar_lugar(_futuro=None):
+    with _HASH_LOCK:
+        _HASH["en_curso"] -= 1
+    _HASH_LUGARES.release()
+
+def _calcular_hash(fn, *args, **kwargs):
+    """Ejecuta fn (función de werkzeug.security) en el pool respetando el tope de concurrencia."""
+    if not _HASH_LUGARES.acquire(timeout=PASSWORD_ESPERA_SEG):
+        with _HASH_LOCK:
+            _HASH["rechazados"] += 1
+        raise HashSaturado()
+    with _HASH_LOCK:
+        _HASH["en_curso"] += 1
+    if not PASSWORD_PROCESOS:
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _soltar_lugar()
+    try:
+        futuro = _pool_hash().submit(fn, *args, **kwargs)
+    except BaseException:
+        _soltar_lugar()
+        raise
+    # El lugar se libera cuando el proceso termina, aunque este hilo deje de esperar
+    futuro.add_done_callback(_soltar_lugar)
+    try:
+        return futuro.result(timeout=PASSWORD_CALCULO_SEG)
+    except FuturoVencido:
+        raise HashSaturado() from None
 
-            folio = cur.lastrowid
+def hash_password(password):
+    return _calcular_hash(generate_password_hash, password, method=PASSWORD_METODO)
 
-            # ---- Detalle
-            for d in detalles:
-                cur.execute("""
-                    INSERT INTO TBL_DETALLE (Folio, ID_Producto, Cantidad, Precio_Unit)
-                    VALUES (%s, %s, %s, %s)
-                """, (folio, d["id_producto"], d["cantidad"], d["precio"]))
+def verificar_password(pw_hash, password):
+    return _calcular_hash(check_password_hash, pw_hash, password)
 
-        conn.commit()
-        flash("Cuenta registrada correctamente.", "success")
-    except Exception as e:
-        conn.rollback()
-        flash(f"Error al registrar la cuenta: {e}", "danger")
-    finally:
-        conn.close()
+def _requiere_rehash(pw_hash):
+    if _HASH["prefijo"] is None:
+        # Prefijo real (lo anterior al primer "$") de un hash de prueba, calculado en el primer
+        # uso y no al importar: los procesos "spawn" del pool vuelven a importar este módulo
+        _HASH["prefijo"] = generate_password_hash("x", method=PASSWORD_METODO).split("$", 1)[0] + "$"
+    return not pw_hash.startswith(_HASH["prefijo"])
 
-    return redirect(url_for("index"))
+MSG_HASH_SATURADO = "Hay muchos inicios de sesión en este momento; intenta de nuevo en unos segundos."
 
 # ---------------- Registro / Login / Logout ----------------
 @app.route("/register", methods=["GET", "POST"])
@@ -587,33 +2809,34 @@ def register():
     if rol not in ("admin", "mesero"):
         rol = "mesero"
 
-    pw_hash = generate_password_hash(pw)
-
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            # INSERT directo (sin SELECT previo) para evitar TOCTTOU
-            cur.execute("""
-                INSERT INTO TBL_USUARIOS
-                    (Nombre_Usuario, Rol_Usuario, Contrasenia_hash, Fecha_Creacion)
-                VALUES (%s, %s, %s, NOW())
-            """, (nombre, rol, pw_hash))
-        conn.commit()
-        flash(f"Usuario «{nombre}» registrado correctamente.", "success")
-        return redirect(url_for("login"))
+        pw_hash = hash_password(pw)
+    except HashSaturado:
+        flash(MSG_HASH_SATURADO, "warning")
+        return render_template("login.html", register_mode=True), 503
 
-    except IntegrityError as e:
-        conn.rollback()
-        # 1062 => Duplicate entry for key (índice UNIQUE lo disparó)
-        if getattr(e, "args", None) and e.args[0] == 1062:
-            flash("Ese nombre de usuario ya está registrado.", "danger")
-            return render_template("login.html", register_mode=True)
-        # Otros errores de BD
-        flash(f"Error al registrar: {e}", "danger")
-        return render_template("login.html", register_mode=True)
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                # INSERT directo (sin SELECT previo) para evitar TOCTTOU
+                cur.execute("""
+                    INSERT INTO TBL_USUARIOS
+                        (Nombre_Usuario, Rol_Usuario, Contrasenia_hash, Fecha_Creacion)
+                    VALUES (%s, %s, %s, NOW())
+                """, (nombre, rol, pw_hash))
+            conn.commit()
+            flash(f"Usuario «{nombre}» registrado correctamente.", "success")
+            return redirect(url_for("login"))
 
-    finally:
-        conn.close()
+        except IntegrityError as e:
+            conn.rollback()
+            # 1062 => Duplicate entry for key (índice UNIQUE lo disparó)
+            if getattr(e, "args", None) and e.args[0] == 1062:
+                flash("Ese nombre de usuario ya está registrado.", "danger")
+                return render_template("login.html", register_mode=True)
+            # Otros errores de BD
+            flash(f"Error al registrar: {e}", "danger")
+            return render_template("login.html", register_mode=True)
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -633,61 +2856,81 @@ def login():
         flash("Debes ingresar usuario y contraseña.", "warning")
         return render_template("login.html", register_mode=False)
 
-    # Conexión a la BD
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT ID_Usuario, Nombre_Usuario, Rol_Usuario, Contrasenia_hash,
-                       Session_Token, Session_Expira, Ultimo_Visto
-                  FROM TBL_USUARIOS
-                 WHERE Nombre_Usuario = %s
-            """, (usuario,))
-            row = cur.fetchone()
+    # Conexión a la BD (se devuelve al pool antes de calcular el hash)
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT ID_Usuario, Nombre_Usuario, Rol_Usuario, Contrasenia_hash,
+                           Session_Token, Session_Expira, Ultimo_Visto
+                      FROM TBL_USUARIOS
+                     WHERE Nombre_Usuario = %s
+                """, (usuario,))
+                row = cur.fetchone()
+            conn.rollback()
+        except OperationalError as e:
+            flash(f"Error de conexión a la BD: {e}", "danger")
+            return render_template("login.html", register_mode=False)
 
-            # Usuario no encontrado
-            if not row:
-                flash("Usuario no encontrado.", "danger")
-                return render_template("login.html", register_mode=False)
-
-            # Verificar contraseña
-            if not check_password_hash(row["Contrasenia_hash"], password):
-                flash("Contraseña incorrecta.", "danger")
-                return render_template("login.html", register_mode=False)
-
-            # --------------------------
-            # Validar sesión activa (bloqueo simultáneo)
-            # --------------------------
-            ahora = datetime.now()
-            expira = row.get("Session_Expira")
-            if row.get("Session_Token") and expira and expira > ahora:
-                flash("Esta cuenta ya está activa en otro dispositivo.", "danger")
-                return render_template("login.html", register_mode=False)
-
-            # --------------------------
-            # Crear nueva sesión única
-            # --------------------------
-            token = secrets.token_hex(16)
-            nueva_exp = ahora + timedelta(minutes=SESSION_TTL_MIN)
-            cur.execute("""
-                UPDATE TBL_USUARIOS
-                   SET Session_Token = %s,
-                       Session_Expira = %s,
-                       Ultimo_Visto   = NOW()
-                 WHERE ID_Usuario = %s
-            """, (token, nueva_exp, row["ID_Usuario"]))
-        conn.commit()
+    # Usuario no encontrado
+    if not row:
+        flash("Usuario no encontrado.", "danger")
+        return render_template("login.html", register_mode=False)
 
-    except OperationalError as e:
-        flash(f"Error de conexión a la BD: {e}", "danger")
+    # Verificar contraseña (y recalcular el hash si cambió PASSWORD_METODO)
+    try:
+        valida = verificar_password(row["Contrasenia_hash"], password)
+        nuevo_hash = hash_password(password) if valida and _requiere_rehash(row["Contrasenia_hash"]) else None
+    except HashSaturado:
+        flash(MSG_HASH_SATURADO, "warning")
+        return render_template("login.html", register_mode=False), 503
+    if not valida:
+        flash("Contraseña incorrecta.", "danger")
         return render_template("login.html", register_mode=False)
 
-    finally:
-        conn.close()
+    # --------------------------
+    # Validar sesión activa (bloqueo simultáneo)
+    # --------------------------
+    ahora = datetime.now()
+    expira = row.get("Session_Expira")
+    if row.get("Session_Token") and expira and expira > ahora:
+        flash("Esta cuenta ya está activa en otro dispositivo.", "danger")
+        return render_template("login.html", register_mode=False)
+
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                # --------------------------
+                # Crear nueva sesión única
+                # --------------------------
+                token = secrets.token_hex(16)
+                nueva_exp = ahora + timedelta(minutes=SESSION_TTL_MIN)
+                cur.execute("""
+                    UPDATE TBL_USUARIOS
+                       SET Session_Token = %s,
+                           Session_Expira = %s,
+                           Ultimo_Visto   = NOW()
+                     WHERE ID_Usuario = %s
+                """, (token, nueva_exp, row["ID_Usuario"]))
+                if nuevo_hash:
+                    # Solo si nadie la cambió mientras tanto (p. ej. un reset del admin)
+                    cur.execute(
+                        "UPDATE TBL_USUARIOS SET Contrasenia_hash=%s WHERE ID_Usuario=%s AND Contrasenia_hash=%s",
+                        (nuevo_hash, row["ID_Usuario"], row["Contrasenia_hash"]),
+                    )
+            conn.commit()
+
+        except OperationalError as e:
+            flash(f"Error de conexión a la BD: {e}", "danger")
+            return render_template("login.html", register_mode=False)
+    if nuevo_hash:
+        with _HASH_LOCK:
+            _HASH["rehash"] += 1
 
     # --------------------------
     # Crear sesión Flask
     # --------------------------
+    _olvidar_sesion(row["Nombre_Usuario"])  # la caché se rellena con el token nuevo
     session.clear()
     session["usuario"] = row["Nombre_Usuario"]
     session["rol"] = row["Rol_Usuario"]
@@ -704,8 +2947,7 @@ def logout():
     token = session.get("sess_token")
 
     if user and token:
-        conn = get_db_connection()
-        try:
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT ID_Usuario, Session_Token FROM TBL_USUARIOS WHERE Nombre_Usuario=%s", (user,))
                 row = cur.fetchone()
@@ -718,8 +2960,7 @@ def logout():
                          WHERE ID_Usuario   = %s
                     """, (row["ID_Usuario"],))
             conn.commit()
-        finally:
-            conn.close()
+        _olvidar_sesion(user)
 
     session.clear()
     flash("Sesión cerrada.", "success")
@@ -734,8 +2975,7 @@ def usuarios_list():
     Lista usuarios desde TBL_USUARIOS para permitir su eliminación por el admin.
     NOTA: las contraseñas se almacenan como hash (no descifrables).
     """
-    conn = get_db_connection()
-    try:
+    with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("""
                 SELECT ID_Usuario, Nombre_Usuario, Rol_Usuario, Contrasenia_hash, Fecha_Creacion
@@ -743,8 +2983,6 @@ def usuarios_list():
                  ORDER BY ID_Usuario
             """)
             usuarios = cur.fetchall()
-    finally:
-        conn.close()
 
     return render_template(
         "ElimUs.html",
@@ -770,28 +3008,30 @@ def usuario_reset_password(id_usuario):
         flash("Las contraseñas no coinciden.", "warning")
         return redirect(url_for("usuarios_list"))
 
-    pw_hash = generate_password_hash(new_pw)
-
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT Nombre_Usuario FROM TBL_USUARIOS WHERE ID_Usuario=%s", (id_usuario,))
-            row = cur.fetchone()
-            if not row:
-                flash("Usuario no encontrado.", "warning")
-                return redirect(url_for("usuarios_list"))
+        pw_hash = hash_password(new_pw)
+    except HashSaturado:
+        flash(MSG_HASH_SATURADO, "warning")
+        return redirect(url_for("usuarios_list"))
 
-            cur.execute(
-                "UPDATE TBL_USUARIOS SET Contrasenia_hash=%s WHERE ID_Usuario=%s",
-                (pw_hash, id_usuario),
-            )
-        conn.commit()
-        flash(f"Contraseña restablecida para «{row['Nombre_Usuario']}».", "success")
-    except Exception as e:
-        conn.rollback()
-        flash(f"Error al restablecer: {e}", "danger")
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT Nombre_Usuario FROM TBL_USUARIOS WHERE ID_Usuario=%s", (id_usuario,))
+                row = cur.fetchone()
+                if not row:
+                    flash("Usuario no encontrado.", "warning")
+                    return redirect(url_for("usuarios_list"))
+
+                cur.execute(
+                    "UPDATE TBL_USUARIOS SET Contrasenia_hash=%s WHERE ID_Usuario=%s",
+                    (pw_hash, id_usuario),
+                )
+            conn.commit()
+            flash(f"Contraseña restablecida para «{row['Nombre_Usuario']}».", "success")
+        except Exception as e:
+            conn.rollback()
+            flash(f"Error al restablecer: {e}", "danger")
 
     return redirect(url_for("usuarios_list"))
 
@@ -803,35 +3043,526 @@ def usuario_delete(id_usuario):
     Evita borrar al propio admin logueado para no dejar el sistema sin usuarios.
     """
     # Evitar que el admin actual se borre a sí mismo
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT Nombre_Usuario, Rol_Usuario FROM TBL_USUARIOS WHERE ID_Usuario=%s", (id_usuario,))
-            row = cur.fetchone()
-            if not row:
-                flash("Usuario no encontrado.", "warning")
-                return redirect(url_for("usuarios_list"))
+    with get_db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT Nombre_Usuario, Rol_Usuario FROM TBL_USUARIOS WHERE ID_Usuario=%s", (id_usuario,))
+                row = cur.fetchone()
+                if not row:
+                    flash("Usuario no encontrado.", "warning")
+                    return redirect(url_for("usuarios_list"))
 
-            if row["Nombre_Usuario"] == session.get("usuario"):
-                flash("No puedes eliminar tu propio usuario en esta vista.", "warning")
-                return redirect(url_for("usuarios_list"))
+                if row["Nombre_Usuario"] == session.get("usuario"):
+                    flash("No puedes eliminar tu propio usuario en esta vista.", "warning")
+                    return redirect(url_for("usuarios_list"))
 
-            # Si hay tablas que referencian usuarios, deberías manejar FK/ON DELETE RESTRICT/SET NULL.
-            cur.execute("DELETE FROM TBL_USUARIOS WHERE ID_Usuario=%s", (id_usuario,))
-        conn.commit()
-        flash(f"Usuario «{row['Nombre_Usuario']}» eliminado.", "success")
-    except Exception as e:
-        conn.rollback()
-        flash(f"Error al eliminar: {e}", "danger")
-    finally:
-        conn.close()
+                # Si hay tablas que referencian usuarios, deberías manejar FK/ON DELETE RESTRICT/SET NULL.
+                cur.execute("DELETE FROM TBL_USUARIOS WHERE ID_Usuario=%s", (id_usuario,))
+            conn.commit()
+            _olvidar_sesion(row["Nombre_Usuario"])
+            flash(f"Usuario «{row['Nombre_Usuario']}» eliminado.", "success")
+        except Exception as e:
+            conn.rollback()
+            flash(f"Error al eliminar: {e}", "danger")
 
     return redirect(url_for("usuarios_list"))
 
 
+# ---------------- Tablero en vivo (Server-Sent Events) ----------------
+# Cada alta/edición/baja de una cuenta inserta una fila en TBL_EVENTOS dentro de su
+# propia transacción (migraciones/003_eventos.sql), así que el evento existe si y solo si
+# el cambio se confirmó, venga de este proceso o de otro. Un solo hilo por proceso lee
+# los eventos nuevos (ID_Evento > último), les pega la fila actual del listado con UNA
+# consulta por lote y los reparte a los clientes de /eventos desde memoria: el costo en
+# BD no crece con el número de pantallas abiertas.
+# El hilo consulta cada EVENTOS_POLL_SEG, o de inmediato cuando una petición de este
+# proceso acaba de escribir un evento.
+# Ojo: cada cliente SSE ocupa un hilo de waitress mientras está conectado; por eso hay
+# tope de clientes y cada flujo se corta a los EVENTOS_DURACION_SEG (EventSource se
+# reconecta solo y sigue desde Last-Event-ID).
+# Pantallas: con lo de fábrica (WAITRESS_THREADS=8) caben 4 con /eventos y los otros 4
+# hilos quedan para /add, /update y los logins. A partir de la quinta, /eventos responde
+# 503 y index.html pasa a sondear /ventas?filas=1 cada 5 s (304 si nada cambió; no retiene
+# ningún hilo entre sondeos): se sigue viendo al día, con unos segundos de retraso.
+# Para más pantallas en vivo: subir WAITRESS_THREADS (el tope es la mitad) o servir con
+# SERVIDOR=asgi, donde un cliente SSE es una corrutina (EVENTOS_MAX_CLIENTES_ASGI).
+EVENTOS_POLL_SEG = float(os.getenv("EVENTOS_POLL_SEG", "1"))
+EVENTOS_LOTE = 500                     # eventos leídos por consulta
+EVENTOS_BUFFER = 2000                  # eventos recientes en memoria para los clientes
+EVENTOS_HUECO_SEG = 5                  # espera máx. por un ID_Evento aún sin confirmar
+EVENTOS_LATIDO_SEG = 15                # comentario keep-alive (y detección de desconexión)
+EVENTOS_DURACION_SEG = int(os.getenv("EVENTOS_DURACION_SEG", "300"))
+EVENTOS_MAX_CLIENTES = int(os.getenv("EVENTOS_MAX_CLIENTES", max(1, WAITRESS_THREADS // 2)))
+EVENTOS_RETENCION_SEG = int(os.getenv("EVENTOS_RETENCION_SEG", "3600"))
+
+_EVENTOS = {
+    "base": None,        # ID_Evento desde el que arrancó el hilo (antes de eso no hay buffer)
+    "ultimo": 0,         # último ID_Evento repartido
+    "descartado": 0,     # último ID_Evento que ya salió del buffer
+    "buffer": deque(maxlen=EVENTOS_BUFFER),
+    "hueco": None,       # (ID_Evento esperado, desde cuándo falta)
+    "clientes": 0,
+    "hilo": None,
+}
+_EVENTOS_COND = threading.Condition()
+_EVENTOS_DESPERTAR = threading.Event()
+_EVENTOS_OYENTES = []   # funciones sin argumentos a llamar tras repartir un lote (app_async.py)
+
+SQL_EVENTO = "INSERT INTO TBL_EVENTOS (Tipo, Folio) VALUES (%s, %s)"
+SQL_ULTIMO_EVENTO = "SELECT COALESCE(MAX(ID_Evento), 0) AS ultimo FROM TBL_EVENTOS"
+SQL_EVENTOS_DESDE = "SELECT ID_Evento FROM TBL_EVENTOS WHERE ID_Evento > %s ORDER BY ID_Evento LIMIT %s"
+
+def _emitir_evento(cur, tipo, folio):
+    """Registra 'creada' / 'editada' / 'eliminada' de un folio (dentro de la transacción del cambio)."""
+    cur.execute(SQL_EVENTO, (tipo, folio))
+    if has_request_context():
+        g.evento_emitido = True
+
+@app.after_request
+def _avisar_eventos(resp):
+    # La transacción ya se confirmó (o se deshizo): el hilo lee sin esperar al siguiente ciclo
+    if g.get("evento_emitido"):
+        _EVENTOS_DESPERTAR.set()
+    return resp
+
+def _ultimo_evento(cur):
+    cur.execute(SQL_ULTIMO_EVENTO)
+    return cur.fetchone()["ultimo"]
+
+def _evento_contiguo(desde, ids):
+    """
+    Último ID de 'ids' (ordenados, > desde) sin huecos antes de él. Un hueco es un ID_Evento
+    repartido cuya transacción aún no confirma: se salta solo si el hilo lector ya lo dio
+    por perdido (EVENTOS_HUECO_SEG), igual que en _leer_eventos.
+    """
+    ultimo = desde
+    for id_evento in ids:
+        if id_evento != ultimo + 1:
+            hueco = _EVENTOS["hueco"]
+            if hueco is None or hueco[0] != ultimo + 1 or time.monotonic() - hueco[1] < EVENTOS_HUECO_SEG:
+                break
+        ultimo = id_evento
+    return ultimo
+
+def _version_eventos(cur):
+    """
+    Versión del listado para las ETag: el último ID_Evento con todos los anteriores ya
+    confirmados. MAX(ID_Evento) no sirve: el AUTO_INCREMENT se reparte en el INSERT y no en
+    el COMMIT, así que un ID menor puede confirmarse después y la ETag no cambiaría. Parte
+    del último que repartió el hilo lector (contiguo) y sigue por lo confirmado después.
+    Requiere el hilo lector en marcha (_iniciar_eventos).
+    """
+    desde = _EVENTOS["ultimo"]
+    cur.execute(SQL_EVENTOS_DESDE, (desde, EVENTOS_LOTE))
+    return _evento_contiguo(desde, [r["ID_Evento"] for r in cur.fetchall()])
+
+def _leer_eventos(cur, ultimo):
+    """
+    Eventos con ID_Evento > ultimo, contiguos: si falta un ID (transacción que lo tomó
+    pero aún no confirma) se detiene ahí y lo espera hasta EVENTOS_HUECO_SEG; pasado
+    ese tiempo se da por perdido (rollback) y sigue.
+    """
+    cur.execute(
+        "SELECT ID_Evento, Tipo, Folio FROM TBL_EVENTOS WHERE ID_Evento > %s ORDER BY ID_Evento LIMIT %s",
+        (ultimo, EVENTOS_LOTE),
+    )
+    eventos, esperado = [], ultimo + 1
+    for e in cur.fetchall():
+        if e["ID_Evento"] != esperado:
+            hueco = _EVENTOS["hueco"]
+            if hueco is None or hueco[0] != esperado:
+                _EVENTOS["hueco"] = hueco = (esperado, time.monotonic())
+            if time.monotonic() - hueco[1] < EVENTOS_HUECO_SEG:
+                break
+        eventos.append(e)
+        esperado = e["ID_Evento"] + 1
+    if not eventos:
+        return []
+
+    # Fila actual del listado de cada folio vivo (una sola consulta para todo el lote)
+    folios = sorted({e["Folio"] for e in eventos if e["Tipo"] != "eliminada"})
+    ventas = {}
+    if folios:
+        filas, _ = _consultar_ventas(cur, {"folios": folios, "antes": None, "por_pagina": len(folios)})
+        ventas = {v["Folio"]: v for v in filas}
+    return [
+        {"id": e["ID_Evento"], "tipo": e["Tipo"], "folio": e["Folio"],
+         "venta": None if e["Tipo"] == "eliminada" else ventas.get(e["Folio"])}
+        for e in eventos
+    ]
+
+def _bucle_eventos():
+    while True:
+        _EVENTOS_DESPERTAR.wait(EVENTOS_POLL_SEG)
+        _EVENTOS_DESPERTAR.clear()
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    eventos = _leer_eventos(cur, _EVENTOS["ultimo"])
+                conn.rollback()
+        except Exception:
+            app.logger.exception("No se pudieron leer los eventos del tablero")
+            time.sleep(EVENTOS_POLL_SEG)
+            continue
+        if not eventos:
+            continue
+        with _EVENTOS_COND:
+            buf = _EVENTOS["buffer"]
+            for e in eventos:
+                if len(buf) == buf.maxlen:
+                    _EVENTOS["descartado"] = buf[0]["id"]
+                buf.append(e)
+            _EVENTOS["ultimo"] = eventos[-1]["id"]
+            _EVENTOS["hueco"] = None
+            _EVENTOS_COND.notify_all()
+        for oyente in _EVENTOS_OYENTES:
+            oyente()
+
+def _iniciar_eventos():
+    """Arranca el hilo lector la primera vez que se conecta un cliente."""
+    with _EVENTOS_COND:
+        if _EVENTOS["hilo"] is not None:
+            return
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                _EVENTOS["base"] = _EVENTOS["ultimo"] = _EVENTOS["descartado"] = _ultimo_evento(cur)
+            conn.rollback()
+        _EVENTOS["hilo"] = threading.Thread(target=_bucle_eventos, name="eventos", daemon=True)
+        _EVENTOS["hilo"].start()
+
+def _soltar_cliente():
+    with _EVENTOS_COND:
+        _EVENTOS["clientes"] -= 1
+
+def _fila_evento(e, rol):
+    """data: de un evento SSE: folio, fila del listado (para los filtros) y su HTML para 'rol'."""
+    html = _fila_html(e["venta"], rol) if e["venta"] else None
+    return json.dumps({"folio": e["folio"], "venta": e["venta"], "html": html}, default=str)
+
+def _flujo_eventos(desde, rol):
+    """
+    Texto SSE: eventos posteriores a 'desde', latidos, y fin a los EVENTOS_DURACION_SEG.
+    La fila va renderizada para el rol del cliente (la primera pantalla la pone en caché).
+    """
+    yield "retry: 2000\n\n"
+    ultimo, fin = desde, time.monotonic() + EVENTOS_DURACION_SEG
+    while time.monotonic() < fin:
+        with _EVENTOS_COND:
+            if ultimo < _EVENTOS["descartado"]:
+                # El cliente se quedó atrás más que el buffer (o es de antes de que arrancara el
+                # hilo): que recargue el listado completo
+                yield f"id: {_EVENTOS['ultimo']}\nevent: recargar\ndata: {{}}\n\n"
+                return
+            _EVENTOS_COND.wait_for(lambda: _EVENTOS["ultimo"] > ultimo, timeout=EVENTOS_LATIDO_SEG)
+            nuevos = [e for e in _EVENTOS["buffer"] if e["id"] > ultimo]
+        if not nuevos:
+            yield ": latido\n\n"
+            continue
+        for e in nuevos:
+            yield f"id: {e['id']}\nevent: {e['tipo']}\ndata: {_fila_evento(e, rol)}\n\n"
+        ultimo = nuevos[-1]["id"]
+
+@app.route("/eventos")
+@login_requerido
+def eventos():
+    """
+    Flujo Server-Sent Events de cambios en las cuentas para el listado de index.html:
+      event: creada | editada | eliminada   data: {"folio", "venta": fila del listado | null,
+                                                  "html": la fila renderizada | null}
+      event: recargar                        (se perdieron eventos: volver a pedir la página)
+    Empieza después de Last-Event-ID (reconexión) o de ?desde=<ID_Evento> (el que trae la página).
+    """
+    desde = request.headers.get("Last-Event-ID", type=int)
+    if desde is None:
+        desde = request.args.get("desde", type=int)
+
+    _iniciar_eventos()
+    with _EVENTOS_COND:
+        if _EVENTOS["clientes"] >= EVENTOS_MAX_CLIENTES:
+            return Response("Demasiados clientes del tablero en vivo\n", status=503,
+                            headers={"Retry-After": "30"}, mimetype="text/plain")
+        _EVENTOS["clientes"] += 1
+        if desde is None:
+            desde = _EVENTOS["ultimo"]
+
+    # Con el contexto de la petición: las filas se renderizan dentro del flujo (url_for)
+    resp = Response(
+        stream_with_context(_flujo_eventos(desde, session.get("rol"))),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    resp.call_on_close(_soltar_cliente)
+    return resp
+
+def purgar_eventos():
+    """
+    Borra por lotes los eventos más viejos que EVENTOS_RETENCION_SEG (ya nadie los necesita).
+    Conserva siempre el último: sin él, MAX(ID_Evento) y con él el AUTO_INCREMENT podrían
+    volver a un valor anterior tras un reinicio.
+    """
+    limite = datetime.now() - timedelta(seconds=EVENTOS_RETENCION_SEG)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            ultimo = _ultimo_evento(cur)
+            while True:
+                cur.execute(
+                    "DELETE FROM TBL_EVENTOS WHERE Creado < %s AND ID_Evento < %s ORDER BY ID_Evento LIMIT 1000",
+                    (limite, ultimo),
+                )
+                conn.commit()
+                if cur.rowcount < 1000:
+                    break
+
+# ---------------- Métricas (formato Prometheus) ----------------
+# Cada hilo de waitress acumula en su propio objeto (_MetricasHilo): en el camino caliente
+# no hay locks, solo sumas sobre datos del propio hilo. /admin/metricas suma los objetos
+# de todos los hilos al momento de leer.
+METRICAS_CUBETAS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN", "")   # opcional: "Authorization: Bearer <token>" para el scraper
+
+class _MetricasHilo:
+    """Contadores de UN hilo: solo ese hilo escribe; la lectura del scrape copia."""
+
+    def __init__(self):
+        self.en_curso = 0
+        # (método, ruta, status) -> [peticiones, segundos, sentencias, seg_bd, cubeta_0, ..., cubeta_+Inf]
+        self.rutas = {}
+
+_METRICAS_LOCAL = threading.local()
+_METRICAS_HILOS = []   # los hilos de waitress son fijos, así que la lista no crece
+_METRICAS_LOCK = threading.Lock()
+_SERVIDOR = None       # servidor waitress (lo fija __main__) para leer su cola de tareas
+
+def _metricas_hilo():
+    m = getattr(_METRICAS_LOCAL, "m", None)
+    if m is None:
+        m = _METRICAS_LOCAL.m = _MetricasHilo()
+        with _METRICAS_LOCK:
+            _METRICAS_HILOS.append(m)
+    return m
+
+@app.before_request
+def _metricas_inicio():
+    _metricas_hilo().en_curso += 1
+    g.metricas_inicio = time.perf_counter()
+
+@app.after_request
+def _metricas_observar(resp):
+    inicio = g.get("metricas_inicio")
+    if inicio is None:
+        return resp
+    dur = time.perf_counter() - inicio
+    ruta = request.url_rule.rule if request.url_rule else "(sin ruta)"
+    clave = (request.method, ruta, resp.status_code)
+    rutas = _metricas_hilo().rutas
+    fila = rutas.get(clave)
+    if fila is None:
+        fila = rutas[clave] = [0, 0.0, 0, 0.0] + [0] * (len(METRICAS_CUBETAS) + 1)
+    fila[0] += 1
+    fila[1] += dur
+    db = g.get("db_medicion")
+    if db is not None:
+        fila[2] += db["sentencias"]
+        fila[3] += db["db_seg"]
+    fila[4 + bisect_left(METRICAS_CUBETAS, dur)] += 1
+    return resp
+
+@app.teardown_request
+def _metricas_fin(exc):
+    if g.pop("metricas_inicio", None) is not None:
+        _metricas_hilo().en_curso -= 1
+
+def _etiquetas(**kw):
+    return ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in kw.items()
+    )
+
+def _texto_metricas():
+    """Todas las métricas en formato de exposición de texto de Prometheus."""
+    with _METRICAS_LOCK:
+        hilos = list(_METRICAS_HILOS)
+    por_status, por_ruta, en_curso = {}, {}, 0
+    for h in hilos:
+        en_curso += h.en_curso
+        for clave, fila in h.rutas.copy().items():
+            fila = list(fila)
+            por_status[clave] = por_status.get(clave, 0) + fila[0]
+            acum = por_ruta.setdefault(clave[:2], [0] * len(fila))
+            for i, v in enumerate(fila):
+                acum[i] += v
+
+    out = []
+    def metrica(nombre, tipo, ayuda, muestras):
+        out.append(f"# HELP {nombre} {ayuda}")
+        out.append(f"# TYPE {nombre} {tipo}")
+        for etiquetas, valor in muestras:
+            out.append(f"{nombre}{{{etiquetas}}} {valor}" if etiquetas else f"{nombre} {valor}")
+
+    metrica("smorgas_http_peticiones_total", "counter", "Peticiones atendidas por ruta y status.",
+            [(_etiquetas(metodo=m, ruta=r, status=st), n) for (m, r, st), n in sorted(por_status.items())])
+
+    out.append("# HELP smorgas_http_duracion_segundos Latencia de las peticiones por ruta.")
+    out.append("# TYPE smorgas_http_duracion_segundos histogram")
+    for (m, r), fila in sorted(por_ruta.items()):
+        acumulado = 0
+        for le, n in zip(METRICAS_CUBETAS + ("+Inf",), fila[4:]):
+            acumulado += n
+            out.append(f'smorgas_http_duracion_segundos_bucket{{{_etiquetas(metodo=m, ruta=r, le=le)}}} {acumulado}')
+        out.append(f"smorgas_http_duracion_segundos_sum{{{_etiquetas(metodo=m, ruta=r)}}} {fila[1]:.6f}")
+        out.append(f"smorgas_http_duracion_segundos_count{{{_etiquetas(metodo=m, ruta=r)}}} {fila[0]}")
+
+    metrica("smorgas_db_sentencias_total", "counter", "Sentencias SQL ejecutadas por ruta.",
+            [(_etiquetas(metodo=m, ruta=r), f[2]) for (m, r), f in sorted(por_ruta.items())])
+    metrica("smorgas_db_segundos_total", "counter", "Tiempo en la BD por ruta.",
+            [(_etiquetas(metodo=m, ruta=r), f"{f[3]:.6f}") for (m, r), f in sorted(por_ruta.items())])
+    metrica("smorgas_http_en_curso", "gauge", "Peticiones atendiéndose ahora.", [("", en_curso)])
+
+    metrica("smorgas_waitress_hilos", "gauge", "Hilos de trabajo de waitress.", [("", WAITRESS_THREADS)])
+    disp = getattr(_SERVIDOR, "task_dispatcher", None)
+    if disp is not None:
+        metrica("smorgas_waitress_hilos_ocupados", "gauge", "Hilos de waitress atendiendo una tarea.",
+                [("", disp.active_count)])
+        metrica("smorgas_waitress_cola", "gauge", "Tareas esperando un hilo libre de waitress.",
+                [("", len(disp.queue))])
+
+    metrica("smorgas_eventos_clientes", "gauge", "Clientes conectados a /eventos (cada uno ocupa un hilo).",
+            [("", _EVENTOS["clientes"])])
+    metrica("smorgas_eventos_ultimo", "gauge", "Último ID_Evento repartido por este proceso.",
+            [("", _EVENTOS["ultimo"])])
+
+    metrica("smorgas_hash_en_curso", "gauge", "Hashes de contraseña calculándose o en cola del pool.",
+            [("", _HASH["en_curso"])])
+    metrica("smorgas_hash_rechazados_total", "counter", "Hashes rechazados por falta de lugar (503).",
+            [("", _HASH["rechazados"])])
+    metrica("smorgas_hash_recalculados_total", "counter", "Hashes recalculados al iniciar sesión (rehash).",
+            [("", _HASH["rehash"])])
+
+    metrica("smorgas_pedidos_pendientes", "gauge", "Pedidos del diario sin guardar en la BD.",
+            [("", len(_PEDIDOS))])
+    metrica("smorgas_pedidos_aplicados_total", "counter", "Pedidos del diario guardados en la BD.",
+            [("", _DIARIO["aplicados"])])
+    metrica("smorgas_pedidos_rechazados_total", "counter", "Pedidos del diario que la BD rechazó.",
+            [("", _DIARIO["rechazados"])])
+    metrica("smorgas_diario_escrituras_total", "counter", "Líneas escritas al diario de pedidos.",
+            [("", _DIARIO["escritos"])])
+    metrica("smorgas_diario_fsync_total", "counter", "fsync del diario (uno cubre varias escrituras).",
+            [("", _DIARIO["fsyncs"])])
+
+    metrica("smorgas_grupo_lotes_total", "counter", "Lotes confirmados por el escritor en grupo.",
+            [("", _GRUPO["lotes"])])
+    metrica("smorgas_grupo_cuentas_total", "counter", "Cuentas guardadas dentro de un lote.",
+            [("", _GRUPO["cuentas"])])
+    metrica("smorgas_grupo_separadas_total", "counter", "Cuentas guardadas una por una tras fallar su lote.",
+            [("", _GRUPO["separadas"])])
+    metrica("smorgas_grupo_cola", "gauge", "Cuentas esperando al escritor en grupo.",
+            [("", _GRUPO_COLA.qsize())])
+
+    metrica("smorgas_filas_cache_aciertos_total", "counter", "Filas del listado servidas desde la caché.",
+            [("", _FILAS_CACHE["aciertos"])])
+    metrica("smorgas_filas_cache_fallos_total", "counter", "Filas del listado renderizadas (no estaban o cambiaron).",
+            [("", _FILAS_CACHE["fallos"])])
+    metrica("smorgas_filas_cache_expulsadas_total", "counter", "Filas expulsadas de la caché por FILAS_CACHE_MAX_BYTES.",
+            [("", _FILAS_CACHE["expulsadas"])])
+    metrica("smorgas_filas_cache_bytes", "gauge", "Memoria ocupada por la caché de filas.",
+            [("", _FILAS_CACHE["bytes"])])
+    metrica("smorgas_filas_cache_entradas", "gauge", "Filas en la caché del listado.",
+            [("", len(_FILAS))])
+
+    metrica("smorgas_archivo_cuentas_total", "counter", "Cuentas movidas al archivo (TBL_COMPRA_HIST).",
+            [("", _ARCHIVO["cuentas"])])
+    metrica("smorgas_sesiones_limpiadas_total", "counter", "Sesiones vencidas limpiadas por el barrido.",
+            [("", _BARRIDO_SESIONES["limpiadas"])])
+    metrica("smorgas_sesiones_cache", "gauge", "Sesiones en la caché de login_requerido.",
+            [("", len(_SESIONES))])
+
+    pools = [(usuario, pool.estadisticas()) for (usuario, _), pool in list(_POOLS.items())]
+    metrica("smorgas_db_conexiones", "gauge", "Conexiones del pool por usuario de BD y estado.",
+            [(_etiquetas(usuario=u, estado="abiertas"), st["abiertas"]) for u, st in pools]
+            + [(_etiquetas(usuario=u, estado="libres"), st["libres"]) for u, st in pools])
+    metrica("smorgas_db_conexiones_maximo", "gauge", "Tope de conexiones del pool por usuario de BD.",
+            [(_etiquetas(usuario=u), st["maximo"]) for u, st in pools])
+    metrica("smorgas_db_conexiones_creadas_total", "counter", "Conexiones físicas abiertas desde el arranque.",
+            [(_etiquetas(usuario=u), st["creadas"]) for u, st in pools])
+
+    reintentos = sorted(estadisticas_reintentos().items())
+    for campo in ("llamadas", "intentos", "deadlocks", "lock_timeouts", "fallos", "conflictos"):
+        metrica(f"smorgas_tx_{campo}_total", "counter", f"tx_with_retry: {campo} por sitio.",
+                [(_etiquetas(sitio=s), st[campo]) for s, st in reintentos])
+    metrica("smorgas_tx_espera_segundos_total", "counter", "tx_with_retry: tiempo de backoff por sitio.",
+            [(_etiquetas(sitio=s), f'{st["espera_seg"]:.6f}') for s, st in reintentos])
+    return "\n".join(out) + "\n"
+
+@admin_requerido
+def _metricas_admin():
+    return Response(_texto_metricas(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/admin/metricas")
+def metricas():
+    """Métricas para Prometheus: sesión de admin o, si se configuró METRICAS_TOKEN, token Bearer."""
+    auth = request.headers.get("Authorization", "").encode()
+    if METRICAS_TOKEN and secrets.compare_digest(auth, f"Bearer {METRICAS_TOKEN}".encode()):
+        return Response(_texto_metricas(), mimetype="text/plain; version=0.0.4")
+    return _metricas_admin()
+
+
+# ---------------- Tareas de fondo ----------------
+_TAREAS = []   # (nombre, intervalo_seg, función)
+
+def tarea_periodica(nombre, intervalo_seg):
+    """Registra una función para ejecutarse cada 'intervalo_seg' en un hilo de fondo."""
+    def deco(fn):
+        _TAREAS.append((nombre, intervalo_seg, fn))
+        return fn
+    return deco
+
+def _bucle_tarea(nombre, intervalo_seg, fn):
+    while True:
+        time.sleep(intervalo_seg)
+        try:
+            fn()
+        except Exception:
+            app.logger.exception("Falló la tarea de fondo %s", nombre)
+
+def iniciar_tareas_fondo():
+    """
+    Arranca un hilo daemon por cada tarea registrada (llamar una vez, al iniciar el servidor)
+    y, con PEDIDOS_DIARIO, el aplicador del diario para recuperar lo que quedó pendiente.
+    """
+    for nombre, intervalo_seg, fn in _TAREAS:
+        threading.Thread(target=_bucle_tarea, args=(nombre, intervalo_seg, fn),
+                         name=f"tarea-{nombre}", daemon=True).start()
+    if PEDIDOS_DIARIO:
+        iniciar_diario()
+
+tarea_periodica("conciliacion", CONCILIACION_SEG)(conciliar_totales)
+tarea_periodica("eventos_purga", 600)(purgar_eventos)
+tarea_periodica("sesiones_barrido", SESIONES_BARRIDO_SEG)(barrer_sesiones)
+if ARCHIVO_SEG > 0:
+    tarea_periodica("archivo_ventas", ARCHIVO_SEG)(archivar_ventas)
+
+
 # ---------------- Run ----------------
-if __name__ == "__main__":
-    serve(app, host="10.236.165.73", port=5000, threads=8) #La IP es del internet de MAUI
+# SERVIDOR=waitress (por defecto, WSGI con hilos) o SERVIDOR=asgi (asyncio: app_async.py)
+SERVIDOR = os.getenv("SERVIDOR", "waitress")
+
+if __name__ == "__main__" and SERVIDOR == "asgi":
+    # app_async hace "import app": que reciba este mismo módulo y no una segunda copia
+    sys.modules.setdefault("app", sys.modules[__name__])
+    try:
+        import app_async
+    except ImportError as e:
+        sys.exit(str(e))
+    iniciar_tareas_fondo()
+    logging.basicConfig()
+    app_async.servir(host="10.236.165.73", port=5000)
+elif __name__ == "__main__":
+    iniciar_tareas_fondo()
+    # create_server en lugar de serve() para conservar el servidor: /admin/metricas lee su cola
+    logging.basicConfig()
+    _SERVIDOR = create_server(app, host="10.236.165.73", port=5000, threads=WAITRESS_THREADS) #La IP es del internet de MAUI
+    _SERVIDOR.print_listen("Serving on http://{}:{}")
+    _SERVIDOR.run()
     #app.run(host="192.168.0.87", port=5000, debug=True, threaded=True)  # Para desarrollo en casa
 
 
@@ -0,0 +1,650 @@
+# =============================
+# Smörgås Kaffet - Modo de servicio asyncio (ASGI)
+# Las mismas rutas y plantillas de app.py servidas desde un solo hilo de asyncio:
+# Quart + aiomysql (pool de conexiones no bloqueante) sobre Hypercorn.
+# Se elige al arrancar con SERVIDOR=asgi (ver el bloque Run de app.py) para medirlo
+# lado a lado con waitress (herramientas/prueba_carga.py --servidor asgi).
+# =============================
+"""
+Modo ASGI de la aplicación.
+
+Rutas nativas en asyncio (las calientes del listado y la edición):
+  /  /ventas  /venta/<folio>/detalles  /eventos
+  /update/<folio>  /delete/<folio>  /detalle/update/<id>   (solo en modo pesimista)
+Todo lo demás (login, alta de cuentas, administración, exportación...) lo atiende la
+app Flask de app.py tal cual, en un ThreadPoolExecutor de WAITRESS_THREADS hilos a
+través del adaptador WSGI de Hypercorn. Así las rutas frías y las configuraciones sin
+versión async (CONCURRENCIA_*=optimista, DETALLE_MODO_TOTALES=recalculo) siguen
+teniendo una sola implementación.
+
+Las transacciones de update / delete / detalle_update conservan el bloqueo pesimista
+de app.py: las mismas sentencias (las constantes SQL_* de app.py), con los SELECT ... FOR
+UPDATE en el mismo orden (cabecera -> detalle), los mismos reintentos ante 1213/1205
+(contados en los mismos sitios de /admin/reintentos), y los mismos resúmenes y eventos. La diferencia es que esperar un
+lock o una respuesta de la BD ya no ocupa un hilo: solo suspende la corrutina.
+
+La sesión es la misma cookie firmada (mismo secret_key) y la misma caché _SESIONES, así
+que una sesión abierta en un modo vale en el otro.
+
+Las rutas nativas no pasan por la instrumentación de app.py (Server-Timing, métricas por
+hilo). Para comparar los dos modos se mide desde el cliente, con la prueba de carga.
+
+Dependencias extra (quart, aiomysql, hypercorn): pip install -r requirements-asgi.txt
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from functools import partial, wraps
+
+from markupsafe import Markup
+from pymysql.err import InterfaceError, OperationalError
+try:
+    import aiomysql
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    from hypercorn.middleware import AsyncioWSGIMiddleware
+    from quart import (
+        Quart, render_template, request, redirect, url_for,
+        session, flash, jsonify, Response, stream_with_context
+    )
+except ImportError as e:
+    raise ImportError(f"El modo ASGI necesita quart, aiomysql e hypercorn y falta {e.name}: "
+                      "pip install -r requirements-asgi.txt") from e
+from werkzeug.exceptions import HTTPException
+
+import app as smorgas
+from app import (
+    CENTAVO, ConflictoVersion,
+    _delta_resumen, _sumar_cuenta, _sumar_renglones, _sentencias_resumen,
+    _etag, _etag_listado, _con_etag,
+    SQL_FOLIO_DETALLE, SQL_BLOQUEAR_CABECERA, SQL_BLOQUEAR_RENGLON, SQL_BLOQUEAR_DETALLES,
+    SQL_SUMAR_TOTALES, SQL_ACTUALIZAR_RENGLON, SQL_CAMBIAR_MESA, SQL_BORRAR_DETALLES, SQL_BORRAR_CABECERA,
+)
+
+# ---------------- Configuración ----------------
+# Conexiones por credencial del pool aiomysql (la concurrencia ya no la limitan los hilos)
+ASGI_POOL_MAX = int(os.getenv("ASGI_POOL_MAX", smorgas.POOL_MAX))
+# Un cliente SSE aquí es una corrutina, no un hilo: el tope puede ser mucho mayor
+EVENTOS_MAX_CLIENTES_ASGI = int(os.getenv("EVENTOS_MAX_CLIENTES_ASGI", "500"))
+
+aapp = Quart(__name__)
+aapp.secret_key = smorgas.app.secret_key
+aapp.config["SESSION_TTL_MIN"] = smorgas.SESSION_TTL_MIN
+
+def _rutas_async():
+    """Endpoints que se atienden en asyncio con la configuración de concurrencia vigente."""
+    rutas = {"index", "ventas_json", "venta_detalles", "eventos"}
+    rutas |= {r for r in ("update", "delete") if not smorgas._optimista(r)}
+    if not smorgas._optimista("detalle_update") and smorgas.DETALLE_MODO_TOTALES == "delta":
+        rutas.add("detalle_update")
+    return rutas
+
+RUTAS_ASYNC = _rutas_async()
+
+# ---------------- Pool aiomysql ----------------
+_POOLS = {}
+_POOLS_LOCK = None   # asyncio.Lock (se crea dentro del loop, ver _al_arrancar)
+
+async def _pool_para(rol):
+    """Pool aiomysql por credenciales (misma elección de usuario que app._credenciales)."""
+    clave = smorgas._credenciales(rol)
+    pool = _POOLS.get(clave)
+    if pool is None:
+        async with _POOLS_LOCK:
+            pool = _POOLS.get(clave)
+            if pool is None:
+                cfg = smorgas.BASE_DB_CFG
+                pool = _POOLS[clave] = await aiomysql.create_pool(
+                    host=cfg["host"], port=cfg["port"], db=cfg["database"],
+                    user=clave[0], password=clave[1], charset=cfg["charset"],
+                    autocommit=False, cursorclass=aiomysql.DictCursor,
+                    init_command=smorgas.SESSION_INIT_SQL,
+                    minsize=0, maxsize=ASGI_POOL_MAX,
+                    pool_recycle=int(smorgas.POOL_IDLE_SEG),
+                )
+    return pool
+
+@asynccontextmanager
+async def conexion(rol=None):
+    """
+    Equivalente async de app.get_db_connection(): presta una conexión del pool con las
+    credenciales del rol de la sesión. Al salir deshace lo que haya quedado abierto
+    (aiomysql cierra, en vez de reutilizar, las conexiones devueltas a media transacción).
+    """
+    if rol is None:
+        rol = session.get("rol")
+    pool = await _pool_para(rol)
+    conn = await asyncio.wait_for(pool.acquire(), smorgas.POOL_ESPERA_SEG)
+    try:
+        yield conn
+    except (OperationalError, InterfaceError):
+        conn.close()
+        raise
+    finally:
+        if not conn.closed and conn.get_transaction_status():
+            await conn.rollback()
+        pool.release(conn)
+
+async def tx_with_retry(fn, retries=3, sitio="tx"):
+    """
+    Versión async de app.tx_with_retry(): mismos reintentos ante deadlock (1213) o lock
+    wait timeout (1205), mismo backoff con jitter y presupuesto, mismos contadores por sitio.
+    'fn' es una corrutina sin argumentos que abre su conexión y hace commit.
+    """
+    st = smorgas._stats_reintentos(sitio)
+    smorgas._contar(st, llamadas=1)
+    inicio = time.monotonic()
+    for i in range(retries):
+        smorgas._contar(st, intentos=1)
+        try:
+            return await fn()
+        except OperationalError as e:
+            code = e.args[0] if e.args else None
+            if code == 1213:
+                smorgas._contar(st, deadlocks=1)
+            elif code == 1205:
+                smorgas._contar(st, lock_timeouts=1)
+            if code in (1213, 1205) and i < retries - 1:
+                espera = random.uniform(
+                    0, min(smorgas.TX_BACKOFF_MAX_SEG, smorgas.TX_BACKOFF_BASE_SEG * 2 ** i))
+                if time.monotonic() - inicio + espera <= smorgas.TX_PRESUPUESTO_SEG:
+                    await asyncio.sleep(espera)
+                    smorgas._contar(st, espera_seg=espera)
+                    continue
+            smorgas._contar(st, fallos=1)
+            raise
+        except ConflictoVersion:
+            smorgas._contar(st, conflictos=1)
+            raise
+        except Exception:
+            smorgas._contar(st, fallos=1)
+            raise
+
+async def _aplicar_resumen(cur, delta):
+    for sql, filas in _sentencias_resumen(delta):
+        await cur.executemany(sql, filas)
+
+async def _en_hilo(fn, *args):
+    """Corre una función bloqueante de app.py (con contexto de la app Flask) en el executor."""
+    def _llamar():
+        with smorgas.app.app_context():
+            return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, _llamar)
+
+# ---------------- Sesión ----------------
+async def _verificar_sesion():
+    """
+    Lo mismo que app.login_requerido() (caché _SESIONES, heartbeat, cierre por
+    inactividad). Devuelve None si la sesión sigue vigente o la redirección a /login.
+    """
+    if "usuario" not in session or "sess_token" not in session:
+        return redirect(url_for("login"))
+
+    user = session.get("usuario")
+    token = session.get("sess_token")
+
+    ent = smorgas._sesion_en_cache(user, token)
+    if ent is not None and not smorgas._heartbeat_pendiente(ent):
+        return None
+
+    bump = None
+    async with conexion() as conn:
+        async with conn.cursor() as cur:
+            if ent is None:
+                await cur.execute(smorgas.SQL_SESION, (user,))
+                row = await cur.fetchone()
+
+                if not row or not row.get("Session_Token") or row["Session_Token"] != token:
+                    smorgas._olvidar_sesion(user)
+                    session.clear()
+                    await flash("Tu sesión ya no es válida (iniciada en otro dispositivo o cerrada).", "warning")
+                    return redirect(url_for("login"))
+
+                if not smorgas._session_active(cur, row):
+                    smorgas._olvidar_sesion(user)
+                    session.clear()
+                    await flash("Tu sesión ha expirado por inactividad.", "warning")
+                    return redirect(url_for("login"))
+
+                ent = smorgas._cachear_sesion(user, row)
+
+            if smorgas._heartbeat_pendiente(ent):
+                ahora = smorgas._now_sql()
+                bump = (ahora, ahora + timedelta(minutes=smorgas.SESSION_TTL_MIN))
+                await cur.execute(smorgas.SQL_BUMP_SESION, (bump[1], ent["ID_Usuario"]))
+        await conn.commit()
+    if bump:
+        ent["Ultimo_Visto"], ent["Session_Expira"] = bump
+    return None
+
+def login_requerido(f):
+    @wraps(f)
+    async def wrapped(*args, **kwargs):
+        resp = await _verificar_sesion()
+        if resp is not None:
+            return resp
+        return await f(*args, **kwargs)
+    return wrapped
+
+def quiere_json():
+    return request.accept_mimetypes.best_match(["application/json", "text/html"]) == "application/json"
+
+def _no_modificado(etag):
+    if request.if_none_match.contains_weak(etag):
+        return _con_etag(Response("", status=304), etag)
+    return None
+
+# ---------------- Listado y detalle ----------------
+async def _version_eventos(cur):
+    """app._version_eventos(): último ID_Evento sin huecos antes (versión de las ETag)."""
+    if smorgas._EVENTOS["hilo"] is None:
+        await _en_hilo(smorgas._iniciar_eventos)
+    desde = smorgas._EVENTOS["ultimo"]
+    await cur.execute(smorgas.SQL_EVENTOS_DESDE, (desde, smorgas.EVENTOS_LOTE))
+    return smorgas._evento_contiguo(desde, [r["ID_Evento"] for r in await cur.fetchall()])
+
+async def _tope_archivo(cur):
+    await cur.execute(smorgas.SQL_TOPE_ARCHIVO)
+    return (await cur.fetchone())["tope"]
+
+async def _consultar_ventas(cur, filtros, tope_archivo=None, importes_float=True):
+    """Igual que app._consultar_ventas() (mismas sentencias, ver app._sql_ventas)."""
+    ids_fecha = None
+    if "fecha" in filtros:
+        d = filtros["fecha"]
+        await cur.execute(smorgas.SQL_ID_FECHA_DIA, (d.year, d.month, d.day))
+        ids_fecha = [r["ID_Fecha"] for r in await cur.fetchall()]
+        if not ids_fecha:
+            return [], None
+    await cur.execute(*smorgas._sql_ventas(filtros, ids_fecha))
+    ventas = list(await cur.fetchall())
+    if tope_archivo is None:
+        tope_archivo = await _tope_archivo(cur)
+    if smorgas._ver_archivo(ventas, filtros, tope_archivo):
+        await cur.execute(*smorgas._sql_ventas(filtros, ids_fecha, archivo=True))
+        ventas = smorgas._unir_archivo(ventas, await cur.fetchall(), filtros)
+    return smorgas._pagina_ventas(ventas, filtros, importes_float)
+
+async def _venta(cur, folio):
+    filas, _ = await _consultar_ventas(cur, {"folios": [folio], "antes": None, "por_pagina": 1})
+    return filas[0] if filas else None
+
+async def _fila_html(v, rol):
+    """app._fila_html() con render_template de Quart; la caché de filas es la de app.py."""
+    clave, version = smorgas._clave_fila(v, rol)
+    html = smorgas._fila_cacheada(clave, version)
+    if html is None:
+        html = smorgas._guardar_fila(clave, version,
+                                     Markup(await render_template("_fila_venta.html", v=v, rol=rol)))
+    return html
+
+async def _filas_ventas(ventas, rol):
+    return [await _fila_html(v, rol) for v in ventas]
+
+@aapp.route("/")
+@login_requerido
+async def index():
+    """app.index() en asyncio: misma plantilla, misma ETag, mismo 304."""
+    try:
+        filtros = smorgas._filtros_ventas(request.args)
+    except ValueError:
+        await flash("Filtros inválidos; se muestran todas las cuentas.", "warning")
+        filtros = smorgas._filtros_ventas({})
+    validar = not session.get("_flashes")
+
+    async with conexion() as conn:
+        async with conn.cursor() as cur:
+            ultimo_evento = await _version_eventos(cur)
+            tope_archivo = await _tope_archivo(cur)
+            etag = _etag_listado(ultimo_evento, tope_archivo, request.args,
+                                 session.get("usuario"), session.get("rol"))
+            if validar:
+                no_modificado = _no_modificado(etag)
+                if no_modificado is not None:
+                    return no_modificado
+            ventas, siguiente = await _consultar_ventas(cur, filtros, tope_archivo, importes_float=False)
+
+    args_filtros = {k: request.args[k] for k in smorgas.FILTROS_VENTAS if request.args.get(k)}
+    html = await render_template(
+        "index.html",
+        filas=await _filas_ventas(ventas, session.get("rol")),
+        siguiente=siguiente,
+        filtros=args_filtros,
+        es_primera=not filtros.get("antes"),
+        por_pagina=filtros["por_pagina"],
+        ultimo_evento=ultimo_evento,
+        diario_activo=bool(smorgas.PEDIDOS_DIARIO),
+        usuario=session.get("usuario"),
+        rol=session.get("rol"),
+    )
+    if validar:
+        return _con_etag(Response(html, mimetype="text/html"), etag)
+    return html
+
+@aapp.route("/ventas")
+@login_requerido
+async def ventas_json():
+    try:
+        filtros = smorgas._filtros_ventas(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "msg": f"Filtros inválidos: {e}"}), 400
+
+    async with conexion() as conn:
+        async with conn.cursor() as cur:
+            ultimo_evento = await _version_eventos(cur)
+            tope_archivo = await _tope_archivo(cur)
+            etag = _etag_listado(ultimo_evento, tope_archivo, request.args,
+                                 session.get("usuario"), session.get("rol"))
+            no_modificado = _no_modificado(etag)
+            if no_modificado is not None:
+                return no_modificado
+            ventas, siguiente = await _consultar_ventas(cur, filtros, tope_archivo)
+
+    cuerpo = {"ventas": ventas, "siguiente": siguiente, "ultimo_evento": ultimo_evento}
+    if request.args.get("filas"):
+        cuerpo["filas"] = await _filas_ventas(ventas, session.get("rol"))
+    return _con_etag(jsonify(cuerpo), etag)
+
+@aapp.route("/venta/<int:folio>/detalles")
+@login_requerido
+async def venta_detalles(folio):
+    # La caché del catálogo vive en app.py; solo va a la BD cada CATALOGO_REVISAR_SEG
+    catalogo = (await _en_hilo(smorgas._catalogo_vigente))["version"]
+    async with conexion() as conn:
+        async with conn.cursor() as cur:
+            archivo = False
+            await cur.execute("SELECT Version FROM TBL_COMPRA WHERE Folio=%s", (folio,))
+            cab = await cur.fetchone()
+            if cab is None:
+                archivo = True
+                await cur.execute("SELECT Version FROM TBL_COMPRA_HIST WHERE Folio=%s", (folio,))
+                cab = await cur.fetchone()
+                if cab is None:
+                    return jsonify([])
+            etag = _etag("f", folio, cab["Version"], int(archivo), *catalogo)
+            no_modificado = _no_modificado(etag)
+            if no_modificado is not None:
+                return no_modificado
+            await cur.execute(smorgas.SQL_DETALLES_HIST if archivo else smorgas.SQL_DETALLES, (folio,))
+            rows = smorgas._formatear_detalles(list(await cur.fetchall()))
+
+    if rows:
+        etag = _etag("f", folio, rows[0]["Version_Folio"], int(archivo), *catalogo)
+    return _con_etag(jsonify(rows), etag)
+
+# ---------------- Escrituras (bloqueo pesimista) ----------------
+@aapp.route("/detalle/update/<int:id_detalle>", methods=["POST"])
+@login_requerido
+async def detalle_update(id_detalle):
+    """app.detalle_update() en modo "delta": bloquea cabecera y luego solo el renglón editado."""
+    form = await request.form
+    try:
+        cant = int(form.get("cantidad", ""))
+        precio = Decimal(form.get("precio_unit", "")).quantize(CENTAVO, ROUND_HALF_UP)
+    except (ValueError, ArithmeticError):
+        return jsonify({"ok": False, "msg": "Datos inválidos"}), 400
+
+    if not (1 <= cant <= 50) or not (CENTAVO <= precio <= 10000):
+        return jsonify({"ok": False, "msg": "Fuera de rango"}), 400
+
+    subtotal = (precio * cant).quantize(CENTAVO, ROUND_HALF_UP)
+
+    async def _tx():
+        async with conexion() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_FOLIO_DETALLE, (id_detalle,))
+                r = await cur.fetchone()
+                if not r:
+                    await conn.rollback()
+                    return jsonify({"ok": False, "msg": "Detalle inexistente"}), 404
+                folio = r["Folio"]
+
+                await cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = await cur.fetchone()
+                await cur.execute(SQL_BLOQUEAR_RENGLON, (id_detalle,))
+                viejo = await cur.fetchone()
+                if not viejo:
+                    await conn.rollback()
+                    return jsonify({"ok": False, "msg": "Detalle inexistente"}), 404
+
+                await cur.execute(SQL_SUMAR_TOTALES,
+                                  (cant - viejo["Cantidad"], subtotal - viejo["Subtotal"], folio))
+                await cur.execute(SQL_ACTUALIZAR_RENGLON, (cant, precio, subtotal, id_detalle))
+
+                delta = _delta_resumen()
+                nuevo = {"ID_Producto": viejo["ID_Producto"], "Cantidad": cant, "Subtotal": subtotal}
+                c1, i1 = _sumar_renglones(delta, clave, [viejo], -1)
+                c2, i2 = _sumar_renglones(delta, clave, [nuevo])
+                _sumar_cuenta(delta, clave, 0, c1 + c2, i1 + i2)
+                await _aplicar_resumen(cur, delta)
+                await cur.execute(smorgas.SQL_EVENTO, ("editada", folio))
+
+            await conn.commit()
+            smorgas._EVENTOS_DESPERTAR.set()
+            return jsonify({"ok": True})
+
+    try:
+        return await tx_with_retry(_tx, sitio="detalle_update")
+    except Exception as e:
+        return jsonify({"ok": False, "msg": f"Error al actualizar: {e}"}), 500
+
+async def _responder(cuerpo, estado, categoria):
+    """JSON para fetch(), o aviso flash + regreso al listado (como app.update/app.delete)."""
+    if quiere_json():
+        return jsonify(cuerpo), estado
+    await flash(cuerpo["msg"], categoria)
+    return redirect(url_for("index"))
+
+@aapp.route("/update/<int:folio>", methods=["POST"])
+@login_requerido
+async def update(folio):
+    """app.update() pesimista: bloquea cabecera y detalles del folio antes de escribir."""
+    form = await request.form
+    id_mesa = form.get("ID_Mesa")
+    id_modo = form.get("ID_Modo_Entrega")
+
+    msg = None
+    if id_mesa not in [str(x) for x in range(100, 109)]:
+        msg = "Mesa inválida."
+    elif id_modo not in ("1", "2"):
+        msg = "Modo de entrega inválido."
+    if msg:
+        return await _responder({"ok": False, "msg": msg}, 400, "warning")
+
+    async def _tx():
+        async with conexion() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = await cur.fetchone()
+                await cur.execute(SQL_BLOQUEAR_DETALLES, (folio,))
+                renglones = await cur.fetchall()
+                await cur.execute(SQL_CAMBIAR_MESA, (id_mesa, id_modo, folio))
+                if clave:
+                    viejos = (int(clave["ID_Mesa"]), int(clave["ID_Modo_Entrega"]))
+                    if viejos != (int(id_mesa), int(id_modo)):
+                        cant = sum(r["Cantidad"] for r in renglones)
+                        imp = sum((r["Subtotal"] for r in renglones), Decimal("0.00"))
+                        delta = _delta_resumen()
+                        _sumar_cuenta(delta, clave, -1, -cant, -imp)
+                        _sumar_cuenta(delta, dict(clave, ID_Mesa=id_mesa, ID_Modo_Entrega=id_modo), 1, cant, imp)
+                        await _aplicar_resumen(cur, delta)
+                    await cur.execute(smorgas.SQL_EVENTO, ("editada", folio))
+            await conn.commit()
+            smorgas._EVENTOS_DESPERTAR.set()
+
+    try:
+        await tx_with_retry(_tx, sitio="update")
+    except Exception as e:
+        return await _responder({"ok": False, "msg": f"Error al actualizar: {e}"}, 500, "danger")
+
+    cuerpo = {"ok": True, "msg": f"Cuenta #{folio} actualizada."}
+    if quiere_json():
+        async with conexion() as conn:
+            async with conn.cursor() as cur:
+                cuerpo["venta"] = await _venta(cur, folio)
+        cuerpo["html"] = await _fila_html(cuerpo["venta"], session.get("rol")) if cuerpo["venta"] else None
+    return await _responder(cuerpo, 200, "success")
+
+@aapp.route("/delete/<int:folio>")
+@login_requerido
+async def delete(folio):
+    """app.delete() pesimista (solo admin): bloquea cabecera y detalles, borra detalle y cabecera."""
+    if session.get("rol") != "admin":
+        return await _responder({"ok": False, "msg": "Solo administradores pueden eliminar."}, 403, "danger")
+
+    async def _tx():
+        async with conexion() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_BLOQUEAR_CABECERA, (folio,))
+                clave = await cur.fetchone()
+                await cur.execute(SQL_BLOQUEAR_DETALLES, (folio,))
+                renglones = await cur.fetchall()
+
+                await cur.execute(SQL_BORRAR_DETALLES, (folio,))
+                await cur.execute(SQL_BORRAR_CABECERA, (folio,))
+                if clave:
+                    delta = _delta_resumen()
+                    cant, imp = _sumar_renglones(delta, clave, renglones, -1)
+                    _sumar_cuenta(delta, clave, -1, cant, imp)
+                    await _aplicar_resumen(cur, delta)
+                    await cur.execute(smorgas.SQL_EVENTO, ("eliminada", folio))
+            await conn.commit()
+            smorgas._EVENTOS_DESPERTAR.set()
+
+    try:
+        await tx_with_retry(_tx, sitio="delete")
+    except Exception as e:
+        return await _responder({"ok": False, "msg": f"Error al eliminar: {e}"}, 500, "danger")
+    return await _responder({"ok": True, "msg": f"Folio #{folio} eliminado."}, 200, "success")
+
+# ---------------- Tablero en vivo (Server-Sent Events) ----------------
+# El hilo lector de app.py (_bucle_eventos) sigue siendo el único que consulta
+# TBL_EVENTOS; tras cada lote avisa al loop (app._EVENTOS_OYENTES) y este despierta a
+# todas las corrutinas de /eventos a la vez con un asyncio.Event por "generación".
+_AVISO = {"evento": None}
+
+def _despertar():
+    aviso, _AVISO["evento"] = _AVISO["evento"], asyncio.Event()
+    aviso.set()
+
+async def _flujo_eventos(desde, rol):
+    """Mismo texto SSE que app._flujo_eventos(), esperando en el loop en vez de en un hilo."""
+    # El lugar se toma aquí y no en la ruta: si el cliente se va antes de la primera vuelta,
+    # el generador nunca arranca y su finally no correría para devolverlo
+    with smorgas._EVENTOS_COND:
+        smorgas._EVENTOS["clientes"] += 1
+    try:
+        yield "retry: 2000\n\n"
+        ultimo, fin = desde, time.monotonic() + smorgas.EVENTOS_DURACION_SEG
+        while time.monotonic() < fin:
+            ev = smorgas._EVENTOS
+            with smorgas._EVENTOS_COND:   # solo para leer el buffer: nunca se espera con el lock
+                atrasado = ultimo < ev["descartado"]
+                nuevos = [e for e in ev["buffer"] if e["id"] > ultimo]
+                aviso = _AVISO["evento"]
+                ultimo_hub = ev["ultimo"]
+            if atrasado:
+                yield f"id: {ultimo_hub}\nevent: recargar\ndata: {{}}\n\n"
+                return
+            if not nuevos:
+                try:
+                    await asyncio.wait_for(aviso.wait(), smorgas.EVENTOS_LATIDO_SEG)
+                except asyncio.TimeoutError:
+                    yield ": latido\n\n"
+                continue
+            for e in nuevos:
+                html = await _fila_html(e["venta"], rol) if e["venta"] else None
+                datos = json.dumps({"folio": e["folio"], "venta": e["venta"], "html": html}, default=str)
+                yield f"id: {e['id']}\nevent: {e['tipo']}\ndata: {datos}\n\n"
+            ultimo = nuevos[-1]["id"]
+    finally:
+        smorgas._soltar_cliente()
+
+@aapp.route("/eventos")
+@login_requerido
+async def eventos():
+    desde = request.headers.get("Last-Event-ID", type=int)
+    if desde is None:
+        desde = request.args.get("desde", type=int)
+
+    if smorgas._EVENTOS["hilo"] is None:
+        await _en_hilo(smorgas._iniciar_eventos)
+    with smorgas._EVENTOS_COND:
+        # Solo se revisa el tope; el lugar lo toma _flujo_eventos al empezar a enviar
+        if smorgas._EVENTOS["clientes"] >= EVENTOS_MAX_CLIENTES_ASGI:
+            return Response("Demasiados clientes del tablero en vivo\n", status=503,
+                            headers={"Retry-After": "30"}, mimetype="text/plain")
+        if desde is None:
+            desde = smorgas._EVENTOS["ultimo"]
+
+    # Con el contexto de la petición: las filas se renderizan dentro del flujo (url_for)
+    resp = Response(
+        stream_with_context(_flujo_eventos)(desde, session.get("rol")),   # Quart: envuelve la función
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    resp.timeout = None   # el flujo dura EVENTOS_DURACION_SEG, más que RESPONSE_TIMEOUT de Quart
+    return resp
+
+# ---------------- Arranque ----------------
+# El resto de las reglas de app.py se registran sin vista: url_for() en las plantillas
+# las resuelve igual, pero las peticiones a ellas las atiende la app Flask (ver asgi()).
+for _regla in smorgas.app.url_map.iter_rules():
+    if _regla.endpoint not in aapp.view_functions:
+        aapp.add_url_rule(_regla.rule, _regla.endpoint, methods=_regla.methods)
+
+@aapp.before_serving
+async def _al_arrancar():
+    global _POOLS_LOCK
+    _POOLS_LOCK = asyncio.Lock()
+    _AVISO["evento"] = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    smorgas._EVENTOS_OYENTES.append(partial(loop.call_soon_threadsafe, _despertar))
+
+@aapp.after_serving
+async def _al_terminar():
+    for pool in _POOLS.values():
+        pool.close()
+        await pool.wait_closed()
+
+_wsgi = AsyncioWSGIMiddleware(smorgas.app)
+_RUTAS = aapp.url_map.bind("localhost")   # sin subdominios ni host_matching: basta un adaptador
+
+def _es_async(scope):
+    """True si la ruta (y el método) de la petición es una de RUTAS_ASYNC."""
+    try:
+        endpoint, _ = _RUTAS.match(scope["path"], method=scope["method"])
+    except HTTPException:   # 404 / 405 / redirección de barra final: que conteste Flask
+        return False
+    return endpoint in RUTAS_ASYNC
+
+async def asgi(scope, receive, send):
+    """Aplicación ASGI: rutas de RUTAS_ASYNC -> Quart, el resto (y lifespan de WSGI) -> Flask."""
+    if scope["type"] == "http" and not _es_async(scope):
+        return await _wsgi(scope, receive, send)
+    return await aapp(scope, receive, send)
+
+def configuracion(host, port):
+    config = Config()
+    config.bind = [f"{host}:{port}"]
+    config.accesslog = None
+    return config
+
+async def _servir(config, apagar=None):
+    # Hilos para la app Flask (rutas no nativas y _catalogo_vigente), como en waitress
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(smorgas.WAITRESS_THREADS, thread_name_prefix="wsgi"))
+    kw = {"shutdown_trigger": apagar} if apagar is not None else {}
+    await serve(asgi, config, **kw)
+
+def servir(host, port):
+    """Sirve la aplicación con Hypercorn en un loop asyncio (bloquea hasta Ctrl+C)."""
+    print(f"Serving on http://{host}:{port} (asgi)")
+    asyncio.run(_servir(configuracion(host, port)))
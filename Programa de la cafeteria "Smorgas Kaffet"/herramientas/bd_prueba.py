@@ -0,0 +1,63 @@
+# =============================
+# Smörgås Kaffet - BD de prueba para las herramientas
+# Conexión con credenciales de administración, recreación de una BD desde
+# proyecto_smorgas.sql + migraciones/*.sql y utilidades comunes de las herramientas
+# (prueba de carga, datos sintéticos, bench y planes de SQL, commit en grupo, migraciones).
+# =============================
+
+import os
+import subprocess
+import sys
+
+import pymysql
+from pymysql.constants import CLIENT
+
+DIR_APP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def agregar_argumentos(ap, bd_por_defecto):
+    """Opciones de conexión comunes a todas las herramientas."""
+    ap.add_argument("--db-host", default="127.0.0.1")
+    ap.add_argument("--db-puerto", type=int, default=3306)
+    ap.add_argument("--db-usuario", default=os.getenv("DB_USER_DEFAULT", "root"))
+    ap.add_argument("--db-contrasenia", default=os.getenv("DB_PASS_DEFAULT", ""))
+    ap.add_argument("--bd", default=bd_por_defecto, help=f"BD de trabajo (por defecto {bd_por_defecto})")
+
+def conectar(args, bd=None, multi=False, **kw):
+    """Conexión en autocommit con el usuario de administración (--db-usuario)."""
+    return pymysql.connect(
+        host=args.db_host, port=args.db_puerto, user=args.db_usuario, password=args.db_contrasenia,
+        database=bd, charset="utf8mb4", autocommit=True,
+        client_flag=CLIENT.MULTI_STATEMENTS if multi else 0, **kw,
+    )
+
+def ejecutar_script(conn, ruta):
+    """Ejecuta un archivo .sql completo (varias sentencias) y consume todos los resultados."""
+    with open(ruta, encoding="utf-8") as f:
+        sql = f.read()
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        while cur.nextset():
+            pass
+
+def recrear_bd(args):
+    """DROP/CREATE de args.bd y carga de proyecto_smorgas.sql + migraciones (ver migrar.py)."""
+    import migrar  # migrar importa este módulo
+    with conectar(args) as conn, conn.cursor() as cur:
+        cur.execute("SELECT @@lower_case_table_names")
+        if cur.fetchone()[0] == 0:
+            sys.exit("MariaDB debe correr con lower_case_table_names=1 (app.py usa TBL_* en mayúsculas).")
+        cur.execute(f"DROP DATABASE IF EXISTS `{args.bd}`")
+        cur.execute(f"CREATE DATABASE `{args.bd}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+
+    with conectar(args, bd=args.bd, multi=True) as conn:
+        ejecutar_script(conn, os.path.join(DIR_APP, "proyecto_smorgas.sql"))
+        migrar.aplicar_pendientes(conn)
+
+def commit_actual():
+    """Commit corto de git del árbol medido (para etiquetar resultados), o None."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=DIR_APP,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
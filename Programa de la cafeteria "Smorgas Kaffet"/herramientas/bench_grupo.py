@@ -0,0 +1,173 @@
+# =============================
+# Smörgås Kaffet - Benchmark del commit en grupo
+# Compara cuántas cuentas por segundo guarda /add con un commit por cuenta
+# (camino normal) y con el escritor en grupo (COMMIT_GRUPO_MS), con varios hilos
+# registrando cuentas a la vez contra una BD MariaDB recién cargada.
+# =============================
+"""
+Benchmark del commit en grupo de app.py contra una MariaDB local.
+
+Cada corrida recrea la BD de prueba (proyecto_smorgas.sql + migraciones) y, para cada
+número de hilos de --hilos, mide durante --duracion segundos:
+  - directo: cada hilo llama a _guardar_cuenta (una transacción y un COMMIT por cuenta,
+    lo mismo que /add sin COMMIT_GRUPO_MS);
+  - grupo:   cada hilo llama a _guardar_en_grupo con COMMIT_GRUPO_MS de --ventana-ms y
+    COMMIT_GRUPO_MAX de --lote-max (lo mismo que /add con el escritor en grupo).
+Se informan cuentas/s, COMMIT/s, fsync del redo log por cuenta (Innodb_os_log_fsyncs) y
+la latencia p50/p95 de guardar una cuenta. Los hilos comparten el pool de app.py
+(DB_POOL_MAX), como los hilos de waitress.
+
+Ejemplos:
+  python herramientas/bench_grupo.py --hilos 1,8,32 --duracion 20
+  python herramientas/bench_grupo.py --hilos 32 --ventana-ms 2,5,10 --lote-max 64
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+import bd_prueba
+from bd_prueba import DIR_APP
+from prueba_carga import percentil
+
+sys.path.insert(0, DIR_APP)
+import app as smorgas  # noqa: E402  (necesita DIR_APP en sys.path)
+
+ESTADO_SERVIDOR = ("Com_commit", "Innodb_os_log_fsyncs")
+
+
+def preparar(args):
+    """Recrea la BD, apunta app.py a ella (ambos roles con --db-usuario) y lee el catálogo."""
+    bd_prueba.recrear_bd(args)
+    smorgas.BASE_DB_CFG.update(host=args.db_host, port=args.db_puerto, database=args.bd)
+    cred = {"user": args.db_usuario, "password": args.db_contrasenia}
+    smorgas.ROLE_DB_CREDENTIALS.update(admin=cred, mesero=dict(cred))
+    smorgas.DEFAULT_DB_USER, smorgas.DEFAULT_DB_PASS = args.db_usuario, args.db_contrasenia
+    with bd_prueba.conectar(args, bd=args.bd) as conn, conn.cursor() as cur:
+        cur.execute("SELECT ID_Producto, Precio_Producto FROM TBL_PRODUCTO")
+        productos = cur.fetchall()
+    if not productos:
+        sys.exit("TBL_PRODUCTO está vacía: no hay con qué armar cuentas.")
+    return productos
+
+def estado_servidor(args):
+    with bd_prueba.conectar(args) as conn, conn.cursor() as cur:
+        cur.execute("SHOW GLOBAL STATUS WHERE Variable_name IN %s", (ESTADO_SERVIDOR,))
+        return {nombre: int(valor) for nombre, valor in cur.fetchall()}
+
+def cuenta_al_azar(productos):
+    """Mesa, modo y 1-4 renglones como los que arma el formulario de pagina2."""
+    lineas = []
+    for id_producto, precio in random.sample(productos, min(len(productos), random.randint(1, 4))):
+        cantidad = random.randint(1, 3)
+        lineas.append({"id_producto": id_producto, "cantidad": cantidad,
+                       "precio": Decimal(precio), "subtotal": Decimal(precio) * cantidad})
+    return random.randint(100, 108), random.choice((1, 2)), lineas
+
+def correr(args, productos, modo, hilos):
+    """Guarda cuentas con 'hilos' hilos durante args.duracion segundos; devuelve el resumen."""
+    latencias = [[] for _ in range(hilos)]
+    errores = [0] * hilos
+    t_fin = time.perf_counter() + args.duracion
+
+    def _bucle(i):
+        # Contexto de petición propio: _guardar_en_grupo toma el rol de la sesión, como en /add
+        with smorgas.app.test_request_context("/add", method="POST"):
+            smorgas.session["rol"] = "admin"
+            while time.perf_counter() < t_fin:
+                id_mesa, id_modo, lineas = cuenta_al_azar(productos)
+                t0 = time.perf_counter()
+                try:
+                    if modo == "grupo":
+                        smorgas._guardar_en_grupo(datetime.now(), id_mesa, id_modo, lineas, str(uuid.uuid4()))
+                    else:
+                        smorgas._guardar_cuenta(datetime.now(), id_mesa, id_modo, lineas,
+                                                str(uuid.uuid4()), rol="admin")
+                except Exception:
+                    errores[i] += 1
+                    continue
+                latencias[i].append(time.perf_counter() - t0)
+
+    antes, grupo_antes = estado_servidor(args), dict(smorgas._GRUPO)
+    t0 = time.perf_counter()
+    trabajadores = [threading.Thread(target=_bucle, args=(i,), name=f"bench-{i}") for i in range(hilos)]
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    segundos = time.perf_counter() - t0
+    despues = estado_servidor(args)
+
+    todas = sorted(d for lat in latencias for d in lat)
+    cuentas = len(todas)
+    commits = despues["Com_commit"] - antes["Com_commit"]
+    fsyncs = despues["Innodb_os_log_fsyncs"] - antes["Innodb_os_log_fsyncs"]
+    resumen = {
+        "modo": modo, "hilos": hilos, "segundos": round(segundos, 3), "cuentas": cuentas,
+        "errores": sum(errores),
+        "cuentas_s": round(cuentas / segundos, 1),
+        "commits_s": round(commits / segundos, 1),
+        "fsync_por_cuenta": round(fsyncs / cuentas, 3) if cuentas else None,
+        "p50_ms": round(percentil(todas, 50) * 1000, 2) if todas else None,
+        "p95_ms": round(percentil(todas, 95) * 1000, 2) if todas else None,
+    }
+    if modo == "grupo":
+        lotes = smorgas._GRUPO["lotes"] - grupo_antes["lotes"]
+        resumen.update(ventana_ms=smorgas.COMMIT_GRUPO_MS, lote_max=smorgas.COMMIT_GRUPO_MAX, lotes=lotes,
+                       cuentas_por_lote=round((smorgas._GRUPO["cuentas"] - grupo_antes["cuentas"]) / lotes, 1)
+                       if lotes else None,
+                       separadas=smorgas._GRUPO["separadas"] - grupo_antes["separadas"])
+    return resumen
+
+def imprimir(r):
+    extra = (f"  ventana {r['ventana_ms']} ms, {r['cuentas_por_lote']} cuentas/lote"
+             if r["modo"] == "grupo" else "")
+    print(f"{r['modo']:<8}{r['hilos']:>6}{r['cuentas_s']:>12}{r['commits_s']:>12}"
+          f"{r['fsync_por_cuenta'] if r['fsync_por_cuenta'] is not None else '-':>10}"
+          f"{r['p50_ms'] or '-':>10}{r['p95_ms'] or '-':>10}{r['errores']:>8}{extra}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    bd_prueba.agregar_argumentos(ap, "proyecto_smorgas_grupo")
+    ap.add_argument("--hilos", default="1,8,32", help="hilos registrando cuentas, separados por coma")
+    ap.add_argument("--duracion", type=float, default=20, help="segundos medidos por corrida")
+    ap.add_argument("--ventana-ms", default="5", help="valores de COMMIT_GRUPO_MS a probar, separados por coma")
+    ap.add_argument("--lote-max", type=int, default=smorgas.COMMIT_GRUPO_MAX, help="COMMIT_GRUPO_MAX")
+    ap.add_argument("--semilla", type=int, default=1)
+    ap.add_argument("--salida", default=None, help="JSON de resultados (por defecto bench_grupo_<fecha>.json)")
+    args = ap.parse_args()
+    random.seed(args.semilla)
+
+    inicio = datetime.now()
+    print(f"Preparando BD {args.bd} ...")
+    productos = preparar(args)
+    smorgas.COMMIT_GRUPO_MAX = args.lote_max
+
+    corridas = []
+    print(f"{'modo':<8}{'hilos':>6}{'cuentas/s':>12}{'COMMIT/s':>12}{'fsync/c':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'errores':>8}")
+    for hilos in [int(x) for x in args.hilos.split(",") if x]:
+        corridas.append(correr(args, productos, "directo", hilos))
+        imprimir(corridas[-1])
+        for ventana in [float(x) for x in args.ventana_ms.split(",") if x]:
+            smorgas.COMMIT_GRUPO_MS = ventana
+            corridas.append(correr(args, productos, "grupo", hilos))
+            imprimir(corridas[-1])
+
+    resultado = {"inicio": inicio.isoformat(timespec="seconds"), "commit": bd_prueba.commit_actual(),
+                 "pool_max": smorgas.POOL_MAX, "corridas": corridas}
+    salida = args.salida or f"bench_grupo_{inicio:%Y%m%d_%H%M%S}.json"
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2, default=str)
+    print(f"\nResultados en {salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# =============================
+# Smörgås Kaffet - Micro-benchmarks de SQL
+# Cronometra las consultas que usan las rutas de app.py (llamando a sus mismas
+# funciones) y guarda el EXPLAIN de cada sentencia, opcionalmente a varias escalas
+# de historial generadas con generar_datos.py.
+# =============================
+"""
+Micro-benchmarks de las consultas de app.py contra una BD con datos (sintéticos o reales).
+
+Cada caso llama a la función de app.py que usa la ruta (_consultar_ventas, _leer_detalles,
+_recalcular_totales, _leer_catalogo) o repite su consulta (sesión de login_requerido) con
+parámetros al azar; las escrituras se deshacen con ROLLBACK. De cada sentencia distinta se
+guarda su EXPLAIN y se marcan escaneos completos (type=ALL), filesort y temporales.
+
+Con --escalas se recrea la BD y se genera historial (generar_datos.py) para cada tamaño
+de TBL_DETALLE antes de medir, para ver dónde se rompe cada consulta al crecer.
+
+Ejemplos:
+  python herramientas/bench_sql.py --bd proyecto_smorgas_escala
+  python herramientas/bench_sql.py --escalas 100000,1000000,10000000 --anios 5
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import date, datetime
+
+import pymysql
+from pymysql.cursors import DictCursor
+
+import bd_prueba
+import generar_datos
+from bd_prueba import DIR_APP
+from prueba_carga import percentil
+
+sys.path.insert(0, DIR_APP)
+import app as smorgas  # noqa: E402  (necesita DIR_APP en sys.path)
+
+# Misma consulta que login_requerido() cuando la sesión no está en caché
+SQL_SESION = """
+    SELECT ID_Usuario, Session_Token, Session_Expira, Ultimo_Visto
+      FROM TBL_USUARIOS
+     WHERE Nombre_Usuario=%s
+"""
+
+
+class _CursorRegistro(DictCursor):
+    """DictCursor que anota (SQL ya con valores, segundos) de cada sentencia en 'registro'."""
+    registro = None
+
+    def execute(self, query, args=None):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            if self.registro is not None:
+                self.registro.append((self._executed, time.perf_counter() - t0))
+
+
+class Muestras:
+    """Parámetros al azar tomados de la BD (folios, días, usuarios existentes)."""
+
+    def __init__(self, cur):
+        cur.execute("SELECT MIN(Folio) AS lo, MAX(Folio) AS hi FROM TBL_COMPRA")
+        r = cur.fetchone()
+        self.folio_min, self.folio_max = r["lo"] or 0, r["hi"] or 0
+        cur.execute("SELECT Anio, Mes, Dia FROM TBL_FECHA")
+        self.dias = [date(r["Anio"], r["Mes"], r["Dia"]) for r in cur.fetchall()]
+        cur.execute("SELECT Nombre_Usuario FROM TBL_USUARIOS LIMIT 1000")
+        self.usuarios = [r["Nombre_Usuario"] for r in cur.fetchall()] or ["nadie"]
+
+    def folio(self):
+        return random.randint(self.folio_min, self.folio_max)
+
+    def folio_profundo(self):
+        """Cursor en el 10 % más antiguo del historial (páginas viejas del listado)."""
+        return self.folio_min + int((self.folio_max - self.folio_min) * random.uniform(0, 0.1)) + 1
+
+    def dia(self):
+        return random.choice(self.dias) if self.dias else date.today()
+
+    def usuario(self):
+        return random.choice(self.usuarios)
+
+
+def _filtros(**kw):
+    return dict({"antes": None, "por_pagina": smorgas.VENTAS_POR_PAGINA}, **kw)
+
+# nombre -> función(cur, muestras) con lo mismo que hace la ruta
+CASOS = {
+    "listado_primera_pagina": lambda cur, m: smorgas._consultar_ventas(cur, _filtros()),
+    "listado_pagina_profunda": lambda cur, m: smorgas._consultar_ventas(cur, _filtros(antes=m.folio_profundo())),
+    "listado_por_fecha": lambda cur, m: smorgas._consultar_ventas(cur, _filtros(fecha=m.dia())),
+    "listado_mesa_modo": lambda cur, m: smorgas._consultar_ventas(
+        cur, _filtros(mesa=random.randint(100, 108), modo=random.choice((1, 2)))),
+    "detalle_folio": lambda cur, m: smorgas._leer_detalles(cur, m.folio()),
+    "recalcular_totales": lambda cur, m: smorgas._recalcular_totales(cur, m.folio()),
+    "sesion_usuario": lambda cur, m: (cur.execute(SQL_SESION, (m.usuario(),)), cur.fetchone()),
+    "catalogo": lambda cur, m: smorgas._leer_catalogo(cur),
+}
+
+
+def _explicar(cur, sql):
+    """EXPLAIN de una sentencia + alertas (escaneo completo, filesort, tabla temporal)."""
+    cur.execute("EXPLAIN " + sql)
+    plan = cur.fetchall()
+    alertas = []
+    for fila in plan:
+        extra = fila.get("Extra") or ""
+        if fila.get("type") == "ALL":
+            alertas.append(f"escaneo completo de {fila.get('table')} (~{fila.get('rows')} filas)")
+        if "filesort" in extra:
+            alertas.append(f"filesort en {fila.get('table')}")
+        if "temporary" in extra:
+            alertas.append(f"tabla temporal en {fila.get('table')}")
+    return plan, alertas
+
+def medir_caso(conn, fn, muestras, repeticiones, calentamiento):
+    registro = []
+    with conn.cursor() as cur:
+        for i in range(calentamiento + repeticiones):
+            cur.registro = registro if i >= calentamiento else None
+            t0 = time.perf_counter()
+            fn(cur, muestras)
+            dur = time.perf_counter() - t0
+            conn.rollback()
+            if i >= calentamiento:
+                registro.append((None, dur))   # marca de fin de repetición con su total
+        cur.registro = None
+
+    totales = sorted(d for sql, d in registro if sql is None)
+    por_sql = {}
+    for sql, d in registro:
+        if sql is not None:
+            clave = smorgas.normalizar_sql(sql)
+            ent = por_sql.setdefault(clave, {"ejemplo": sql, "n": 0, "seg": 0.0})
+            ent["n"] += 1
+            ent["seg"] += d
+
+    sentencias = []
+    with conn.cursor() as cur:
+        for clave, ent in por_sql.items():
+            plan, alertas = _explicar(cur, ent["ejemplo"])
+            sentencias.append({"sql": clave, "media_ms": round(ent["seg"] / ent["n"] * 1000, 3),
+                               "explain": plan, "alertas": alertas})
+        conn.rollback()
+    return {
+        "p50_ms": round(percentil(totales, 50) * 1000, 3),
+        "p95_ms": round(percentil(totales, 95) * 1000, 3),
+        "max_ms": round(totales[-1] * 1000, 3),
+        "media_ms": round(sum(totales) / len(totales) * 1000, 3),
+        "sentencias": sentencias,
+    }
+
+def tamanios(conn, bd):
+    """Filas estimadas por tabla (information_schema; COUNT(*) sería lento a gran escala)."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA=%s", (bd,))
+        return {r["TABLE_NAME"]: r["TABLE_ROWS"] for r in cur.fetchall()}
+
+def medir(args, casos):
+    conn = pymysql.connect(
+        host=args.db_host, port=args.db_puerto, user=args.db_usuario, password=args.db_contrasenia,
+        database=args.bd, charset="utf8mb4", autocommit=False, cursorclass=_CursorRegistro,
+        init_command=smorgas.SESSION_INIT_SQL,
+    )
+    with conn:
+        with conn.cursor() as cur:
+            muestras = Muestras(cur)
+        conn.rollback()
+        resultado = {"tablas": tamanios(conn, args.bd), "casos": {}}
+        for nombre in casos:
+            resultado["casos"][nombre] = medir_caso(conn, CASOS[nombre], muestras,
+                                                    args.repeticiones, args.calentamiento_rep)
+    return resultado
+
+def imprimir(escala):
+    print(f"\nTBL_DETALLE ≈ {escala['tablas'].get('tbl_detalle') or 0:,} filas, "
+          f"TBL_COMPRA ≈ {escala['tablas'].get('tbl_compra') or 0:,}")
+    print(f"{'caso':<26}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}  alertas")
+    for nombre, r in escala["casos"].items():
+        alertas = sorted({a for s in r["sentencias"] for a in s["alertas"]})
+        print(f"{nombre:<26}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['max_ms']:>10}  {'; '.join(alertas) or '-'}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    generar_datos.agregar_argumentos(ap)
+    ap.add_argument("--escalas", default=None,
+                    help="renglones de TBL_DETALLE separados por coma; recrea y genera cada escala")
+    ap.add_argument("--casos", default=",".join(CASOS), help="casos a medir, separados por coma")
+    ap.add_argument("--repeticiones", type=int, default=50)
+    ap.add_argument("--calentamiento-rep", type=int, default=5, help="repeticiones no medidas por caso")
+    ap.add_argument("--salida", default=None, help="JSON de resultados (por defecto bench_sql_<fecha>.json)")
+    args = ap.parse_args()
+
+    casos = [c for c in args.casos.split(",") if c]
+    desconocidos = set(casos) - set(CASOS)
+    if desconocidos:
+        ap.error(f"casos desconocidos: {', '.join(sorted(desconocidos))}")
+
+    inicio = datetime.now()
+    resultado = {"inicio": inicio.isoformat(timespec="seconds"), "commit": bd_prueba.commit_actual(),
+                 "escalas": []}
+    objetivos = [int(float(x)) for x in args.escalas.split(",")] if args.escalas else [None]
+    for objetivo in objetivos:
+        if objetivo is not None:
+            print(f"\n=== Escala: {objetivo:,} renglones ===")
+            args.recrear, args.detalles = True, objetivo
+            generado = generar_datos.generar(args)
+        else:
+            generado = None
+        random.seed(args.semilla)
+        escala = dict(medir(args, casos), objetivo_detalles=objetivo, generado=generado)
+        resultado["escalas"].append(escala)
+        imprimir(escala)
+
+    salida = args.salida or f"bench_sql_{inicio:%Y%m%d_%H%M%S}.json"
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2, default=str)
+    print(f"\nResultados en {salida}")
+
+
+if __name__ == "__main__":
+    main()
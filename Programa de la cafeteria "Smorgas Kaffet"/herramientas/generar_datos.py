@@ -0,0 +1,271 @@
+# =============================
+# Smörgås Kaffet - Generador de datos sintéticos
+# Llena TBL_FECHA, TBL_COMPRA, TBL_DETALLE, TBL_PRODUCTO y TBL_USUARIOS con
+# volúmenes configurables (años de historial, millones de renglones) usando
+# LOAD DATA LOCAL INFILE por lotes.
+# =============================
+"""
+Genera historial sintético en una BD de Smörgås Kaffet.
+
+- TBL_FECHA: un día por fecha del rango (solo los que falten).
+- TBL_COMPRA / TBL_DETALLE: cuentas en orden cronológico (Folio crece con la fecha y la
+  hora, como en producción), más cuentas en fin de semana, 1..6 renglones por cuenta,
+  productos con popularidad tipo Zipf y totales de cabecera iguales a la suma del detalle.
+- TBL_PRODUCTO: --productos extra además del menú del volcado.
+- TBL_USUARIOS: --usuarios meseros/admins; una parte con sesiones vencidas.
+
+La carga va por lotes de --lote renglones con LOAD DATA LOCAL INFILE (archivo temporal
+TSV, FOREIGN_KEY_CHECKS=0 y UNIQUE_CHECKS=0 dentro del lote). Si el servidor no permite
+LOCAL INFILE se usa INSERT multi-fila. Al final se corre ANALYZE TABLE.
+
+Ejemplo (BD nueva, 5 años, 10M renglones):
+  python herramientas/generar_datos.py --recrear --anios 5 --detalles 10000000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from pymysql.err import OperationalError
+from werkzeug.security import generate_password_hash
+
+import bd_prueba
+
+RENGLONES_POR_CUENTA = (1, 2, 3, 4, 5, 6)
+PESOS_RENGLONES = (20, 30, 22, 14, 9, 5)     # media ≈ 2.8 renglones por cuenta
+CANTIDADES = (1, 2, 3, 4)
+PESOS_CANTIDAD = (60, 25, 10, 5)
+MESAS = range(100, 109)
+MODOS = (1, 2)
+HORA_APERTURA, HORA_CIERRE = 7, 21
+
+COLUMNAS_COMPRA = "(Folio, Importe_Total, Cantidad_Total, Hora, ID_Modo_Entrega, ID_Fecha, ID_Mesa)"
+COLUMNAS_DETALLE = "(ID_Detalle, Folio, ID_Producto, Cantidad, Precio_Unit, Subtotal)"
+
+
+# ---------------- Dimensiones ----------------
+def asegurar_fechas(cur, desde, hasta):
+    """Inserta los días del rango que falten en TBL_FECHA; devuelve {date: ID_Fecha}."""
+    cur.execute("SELECT ID_Fecha, Anio, Mes, Dia FROM TBL_FECHA ORDER BY ID_Fecha")
+    ids = {}
+    for id_fecha, anio, mes, dia in cur.fetchall():
+        ids.setdefault(date(anio, mes, dia), id_fecha)
+    faltan = [desde + timedelta(days=i) for i in range((hasta - desde).days + 1)]
+    faltan = [d for d in faltan if d not in ids]
+    if faltan:
+        cur.executemany("INSERT INTO TBL_FECHA (Dia, Mes, Anio) VALUES (%s, %s, %s)",
+                        [(d.day, d.month, d.year) for d in faltan])
+        cur.execute("SELECT ID_Fecha, Anio, Mes, Dia FROM TBL_FECHA ORDER BY ID_Fecha")
+        for id_fecha, anio, mes, dia in cur.fetchall():
+            ids.setdefault(date(anio, mes, dia), id_fecha)
+    return ids
+
+def agregar_productos(cur, n):
+    """n productos sintéticos repartidos en categorías; nombres únicos por ux_producto_nombre."""
+    if n <= 0:
+        return
+    cur.execute("SELECT COALESCE(MAX(ID_Producto), 0) FROM TBL_PRODUCTO")
+    base = cur.fetchone()[0] + 1
+    categorias = ("Especialidad", "Bebidas", "Postres", "Desayunos", "Comidas", "Extras")
+    cur.executemany(
+        "INSERT INTO TBL_PRODUCTO (ID_Producto, Nombre_Producto, Precio_Producto, Categoria)"
+        " VALUES (%s, %s, %s, %s)",
+        [(base + i, f"Sintético {base + i}", round(random.uniform(15, 250), 2), random.choice(categorias))
+         for i in range(n)],
+    )
+
+def agregar_usuarios(cur, n):
+    """n usuarios (1 de cada 10 admin); 1 de cada 4 con una sesión ya vencida."""
+    if n <= 0:
+        return
+    pw_hash = generate_password_hash("sintetico")
+    ahora = datetime.now()
+    filas = []
+    for i in range(n):
+        vencida = i % 4 == 0
+        filas.append((
+            f"sint{i:06d}", "admin" if i % 10 == 0 else "mesero", pw_hash,
+            os.urandom(16).hex() if vencida else None,
+            ahora - timedelta(hours=random.randint(1, 24 * 30)) if vencida else None,
+        ))
+    cur.executemany(
+        "INSERT IGNORE INTO TBL_USUARIOS"
+        " (Nombre_Usuario, Rol_Usuario, Contrasenia_hash, Fecha_Creacion, Session_Token, Session_Expira)"
+        " VALUES (%s, %s, %s, NOW(), %s, %s)",
+        filas,
+    )
+
+
+# ---------------- Historial ----------------
+def _cuentas_por_dia(dias, total):
+    """Reparte 'total' cuentas entre los días (fin de semana x1.5, leve crecimiento en el tiempo)."""
+    pesos = [(1.5 if d.weekday() >= 5 else 1.0) * (0.7 + 0.6 * i / max(1, len(dias) - 1))
+             for i, d in enumerate(dias)]
+    escala = total / sum(pesos)
+    cuentas = []
+    for p in pesos:
+        esperado = p * escala
+        base = int(esperado)
+        cuentas.append(base + (random.random() < esperado - base))   # redondeo aleatorio
+    return cuentas
+
+def generar_historial(cur, ids_fecha, desde, hasta, objetivo_detalles):
+    """
+    Genera cuentas día por día hasta juntar ~objetivo_detalles renglones.
+    Produce lotes (filas_compra, filas_detalle) ya formateados como TSV.
+    """
+    cur.execute("SELECT ID_Producto, Precio_Producto FROM TBL_PRODUCTO ORDER BY ID_Producto")
+    productos = cur.fetchall()
+    pesos_prod = [1 / (rango + 1) for rango in range(len(productos))]
+    random.shuffle(pesos_prod)                          # la popularidad no sigue al ID
+    cur.execute("SELECT COALESCE(MAX(Folio), 0), (SELECT COALESCE(MAX(ID_Detalle), 0) FROM TBL_DETALLE)"
+                " FROM TBL_COMPRA")
+    folio, id_detalle = cur.fetchone()
+
+    media = sum(r * p for r, p in zip(RENGLONES_POR_CUENTA, PESOS_RENGLONES)) / sum(PESOS_RENGLONES)
+    dias = [desde + timedelta(days=i) for i in range((hasta - desde).days + 1)]
+    por_dia = _cuentas_por_dia(dias, int(objetivo_detalles / media))
+    segundos_abierto = (HORA_CIERRE - HORA_APERTURA) * 3600
+
+    compras, detalles = [], []
+    for dia, n in zip(dias, por_dia):
+        id_fecha = ids_fecha[dia]
+        apertura = datetime(dia.year, dia.month, dia.day, HORA_APERTURA)
+        for seg in sorted(random.randrange(segundos_abierto) for _ in range(n)):
+            folio += 1
+            cant_total, importe_total = 0, 0
+            k = random.choices(RENGLONES_POR_CUENTA, PESOS_RENGLONES)[0]
+            for id_producto, precio in random.choices(productos, pesos_prod, k=k):
+                id_detalle += 1
+                cant = random.choices(CANTIDADES, PESOS_CANTIDAD)[0]
+                subtotal = precio * cant
+                cant_total += cant
+                importe_total += subtotal
+                detalles.append(f"{id_detalle}\t{folio}\t{id_producto}\t{cant}\t{precio}\t{subtotal}\n")
+            hora = apertura + timedelta(seconds=seg)
+            compras.append(f"{folio}\t{importe_total}\t{cant_total}\t{hora:%Y-%m-%d %H:%M:%S}\t"
+                           f"{random.choice(MODOS)}\t{id_fecha}\t{random.choice(MESAS)}\n")
+        yield compras, detalles
+        compras, detalles = [], []
+
+
+# ---------------- Carga ----------------
+class Cargador:
+    """Acumula renglones y los manda en lotes con LOAD DATA LOCAL INFILE (o INSERT multi-fila)."""
+
+    def __init__(self, conn, lote, load_data=True):
+        self.conn, self.lote, self.load_data = conn, lote, load_data
+        self.compras, self.detalles = [], []
+        self.total_compras = self.total_detalles = 0
+
+    def agregar(self, compras, detalles):
+        self.compras += compras
+        self.detalles += detalles
+        if len(self.detalles) >= self.lote:
+            self.vaciar()
+
+    def vaciar(self):
+        if not self.detalles and not self.compras:
+            return
+        with self.conn.cursor() as cur:
+            cur.execute("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+            self._cargar(cur, "TBL_COMPRA", COLUMNAS_COMPRA, self.compras)
+            self._cargar(cur, "TBL_DETALLE", COLUMNAS_DETALLE, self.detalles)
+            cur.execute("SET SESSION foreign_key_checks = 1, unique_checks = 1")
+        self.conn.commit()
+        self.total_compras += len(self.compras)
+        self.total_detalles += len(self.detalles)
+        self.compras, self.detalles = [], []
+
+    def _cargar(self, cur, tabla, columnas, filas):
+        if not filas:
+            return
+        if self.load_data:
+            try:
+                self._load_data(cur, tabla, columnas, filas)
+                return
+            except OperationalError as e:
+                # 1148 / 3948 / 4166: LOCAL INFILE deshabilitado en el servidor o el cliente
+                if e.args[0] not in (1148, 3948, 4166):
+                    raise
+                print(f"LOAD DATA LOCAL no disponible ({e.args[1]}); se usa INSERT multi-fila.")
+                self.load_data = False
+        marcas = "(" + ", ".join(["%s"] * columnas.count(",") + ["%s"]) + ")"
+        cur.executemany(f"INSERT INTO {tabla} {columnas} VALUES {marcas}",
+                        [f.rstrip("\n").split("\t") for f in filas])
+
+    @staticmethod
+    def _load_data(cur, tabla, columnas, filas):
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False, encoding="utf-8") as f:
+            f.writelines(filas)
+        try:
+            cur.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE {tabla}"
+                f" FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' {columnas}",
+                (f.name.replace("\\", "/"),),
+            )
+        finally:
+            os.unlink(f.name)
+
+
+def generar(args):
+    """Genera todo según 'args' (ver main); devuelve un resumen de lo insertado."""
+    if args.recrear:
+        bd_prueba.recrear_bd(args)
+    random.seed(args.semilla)
+    hasta = args.hasta or date.today()
+    desde = hasta - timedelta(days=int(args.anios * 365.25) - 1)
+
+    t0 = time.perf_counter()
+    with bd_prueba.conectar(args, bd=args.bd, local_infile=True) as conn:
+        with conn.cursor() as cur:
+            ids_fecha = asegurar_fechas(cur, desde, hasta)
+            agregar_productos(cur, args.productos)
+            agregar_usuarios(cur, args.usuarios)
+        conn.autocommit(False)
+        cargador = Cargador(conn, args.lote, load_data=not args.sin_load_data)
+        with conn.cursor() as cur:
+            for compras, detalles in generar_historial(cur, ids_fecha, desde, hasta, args.detalles):
+                antes = cargador.total_detalles
+                cargador.agregar(compras, detalles)
+                if cargador.total_detalles // 1_000_000 > antes // 1_000_000:
+                    print(f"  {cargador.total_detalles:,} renglones ({time.perf_counter() - t0:.0f} s)")
+        cargador.vaciar()
+        conn.autocommit(True)
+        with conn.cursor() as cur:
+            for tabla in ("TBL_FECHA", "TBL_COMPRA", "TBL_DETALLE", "TBL_PRODUCTO", "TBL_USUARIOS"):
+                cur.execute(f"ANALYZE TABLE {tabla}")
+                cur.fetchall()
+
+    resumen = {"desde": desde.isoformat(), "hasta": hasta.isoformat(),
+               "compras": cargador.total_compras, "detalles": cargador.total_detalles,
+               "segundos": round(time.perf_counter() - t0, 1)}
+    print(f"Listo: {resumen['compras']:,} cuentas y {resumen['detalles']:,} renglones "
+          f"del {resumen['desde']} al {resumen['hasta']} en {resumen['segundos']} s")
+    return resumen
+
+
+def agregar_argumentos(ap):
+    bd_prueba.agregar_argumentos(ap, "proyecto_smorgas_escala")
+    ap.add_argument("--recrear", action="store_true",
+                    help="borrar y recrear la BD desde proyecto_smorgas.sql antes de generar")
+    ap.add_argument("--anios", type=float, default=1, help="años de historial (terminando en --hasta)")
+    ap.add_argument("--hasta", type=date.fromisoformat, default=None, help="último día (YYYY-MM-DD); hoy")
+    ap.add_argument("--detalles", type=int, default=1_000_000, help="renglones de TBL_DETALLE a generar")
+    ap.add_argument("--productos", type=int, default=0, help="productos sintéticos extra")
+    ap.add_argument("--usuarios", type=int, default=50, help="usuarios sintéticos")
+    ap.add_argument("--lote", type=int, default=200_000, help="renglones de detalle por LOAD DATA")
+    ap.add_argument("--sin-load-data", action="store_true", help="usar INSERT multi-fila")
+    ap.add_argument("--semilla", type=int, default=1)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    agregar_argumentos(ap)
+    generar(ap.parse_args())
+
+
+if __name__ == "__main__":
+    main()
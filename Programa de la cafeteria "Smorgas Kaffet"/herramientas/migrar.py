@@ -0,0 +1,126 @@
+# =============================
+# Smörgås Kaffet - Migraciones versionadas
+# Aplica en orden los migraciones/NNN_*.sql que le falten a una BD y anota cada
+# uno en TBL_MIGRACIONES (número, archivo, suma SHA-256, fecha).
+# =============================
+"""
+Aplica las migraciones pendientes (migraciones/NNN_nombre.sql) a una BD existente.
+
+Cada archivo aplicado queda anotado en TBL_MIGRACIONES con su suma SHA-256: los ya
+anotados no se vuelven a correr y, si uno cambió después de aplicado, se avisa (no se
+re-aplica: el cambio va en una migración nueva). Las migraciones son idempotentes
+(IF NOT EXISTS), así que en una BD a la que se le aplicaron a mano basta con correr
+esto una vez para anotarlas. El DDL de MariaDB hace commit implícito: un archivo que
+falla a la mitad no se anota y se puede volver a correr ya corregido.
+
+Ejemplos:
+  python herramientas/migrar.py --bd proyecto_smorgas
+  python herramientas/migrar.py --bd proyecto_smorgas --estado
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import re
+import sys
+
+import bd_prueba
+from bd_prueba import DIR_APP
+
+DIR_MIGRACIONES = os.path.join(DIR_APP, "migraciones")
+RE_MIGRACION = re.compile(r"^(\d{3})_\w+\.sql$")
+CANDADO = "smorgas_migraciones"   # GET_LOCK: dos despliegues a la vez no aplican lo mismo
+
+SQL_TABLA = """
+    CREATE TABLE IF NOT EXISTS `tbl_migraciones` (
+      `Version` smallint(5) UNSIGNED NOT NULL,
+      `Archivo` varchar(255) NOT NULL,
+      `Suma` char(64) NOT NULL,
+      `Aplicada` datetime NOT NULL DEFAULT current_timestamp(),
+      PRIMARY KEY (`Version`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+
+def migraciones():
+    """[(version, archivo, ruta, suma)] de migraciones/ en orden de número."""
+    lista = []
+    for ruta in sorted(glob.glob(os.path.join(DIR_MIGRACIONES, "*.sql"))):
+        archivo = os.path.basename(ruta)
+        m = RE_MIGRACION.match(archivo)
+        if not m:
+            sys.exit(f"Nombre de migración inválido (se espera NNN_nombre.sql): {archivo}")
+        with open(ruta, "rb") as f:
+            suma = hashlib.sha256(f.read().replace(b"\r\n", b"\n")).hexdigest()
+        lista.append((int(m.group(1)), archivo, ruta, suma))
+    versiones = [v for v, *_ in lista]
+    if len(set(versiones)) != len(versiones):
+        sys.exit("Hay dos migraciones con el mismo número en migraciones/")
+    return lista
+
+def aplicadas(cur):
+    """{version: (archivo, suma, fecha)} ya anotadas en TBL_MIGRACIONES."""
+    cur.execute(SQL_TABLA)
+    cur.execute("SELECT Version, Archivo, Suma, Aplicada FROM TBL_MIGRACIONES")
+    return {v: (archivo, suma, fecha) for v, archivo, suma, fecha in cur.fetchall()}
+
+def aplicar_pendientes(conn):
+    """
+    Aplica en orden las migraciones que no estén en TBL_MIGRACIONES ('conn' en autocommit
+    con varias sentencias por execute, ver bd_prueba.conectar). Devuelve los archivos aplicados.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT GET_LOCK(%s, 60)", (CANDADO,))
+        if cur.fetchone()[0] != 1:
+            sys.exit("Otra ejecución de migrar.py tiene el candado; intenta de nuevo.")
+    try:
+        with conn.cursor() as cur:
+            hechas = aplicadas(cur)
+        nuevas = []
+        for version, archivo, ruta, suma in migraciones():
+            if version in hechas:
+                if hechas[version][1] != suma:
+                    print(f"AVISO: {archivo} cambió después de aplicarse; no se vuelve a correr.")
+                continue
+            bd_prueba.ejecutar_script(conn, ruta)
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO TBL_MIGRACIONES (Version, Archivo, Suma) VALUES (%s, %s, %s)",
+                            (version, archivo, suma))
+            nuevas.append(archivo)
+        return nuevas
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (CANDADO,))
+
+def imprimir_estado(conn):
+    with conn.cursor() as cur:
+        hechas = aplicadas(cur)
+    for version, archivo, _, suma in migraciones():
+        if version not in hechas:
+            estado = "pendiente"
+        elif hechas[version][1] != suma:
+            estado = f"aplicada {hechas[version][2]:%Y-%m-%d %H:%M} (el archivo cambió después)"
+        else:
+            estado = f"aplicada {hechas[version][2]:%Y-%m-%d %H:%M}"
+        print(f"{archivo:<40}{estado}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    bd_prueba.agregar_argumentos(ap, "proyecto_smorgas")
+    ap.add_argument("--estado", action="store_true", help="solo listar aplicadas / pendientes")
+    args = ap.parse_args()
+
+    with bd_prueba.conectar(args, bd=args.bd, multi=True) as conn:
+        if args.estado:
+            imprimir_estado(conn)
+            return
+        nuevas = aplicar_pendientes(conn)
+    for archivo in nuevas:
+        print(f"Aplicada {archivo}")
+    print(f"{len(nuevas)} migración(es) aplicada(s) a {args.bd}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+# =============================
+# Smörgås Kaffet - Regresión de planes de SQL
+# Extrae del código (AST) cada sentencia de app.py y app_async.py, corre su EXPLAIN
+# contra una BD con datos a escala y falla si alguna recorre una tabla completa o
+# hace filesort sobre más filas que el umbral.
+# =============================
+"""
+Revisa el plan de ejecución de cada sentencia SQL de app.py / app_async.py.
+
+1. Registro: se leen con ast todos los literales de SQL del código (cadenas, f-strings,
+   plantillas de str.format y concatenaciones). Lo que el código arma al ejecutarse
+   (nombres de tabla, listas IN, condiciones) queda como hueco.
+2. Casos: se llaman las funciones de app.py que arman esas sentencias (los de bench_sql.py
+   más los de CASOS_PLANES) con parámetros tomados de la BD; las escrituras se deshacen
+   con ROLLBACK. Cada sentencia ejecutada se asocia a su literal del código.
+3. Las sentencias fijas que ningún caso ejecutó se explican con valores de ejemplo según
+   la columna de cada %s. Una sentencia con huecos que ningún caso cubre es un error:
+   hay que agregar su caso a CASOS_PLANES.
+4. EXPLAIN de cada una: escaneo completo (type=ALL) o filesort sobre más de --umbral-filas
+   filas estimadas es una alerta (por debajo, solo aviso). PERMITIDAS lista las lecturas
+   completas a propósito. Los INSERT ... VALUES no leen tablas y no se explican.
+5. Disparadores: su SQL no está en el código y no se puede explicar, así que cualquier
+   disparador que quede en la BD es un error. El único que había, trg_compra_totales_au
+   (un SUM() del folio por cada renglón de TBL_DETALLE modificado), lo quita
+   migraciones/008_quitar_trigger_totales.sql; la app mantiene los totales por su cuenta.
+
+Sale con código 1 si hay alertas, errores o sentencias sin cubrir.
+
+Ejemplos:
+  python herramientas/planes_sql.py --bd proyecto_smorgas_escala
+  python herramientas/planes_sql.py --recrear --anios 2 --detalles 2000000 --usuarios 20000
+"""
+
+import argparse
+import ast
+import json
+import os
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pymysql
+
+import bd_prueba
+import generar_datos
+from bd_prueba import DIR_APP
+from bench_sql import CASOS, Muestras, _CursorRegistro, _filtros, smorgas, tamanios
+
+ARCHIVOS = ("app.py", "app_async.py")
+HUECO = "\x00"   # lugar de algo que el código pone al ejecutarse (tabla, columnas, lista IN)
+RE_SQL = re.compile(r"(SELECT|INSERT|UPDATE|DELETE)\s.*\bTBL_", re.S)
+RE_INSERT_VALUES = re.compile(r"INSERT\s.*\bVALUES\s*\(", re.S)
+
+# Lecturas completas a propósito: regex sobre la sentencia normalizada -> motivo
+PERMITIDAS = [
+    (r"SELECT ID_Fecha FROM TBL_FECHA$", "reconstruir-resumenes sin fechas recorre todo el calendario"),
+    (r"SELECT ID_Producto, Nombre_Producto, Precio_Producto,", "catálogo completo (se guarda en caché)"),
+    (r"SELECT COUNT\(\*\) AS n, COALESCE\(BIT_XOR\(", "versión del catálogo: checksum de TBL_PRODUCTO"),
+    (r"SELECT ID_Usuario, Nombre_Usuario, Rol_Usuario, Contrasenia_hash, Fecha_Creacion "
+     r"FROM TBL_USUARIOS ORDER BY", "lista de usuarios del panel de admin"),
+]
+
+
+class MuestrasPlanes(Muestras):
+    """Muestras de bench_sql.py más ID_Fecha, ID_Detalle e ID_Producto existentes."""
+
+    def __init__(self, cur):
+        super().__init__(cur)
+        cur.execute("SELECT ID_Fecha FROM TBL_FECHA ORDER BY Anio, Mes, Dia")
+        self.ids_fecha = [r["ID_Fecha"] for r in cur.fetchall()] or [1]
+        cur.execute("SELECT MIN(ID_Detalle) AS lo, MAX(ID_Detalle) AS hi FROM TBL_DETALLE")
+        r = cur.fetchone()
+        self.detalle_min, self.detalle_max = r["lo"] or 0, r["hi"] or 0
+        cur.execute("SELECT ID_Producto FROM TBL_PRODUCTO")
+        self.productos = [r["ID_Producto"] for r in cur.fetchall()] or [1]
+
+    def id_fecha(self):
+        return random.choice(self.ids_fecha)
+
+    def ids_recientes(self, dias):
+        return self.ids_fecha[-dias:]
+
+    def id_detalle(self):
+        return random.randint(self.detalle_min, self.detalle_max)
+
+    def id_producto(self):
+        return random.choice(self.productos)
+
+
+def _exportar(cur, m):
+    ids = [m.id_fecha()]
+    for archivo in (False, True):
+        cur.execute(smorgas._sql_exportacion(ids, archivo), ids)
+
+def _cuentas_lote(cur, m):
+    linea = {"id_producto": m.id_producto(), "cantidad": 1, "precio": Decimal("10.00"), "subtotal": Decimal("10.00")}
+    smorgas._insertar_cuentas(cur, [
+        {"id_fecha": m.id_fecha(), "id_mesa": 100 + i, "id_modo": 1, "hora": "12:00:00",
+         "lineas": [linea], "id_pedido": str(uuid.uuid4())} for i in range(2)
+    ])
+
+# Sentencias con huecos que los casos de bench_sql.py no ejecutan
+CASOS_PLANES = dict(CASOS, **{
+    "listado_archivo": lambda cur, m: cur.execute(*smorgas._sql_ventas(_filtros(), None, archivo=True)),
+    "detalle_archivo": lambda cur, m: smorgas._leer_detalles(cur, m.folio(), archivo=True),
+    "fechas_rango": lambda cur, m: smorgas._ids_fecha_rango(cur, m.dia() - timedelta(days=30), m.dia()),
+    "fechas_hasta": lambda cur, m: smorgas._ids_fecha_rango(cur, None, m.dia()),
+    "reportes": lambda cur, m: [smorgas._reporte(cur, por, m.ids_recientes(30)) for por in smorgas.REPORTES_POR],
+    "exportacion_dia": _exportar,
+    "reconstruir_dia": lambda cur, m: smorgas._reconstruir_dia(cur, m.id_fecha()),
+    "archivo_lote": lambda cur, m: smorgas._mover_al_archivo(cur, [m.folio()]),
+    "cuentas_lote": _cuentas_lote,
+})
+
+# Valor de ejemplo para un %s según la columna con la que se compara o asigna
+VALORES = {
+    "folio": lambda m: m.folio(),
+    "id_fecha": lambda m: m.id_fecha(),
+    "id_detalle": lambda m: m.id_detalle(),
+    "anio": lambda m: m.dia().year,
+    "mes": lambda m: m.dia().month,
+    "dia": lambda m: m.dia().day,
+    "nombre_usuario": lambda m: m.usuario(),
+    "session_token": lambda m: "0" * 64,
+    "session_expira": lambda m: datetime.now(),
+    "creado": lambda m: datetime.now() - timedelta(hours=1),
+    "id_evento": lambda m: 0,
+    "id_mesa": lambda m: random.randint(100, 108),
+    "id_modo_entrega": lambda m: random.choice((1, 2)),
+    "contrasenia_hash": lambda m: "x",
+    "id_pedido_cliente": lambda m: "00000000-0000-4000-8000-000000000000",
+}
+
+
+def _texto(nodo):
+    """Texto de un literal de SQL, con HUECO donde el código completa algo al ejecutarse."""
+    if isinstance(nodo, ast.Constant) and isinstance(nodo.value, str):
+        return re.sub(r"\{\w*\}", HUECO, nodo.value)   # plantillas de str.format
+    if isinstance(nodo, ast.JoinedStr):
+        return "".join(_texto(v) if isinstance(v, ast.Constant) else HUECO for v in nodo.values)
+    if isinstance(nodo, ast.BinOp) and isinstance(nodo.op, ast.Add):
+        return _texto(nodo.left) + _texto(nodo.right)
+    return HUECO
+
+def extraer_sentencias(rutas):
+    """{texto normalizado: [archivo:línea]} de los literales de SQL (sin docstrings)."""
+    sentencias = {}
+    for ruta in rutas:
+        with open(ruta, encoding="utf-8") as f:
+            arbol = ast.parse(f.read(), ruta)
+        internos = set()   # partes de una f-string o concatenación: cuenta el todo
+        for nodo in ast.walk(arbol):
+            if isinstance(nodo, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) \
+                    and ast.get_docstring(nodo, clean=False) is not None:
+                internos.add(id(nodo.body[0].value))
+            if isinstance(nodo, ast.JoinedStr) or (isinstance(nodo, ast.BinOp) and isinstance(nodo.op, ast.Add)):
+                internos.update(id(h) for h in ast.iter_child_nodes(nodo))
+        for nodo in ast.walk(arbol):
+            if id(nodo) in internos or not isinstance(nodo, (ast.Constant, ast.JoinedStr, ast.BinOp)):
+                continue
+            texto = " ".join(_texto(nodo).split())
+            if RE_SQL.match(texto):
+                sentencias.setdefault(texto, []).append(f"{os.path.basename(ruta)}:{nodo.lineno}")
+    return sentencias
+
+def _patron(texto):
+    """Regex que reconoce la sentencia ya ejecutada (valores en lugar de %s y de los huecos)."""
+    partes = re.split("%s|" + HUECO, texto)
+    return re.compile(".*?".join(r"\s*".join(map(re.escape, p.split(" "))) for p in partes), re.S)
+
+def _fija(texto):
+    """
+    La sentencia sin huecos: una lista IN armada en tiempo de ejecución cuenta como un %s
+    y un sufijo opcional al final (" FOR UPDATE") se omite; no cambia el plan.
+    """
+    texto = texto.replace(f"IN ({HUECO})", "IN (%s)").removesuffix(HUECO)
+    return None if HUECO in texto else texto
+
+def _parametros(texto, m):
+    """Valores de ejemplo para cada %s de una sentencia fija."""
+    params = []
+    for hit in re.finditer("%s", texto):
+        antes = texto[:hit.start()]
+        if re.search(r"\b(LIMIT|OFFSET)\s*$", antes):
+            params.append(smorgas.VENTAS_POR_PAGINA)
+            continue
+        col = re.search(r"(\w+)\s*(?:<=|>=|<>|=|<|>|\bIN\s*\()\s*$", antes)
+        gen = VALORES.get(col.group(1).lower()) if col else None
+        params.append(gen(m) if gen else 1)
+    return params
+
+
+def evaluar(plan, umbral):
+    """(alertas, avisos) del EXPLAIN: escaneo completo o filesort sobre más / menos de 'umbral' filas."""
+    alertas, avisos = [], []
+    for fila in plan:
+        filas = int(fila.get("rows") or 0)
+        tabla = fila.get("table")
+        hallazgos = []
+        if fila.get("type") == "ALL":
+            hallazgos.append(f"escaneo completo de {tabla} (~{filas} filas)")
+        if "filesort" in (fila.get("Extra") or ""):
+            hallazgos.append(f"filesort en {tabla} (~{filas} filas)")
+        (alertas if filas > umbral else avisos).extend(hallazgos)
+    return alertas, avisos
+
+def _permitida(sql):
+    for patron, motivo in PERMITIDAS:
+        if re.match(patron, sql):
+            return motivo
+    return None
+
+def correr_casos(conn, muestras, casos):
+    """Ejecuta cada caso (con ROLLBACK) y devuelve ({sql ejecutado: caso}, {caso: error})."""
+    ejecutadas, errores = {}, {}
+    with conn.cursor() as cur:
+        for nombre in casos:
+            registro = []
+            cur.registro = registro
+            try:
+                CASOS_PLANES[nombre](cur, muestras)
+            except pymysql.MySQLError as e:
+                errores[nombre] = str(e)
+            finally:
+                cur.registro = None
+                conn.rollback()
+            for sql, _ in registro:
+                if isinstance(sql, bytes):
+                    sql = sql.decode("utf-8", "replace")
+                ejecutadas.setdefault(" ".join(sql.split()), nombre)
+    return ejecutadas, errores
+
+def explicar(conn, sql, params=None):
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN " + sql, params)
+        plan = cur.fetchall()
+    conn.rollback()
+    return plan
+
+def _orden(sentencia):
+    archivo, linea = sentencia[1][0].split(":")
+    return archivo, int(linea)
+
+def revisar(args, casos):
+    sentencias = extraer_sentencias([os.path.join(DIR_APP, a) for a in ARCHIVOS])
+    conn = pymysql.connect(
+        host=args.db_host, port=args.db_puerto, user=args.db_usuario, password=args.db_contrasenia,
+        database=args.bd, charset="utf8mb4", autocommit=False, cursorclass=_CursorRegistro,
+        init_command=smorgas.SESSION_INIT_SQL,
+    )
+    resultado = {"tablas": tamanios(conn, args.bd), "umbral_filas": args.umbral_filas,
+                 "sentencias": [], "errores_casos": {}}
+    with conn:
+        with conn.cursor() as cur:
+            muestras = MuestrasPlanes(cur)
+        conn.rollback()
+        ejecutadas, resultado["errores_casos"] = correr_casos(conn, muestras, casos)
+
+        for texto, ubicaciones in sorted(sentencias.items(), key=_orden):
+            ent = {"sql": texto.replace(HUECO, "{…}"), "en": ubicaciones, "alertas": [], "avisos": []}
+            resultado["sentencias"].append(ent)
+            if RE_INSERT_VALUES.match(texto) and "SELECT" not in texto:
+                ent["estado"] = "sin lectura"
+                continue
+            patron = _patron(texto)
+            instancias = [(sql, None, caso) for sql, caso in ejecutadas.items() if patron.fullmatch(sql)]
+            if not instancias:
+                fija = _fija(texto)
+                if fija is None:
+                    ent["estado"] = "sin cubrir"
+                    continue
+                instancias = [(fija, _parametros(fija, muestras), "valores de ejemplo")]
+            ent["casos"] = sorted({caso for _, _, caso in instancias})
+            ent["permitida"] = _permitida(texto)
+            for sql, params, _ in instancias:
+                try:
+                    plan = explicar(conn, sql, params)
+                except pymysql.MySQLError as e:
+                    ent.setdefault("errores", []).append(f"EXPLAIN falló: {e}")
+                    continue
+                alertas, avisos = evaluar(plan, args.umbral_filas)
+                ent["alertas"] += [a for a in alertas if a not in ent["alertas"]]
+                ent["avisos"] += [a for a in avisos if a not in ent["avisos"]]
+                ent.setdefault("explain", plan)
+            if ent.get("errores"):
+                ent["estado"] = "error"
+            elif ent["alertas"] and not ent["permitida"]:
+                ent["estado"] = "ALERTA"
+            else:
+                ent["estado"] = "ok"
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT TRIGGER_NAME, ACTION_TIMING, EVENT_MANIPULATION, EVENT_OBJECT_TABLE,"
+                        " ACTION_STATEMENT FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s",
+                        (args.bd,))
+            for t in cur.fetchall():
+                resultado["sentencias"].append({
+                    "sql": " ".join(t["ACTION_STATEMENT"].split()), "alertas": [], "avisos": [],
+                    "en": [f"disparador {t['TRIGGER_NAME']} ({t['ACTION_TIMING']} {t['EVENT_MANIPULATION']}"
+                           f" ON {t['EVENT_OBJECT_TABLE']})"],
+                    "estado": "disparador",
+                })
+        conn.rollback()
+    return resultado
+
+def imprimir(resultado):
+    print(f"\nTBL_DETALLE ≈ {resultado['tablas'].get('tbl_detalle') or 0:,} filas, "
+          f"TBL_USUARIOS ≈ {resultado['tablas'].get('tbl_usuarios') or 0:,}; "
+          f"umbral {resultado['umbral_filas']:,} filas")
+    for ent in resultado["sentencias"]:
+        if ent["estado"] in ("ok", "sin lectura") and not ent["avisos"] and not ent["alertas"]:
+            continue
+        print(f"\n[{ent['estado']}] {', '.join(ent['en'])}\n  {ent['sql'][:160]}")
+        for a in ent["alertas"]:
+            print(f"  - {a}" + (f" (permitida: {ent['permitida']})" if ent.get("permitida") else ""))
+        for a in ent["avisos"]:
+            print(f"  · {a} (bajo el umbral)")
+        for e in ent.get("errores", []):
+            print(f"  ! {e}")
+        if ent["estado"] == "sin cubrir":
+            print("  ! ningún caso la ejecuta: agregar uno a CASOS_PLANES")
+        elif ent["estado"] == "disparador":
+            print("  ! su SQL no se revisa: quitarlo con una migración (ver migraciones/008)")
+    for caso, error in resultado["errores_casos"].items():
+        print(f"\n[error] caso {caso}: {error}")
+    cuenta = {}
+    for ent in resultado["sentencias"]:
+        cuenta[ent["estado"]] = cuenta.get(ent["estado"], 0) + 1
+    print("\n" + ", ".join(f"{n} {estado}" for estado, n in sorted(cuenta.items())))
+
+def fallida(resultado):
+    return bool(resultado["errores_casos"]) or any(
+        ent["estado"] in ("ALERTA", "error", "sin cubrir", "disparador") for ent in resultado["sentencias"])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    generar_datos.agregar_argumentos(ap)
+    ap.add_argument("--umbral-filas", type=int, default=1000,
+                    help="filas estimadas a partir de las que un escaneo completo o filesort falla")
+    ap.add_argument("--casos", default=",".join(CASOS_PLANES), help="casos a ejecutar, separados por coma")
+    ap.add_argument("--salida", default=None, help="JSON con el EXPLAIN de cada sentencia")
+    args = ap.parse_args()
+
+    casos = [c for c in args.casos.split(",") if c]
+    desconocidos = set(casos) - set(CASOS_PLANES)
+    if desconocidos:
+        ap.error(f"casos desconocidos: {', '.join(sorted(desconocidos))}")
+
+    if args.recrear:
+        generar_datos.generar(args)
+    random.seed(args.semilla)
+    resultado = dict(revisar(args, casos), commit=bd_prueba.commit_actual())
+    imprimir(resultado)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2, default=str)
+        print(f"Resultados en {args.salida}")
+    sys.exit(1 if fallida(resultado) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+# =============================
+# Smörgås Kaffet - Prueba de carga HTTP
+# Levanta app.py (waitress o asgi) contra una BD MariaDB local recién cargada desde
+# proyecto_smorgas.sql, inicia sesión con meseros/admins sintéticos y reproduce
+# una mezcla de servicio real. Resultados en JSON para comparar corridas.
+# =============================
+"""
+Prueba de carga de Smörgås Kaffet contra una MariaDB local.
+
+Pasos de cada corrida (reproducible: la BD de prueba se recrea siempre):
+  1. DROP/CREATE de la BD de prueba (--bd), carga de proyecto_smorgas.sql y de
+     migraciones/*.sql en orden.
+  2. Usuarios de BD carga_admin / carga_mesero con permisos sobre esa BD (dos pools,
+     como en producción) y N meseros + M admins sintéticos en TBL_USUARIOS.
+  3. app.py servido por waitress en 127.0.0.1 con WAITRESS_THREADS hilos, o con
+     --servidor asgi por Hypercorn + app_async.py (asyncio/aiomysql), para comparar.
+  4. Cada usuario sintético es un hilo cliente (HTTP keep-alive, sin seguir redirects)
+     que elige operaciones según --mezcla durante --duracion segundos.
+
+Requisitos: MariaDB con lower_case_table_names=1 (app.py usa TBL_* en mayúsculas y el
+volcado crea tbl_* en minúsculas) y un usuario con permiso de CREATE DATABASE/USER.
+
+Ejemplo:
+  python herramientas/prueba_carga.py --meseros 8 --admins 2 --duracion 60
+  python herramientas/prueba_carga.py --comparar carga_20261018_120000.json
+  python herramientas/prueba_carga.py --servidor asgi --comparar carga_20261018_120000.json
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import math
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from werkzeug.security import generate_password_hash
+
+import bd_prueba
+from bd_prueba import DIR_APP
+
+sys.path.insert(0, DIR_APP)
+import app as smorgas  # noqa: E402  (necesita DIR_APP en sys.path)
+
+# Operación -> peso por defecto (probabilidad relativa de elegirla en cada paso)
+MEZCLA_POR_DEFECTO = {
+    "pagina2": 3,          # abrir el formulario de nueva cuenta
+    "add": 3,              # registrar una cuenta
+    "index": 3,            # listado de ventas
+    "detalles": 4,         # editor inline: leer renglones de un folio
+    "detalle_update": 3,   # editor inline: guardar un renglón
+    "delete": 0.2,         # eliminar un folio (solo admins)
+}
+CONTRASENIA_SINTETICA = "carga"
+RE_FOLIO = re.compile(r'data-folio="(\d+)"')
+
+
+# ---------------- Preparación de la BD ----------------
+def preparar_bd(args):
+    bd_prueba.recrear_bd(args)
+    with bd_prueba.conectar(args, bd=args.bd) as conn, conn.cursor() as cur:
+        if args.usuarios_bd:
+            for usuario in ("carga_admin", "carga_mesero"):
+                for host in ("localhost", "127.0.0.1", "%"):
+                    cur.execute(f"CREATE USER IF NOT EXISTS '{usuario}'@'{host}' IDENTIFIED BY %s",
+                                (CONTRASENIA_SINTETICA,))
+                    cur.execute(f"GRANT SELECT, INSERT, UPDATE, DELETE ON `{args.bd}`.* TO '{usuario}'@'{host}'")
+
+        # Un solo hash para todos: generarlo por usuario solo alargaría la preparación
+        pw_hash = generate_password_hash(CONTRASENIA_SINTETICA)
+        usuarios = [(f"cargamesero{i:03d}", "mesero") for i in range(args.meseros)]
+        usuarios += [(f"cargaadmin{i:03d}", "admin") for i in range(args.admins)]
+        cur.executemany(
+            "INSERT INTO TBL_USUARIOS (Nombre_Usuario, Rol_Usuario, Contrasenia_hash, Fecha_Creacion)"
+            " VALUES (%s, %s, %s, NOW())",
+            [(nombre, rol, pw_hash) for nombre, rol in usuarios],
+        )
+    return usuarios
+
+
+# ---------------- Servidor ----------------
+class ServidorAsgi:
+    """
+    app_async.py servido por Hypercorn en un hilo con su propio loop. Expone lo que main()
+    usa del servidor de waitress: effective_port y close().
+    """
+
+    def __init__(self, puerto):
+        import app_async   # solo con --servidor asgi (requiere quart, aiomysql, hypercorn)
+        if not puerto:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                puerto = s.getsockname()[1]
+        self.effective_port = puerto
+        self._loop = self._apagar = None
+        listo = threading.Event()
+
+        async def _principal():
+            self._loop, self._apagar = asyncio.get_running_loop(), asyncio.Event()
+            listo.set()
+            await app_async._servir(app_async.configuracion("127.0.0.1", puerto), self._apagar.wait)
+
+        threading.Thread(target=asyncio.run, args=(_principal(),), name="hypercorn", daemon=True).start()
+        listo.wait()
+        # Espera a que Hypercorn acepte conexiones antes de soltar a los clientes
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", puerto), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._apagar.set)
+
+def levantar_app(args):
+    """Apunta app.py a la BD de prueba y lo sirve con waitress (o asgi) en un hilo."""
+    smorgas.BASE_DB_CFG.update(host=args.db_host, port=args.db_puerto, database=args.bd)
+    if args.usuarios_bd:
+        smorgas.ROLE_DB_CREDENTIALS.update({
+            "admin": {"user": "carga_admin", "password": CONTRASENIA_SINTETICA},
+            "mesero": {"user": "carga_mesero", "password": CONTRASENIA_SINTETICA},
+        })
+    else:
+        cred = {"user": args.db_usuario, "password": args.db_contrasenia}
+        smorgas.ROLE_DB_CREDENTIALS.update(admin=cred, mesero=dict(cred))
+    smorgas.DEFAULT_DB_USER, smorgas.DEFAULT_DB_PASS = args.db_usuario, args.db_contrasenia
+
+    if args.servidor == "asgi":
+        servidor = ServidorAsgi(args.http_puerto)
+    else:
+        servidor = smorgas.create_server(smorgas.app, host="127.0.0.1", port=args.http_puerto,
+                                         threads=smorgas.WAITRESS_THREADS)
+        smorgas._SERVIDOR = servidor
+        threading.Thread(target=servidor.run, name="waitress", daemon=True).start()
+    if args.tareas_fondo:
+        smorgas.iniciar_tareas_fondo()
+    return servidor
+
+
+# ---------------- Cliente ----------------
+class UsuarioVirtual:
+    """Un mesero o admin: una conexión keep-alive, su cookie de sesión y lo que ha visto."""
+
+    def __init__(self, puerto, nombre, rol, mezcla, registro):
+        self.puerto, self.nombre, self.rol = puerto, nombre, rol
+        ops = [(op, p) for op, p in mezcla.items() if p > 0 and (op != "delete" or rol == "admin")]
+        self.ops, self.pesos = [op for op, _ in ops], [p for _, p in ops]
+        self.registro = registro        # lista propia del hilo: (op, status, seg, fin, error)
+        self.conn = http.client.HTTPConnection("127.0.0.1", puerto, timeout=30)
+        self.cookie = ""
+        self.catalogo = []              # (id_producto, precio)
+        self.folios = []                # vistos en el listado
+        self.detalles = []              # renglones del último folio abierto
+
+    def pedir(self, metodo, ruta, cuerpo=None, tipo=None):
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        if tipo:
+            headers["Content-Type"] = tipo
+        try:
+            self.conn.request(metodo, ruta, body=cuerpo, headers=headers)
+            resp = self.conn.getresponse()
+            datos = resp.read()
+        except (OSError, http.client.HTTPException):
+            # La conexión se cayó: se reabre para el siguiente paso
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.puerto, timeout=30)
+            raise
+        galleta = resp.getheader("Set-Cookie")
+        if galleta:
+            c = SimpleCookie(galleta)
+            if "session" in c:
+                self.cookie = f"session={c['session'].value}"
+        return resp.status, resp.getheader("Location") or "", datos
+
+    def iniciar(self):
+        status, destino, _ = self.pedir(
+            "POST", "/login", urlencode({"usuario": self.nombre, "contrasenia": CONTRASENIA_SINTETICA}),
+            "application/x-www-form-urlencoded",
+        )
+        if status != 302 or "/login" in destino:
+            raise RuntimeError(f"No pudo iniciar sesión {self.nombre}: HTTP {status}")
+        _, _, datos = self.pedir("GET", "/catalogo")
+        self.catalogo = [(p["id"], p["precio"]) for prods in json.loads(datos).values() for p in prods]
+
+    def paso(self):
+        """Ejecuta una operación al azar y la registra (status, duración, error o no)."""
+        op = random.choices(self.ops, self.pesos)[0]
+        preparado = getattr(self, "_" + op)()
+        if preparado is None:   # sin datos todavía (p. ej. sin folios): se cuenta un listado
+            op, preparado = "index", self._index()
+        metodo, ruta, cuerpo, tipo, al_terminar = preparado
+        t0 = time.perf_counter()
+        try:
+            status, destino, datos = self.pedir(metodo, ruta, cuerpo, tipo)
+        except (OSError, http.client.HTTPException) as e:
+            fin = time.perf_counter()
+            self.registro.append((op, 0, fin - t0, fin, type(e).__name__))
+            return
+        fin = time.perf_counter()
+        error = None
+        if status >= 500 or (status >= 400 and status != 409):
+            error = f"HTTP {status}"
+        elif status == 409:
+            error = "conflicto"
+        elif "/login" in destino:
+            error = "sesion_perdida"
+        elif op == "add" and "/pagina2" in destino:
+            error = "add_rechazado"
+        if al_terminar and error is None:
+            al_terminar(datos)
+        self.registro.append((op, status, fin - t0, fin, error))
+
+    # --- Operaciones: devuelven (método, ruta, cuerpo, content-type, callback) o None ---
+    def _pagina2(self):
+        return "GET", "/pagina2", None, None, None
+
+    def _index(self):
+        def _guardar_folios(html):
+            folios = [int(f) for f in RE_FOLIO.findall(html.decode("utf-8", "replace"))]
+            if folios:
+                self.folios = list(dict.fromkeys(folios))
+        return "GET", "/", None, None, _guardar_folios
+
+    def _add(self):
+        lineas = [
+            {"id_producto": pid, "cantidad": random.randint(1, 4), "precio": precio}
+            for pid, precio in random.sample(self.catalogo, k=min(len(self.catalogo), random.randint(1, 5)))
+        ]
+        cuerpo = urlencode({
+            "id_mesa": random.randint(100, 108), "id_modo_entrega": random.choice((1, 2)),
+            "detalles": json.dumps(lineas),
+        })
+        return "POST", "/add", cuerpo, "application/x-www-form-urlencoded", None
+
+    def _detalles(self):
+        if not self.folios:
+            return None
+        def _guardar_detalles(datos):
+            self.detalles = json.loads(datos)
+        return "GET", f"/venta/{random.choice(self.folios)}/detalles", None, None, _guardar_detalles
+
+    def _detalle_update(self):
+        if not self.detalles:
+            return None
+        d = random.choice(self.detalles)
+        cuerpo = urlencode({"cantidad": random.randint(1, 5), "precio_unit": d["Precio_Unit"],
+                            "version": d.get("Version", 0)})
+        def _nueva_version(datos):
+            d["Version"] = json.loads(datos).get("version", d.get("Version", 0) + 1)
+        return "POST", f"/detalle/update/{d['ID_Detalle']}", cuerpo, "application/x-www-form-urlencoded", _nueva_version
+
+    def _delete(self):
+        if not self.detalles:
+            return None
+        folio, version = self.detalles[0]["Folio"], self.detalles[0].get("Version_Folio", 0)
+        self.detalles = []
+        if folio in self.folios:
+            self.folios.remove(folio)
+        return "GET", f"/delete/{folio}?version={version}", None, None, None
+
+    def cerrar(self):
+        try:
+            self.pedir("GET", "/logout")
+        except (OSError, http.client.HTTPException):
+            pass
+        self.conn.close()
+
+
+# ---------------- Resultados ----------------
+def percentil(ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not ordenados:
+        return None
+    k = max(1, math.ceil(p / 100 * len(ordenados)))
+    return ordenados[k - 1]
+
+def resumir(registros, desde, hasta):
+    """Agrupa por operación las peticiones que terminaron dentro de la ventana medida."""
+    segundos = hasta - desde
+    por_op = {}
+    for op, status, dur, fin, error in registros:
+        if desde <= fin <= hasta:
+            por_op.setdefault(op, []).append((dur, status, error))
+    resumen = {}
+    for op, filas in sorted(por_op.items()):
+        durs = sorted(d for d, _, _ in filas)
+        errores = {}
+        for _, _, error in filas:
+            if error:
+                errores[error] = errores.get(error, 0) + 1
+        resumen[op] = {
+            "peticiones": len(filas),
+            "por_seg": round(len(filas) / segundos, 2),
+            "p50_ms": round(percentil(durs, 50) * 1000, 2),
+            "p95_ms": round(percentil(durs, 95) * 1000, 2),
+            "p99_ms": round(percentil(durs, 99) * 1000, 2),
+            "max_ms": round(durs[-1] * 1000, 2),
+            "media_ms": round(sum(durs) / len(durs) * 1000, 2),
+            "errores": errores,
+            "tasa_error": round(sum(errores.values()) / len(filas), 4),
+        }
+    total = sum(r["peticiones"] for r in resumen.values())
+    return resumen, {"peticiones": total, "por_seg": round(total / segundos, 2) if segundos else 0}
+
+def _restar_reintentos(despues, antes):
+    return {
+        sitio: {k: round(v - antes.get(sitio, {}).get(k, 0), 4) for k, v in st.items()}
+        for sitio, st in despues.items()
+    }
+
+def imprimir(resultado):
+    print(f"\nTotal: {resultado['total']['peticiones']} peticiones, {resultado['total']['por_seg']} req/s")
+    print(f"{'operación':<16}{'n':>8}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  errores")
+    for op, r in resultado["rutas"].items():
+        print(f"{op:<16}{r['peticiones']:>8}{r['por_seg']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}"
+              f"{r['p99_ms']:>9}{r['max_ms']:>9}  {r['errores'] or '-'}")
+    for sitio, st in resultado["reintentos"].items():
+        print(f"tx {sitio}: {st}")
+    print(f"Cola de waitress máx.: {resultado['waitress_cola_max']}")
+
+def comparar(actual, base):
+    """Diferencias de p50/p95/p99 y throughput contra una corrida anterior."""
+    print(f"\nComparación contra {base.get('inicio')} (commit {base.get('commit')}):")
+    for op, r in actual["rutas"].items():
+        b = base["rutas"].get(op)
+        if not b:
+            continue
+        cambios = "  ".join(
+            f"{k} {b[k]}→{r[k]} ({(r[k] - b[k]) / b[k] * 100:+.0f}%)" if b[k] else f"{k} {b[k]}→{r[k]}"
+            for k in ("por_seg", "p50_ms", "p95_ms", "p99_ms")
+        )
+        print(f"  {op:<16}{cambios}")
+
+
+# ---------------- Principal ----------------
+def _parsear_mezcla(texto):
+    mezcla = dict(MEZCLA_POR_DEFECTO)
+    for par in filter(None, (texto or "").split(",")):
+        op, _, peso = par.partition("=")
+        if op not in mezcla:
+            raise argparse.ArgumentTypeError(f"operación desconocida: {op}")
+        mezcla[op] = float(peso)
+    return mezcla
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    bd_prueba.agregar_argumentos(ap, "proyecto_smorgas_carga")
+    ap.add_argument("--sin-usuarios-bd", dest="usuarios_bd", action="store_false",
+                    help="usar --db-usuario para ambos roles en lugar de carga_admin/carga_mesero")
+    ap.add_argument("--http-puerto", type=int, default=0, help="0 = puerto libre cualquiera")
+    ap.add_argument("--servidor", choices=("waitress", "asgi"), default=smorgas.SERVIDOR,
+                    help="waitress (WSGI con hilos) o asgi (app_async.py sobre Hypercorn)")
+    ap.add_argument("--meseros", type=int, default=8)
+    ap.add_argument("--admins", type=int, default=2)
+    ap.add_argument("--duracion", type=float, default=60, help="segundos medidos")
+    ap.add_argument("--calentamiento", type=float, default=5, help="segundos iniciales no medidos")
+    ap.add_argument("--pausa-ms", type=float, default=0, help="pausa media entre pasos de cada usuario")
+    ap.add_argument("--mezcla", type=_parsear_mezcla, default=dict(MEZCLA_POR_DEFECTO),
+                    help="pesos op=peso separados por coma, p. ej. add=5,delete=0")
+    ap.add_argument("--tareas-fondo", action="store_true", help="arrancar también las tareas de fondo")
+    ap.add_argument("--semilla", type=int, default=None)
+    ap.add_argument("--salida", default=None, help="JSON de resultados (por defecto carga_<fecha>.json)")
+    ap.add_argument("--comparar", default=None, help="JSON de una corrida anterior para comparar")
+    args = ap.parse_args()
+    random.seed(args.semilla)
+
+    inicio = datetime.now()
+    print(f"Preparando BD {args.bd} ...")
+    usuarios = preparar_bd(args)
+    servidor = levantar_app(args)
+    puerto = servidor.effective_port
+    print(f"app.py en http://127.0.0.1:{puerto} ({args.servidor}, {smorgas.WAITRESS_THREADS} hilos), "
+          f"{args.meseros} meseros + {args.admins} admins")
+
+    registros = [[] for _ in usuarios]
+    virtuales = [UsuarioVirtual(puerto, nombre, rol, args.mezcla, registros[i])
+                 for i, (nombre, rol) in enumerate(usuarios)]
+    for v in virtuales:
+        v.iniciar()
+
+    t_inicio = time.perf_counter()
+    t_medir = t_inicio + args.calentamiento
+    t_fin = t_medir + args.duracion
+    antes = None
+    cola_max = 0 if args.servidor == "waitress" else None
+
+    def _bucle(v):
+        while time.perf_counter() < t_fin:
+            v.paso()
+            if args.pausa_ms:
+                time.sleep(random.expovariate(1000 / args.pausa_ms))
+
+    hilos = [threading.Thread(target=_bucle, args=(v,), name=f"vu-{v.nombre}") for v in virtuales]
+    for h in hilos:
+        h.start()
+    # Muestrea la cola de waitress mientras corre la prueba
+    while any(h.is_alive() for h in hilos):
+        if antes is None and time.perf_counter() >= t_medir:
+            antes = smorgas.estadisticas_reintentos()
+        if cola_max is not None:
+            cola_max = max(cola_max, len(servidor.task_dispatcher.queue))
+        time.sleep(0.05)
+    for v in virtuales:
+        v.cerrar()
+
+    rutas, total = resumir([r for lista in registros for r in lista], t_medir, t_fin)
+    resultado = {
+        "inicio": inicio.isoformat(timespec="seconds"),
+        "commit": bd_prueba.commit_actual(),
+        "config": {
+            "meseros": args.meseros, "admins": args.admins, "duracion": args.duracion,
+            "calentamiento": args.calentamiento, "pausa_ms": args.pausa_ms, "mezcla": args.mezcla,
+            "servidor": args.servidor, "waitress_threads": smorgas.WAITRESS_THREADS, "pool_max": smorgas.POOL_MAX,
+            "concurrencia": smorgas.CONCURRENCIA, "detalle_modo_totales": smorgas.DETALLE_MODO_TOTALES,
+            "semilla": args.semilla,
+        },
+        "total": total,
+        "rutas": rutas,
+        "reintentos": _restar_reintentos(smorgas.estadisticas_reintentos(), antes or {}),
+        "waitress_cola_max": cola_max,
+        "pools": {u: p.estadisticas() for (u, _), p in smorgas._POOLS.items()},
+    }
+    imprimir(resultado)
+
+    salida = args.salida or f"carga_{inicio:%Y%m%d_%H%M%S}.json"
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(resultado, json.load(f))
+    servidor.close()
+
+
+if __name__ == "__main__":
+    main()
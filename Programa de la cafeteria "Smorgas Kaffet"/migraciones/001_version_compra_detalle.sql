@@ -0,0 +1,8 @@
+-- Migración 001: columna Version para concurrencia optimista (CONCURRENCIA_<RUTA>=optimista).
+-- Todas las escrituras de app.py la incrementan; aplicar antes de desplegar esta versión.
+
+ALTER TABLE `tbl_compra`
+  ADD COLUMN IF NOT EXISTS `Version` INT UNSIGNED NOT NULL DEFAULT 0;
+
+ALTER TABLE `tbl_detalle`
+  ADD COLUMN IF NOT EXISTS `Version` INT UNSIGNED NOT NULL DEFAULT 0;
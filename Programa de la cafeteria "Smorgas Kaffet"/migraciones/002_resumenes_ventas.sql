@@ -0,0 +1,31 @@
+-- Migración 002: tablas de resumen de ventas por día (reportes sin recorrer TBL_DETALLE).
+-- app.py las mantiene en la misma transacción de cada alta/edición/baja; después de
+-- aplicarla hay que llenarlas con el historial existente:
+--   flask --app app reconstruir-resumenes
+-- Cantidad/Importe son con signo: las ediciones aplican diferencias (+/-).
+
+CREATE TABLE IF NOT EXISTS `tbl_resumen_producto_dia` (
+  `ID_Fecha` int(10) UNSIGNED NOT NULL,
+  `ID_Producto` int(10) UNSIGNED NOT NULL,
+  `Cantidad` int(11) NOT NULL DEFAULT 0,
+  `Importe` decimal(14,2) NOT NULL DEFAULT 0.00,
+  PRIMARY KEY (`ID_Fecha`,`ID_Producto`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `tbl_resumen_mesa_dia` (
+  `ID_Fecha` int(10) UNSIGNED NOT NULL,
+  `ID_Mesa` int(10) UNSIGNED NOT NULL,
+  `Cuentas` int(11) NOT NULL DEFAULT 0,
+  `Cantidad` int(11) NOT NULL DEFAULT 0,
+  `Importe` decimal(14,2) NOT NULL DEFAULT 0.00,
+  PRIMARY KEY (`ID_Fecha`,`ID_Mesa`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `tbl_resumen_modo_dia` (
+  `ID_Fecha` int(10) UNSIGNED NOT NULL,
+  `ID_Modo_Entrega` int(10) UNSIGNED NOT NULL,
+  `Cuentas` int(11) NOT NULL DEFAULT 0,
+  `Cantidad` int(11) NOT NULL DEFAULT 0,
+  `Importe` decimal(14,2) NOT NULL DEFAULT 0.00,
+  PRIMARY KEY (`ID_Fecha`,`ID_Modo_Entrega`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
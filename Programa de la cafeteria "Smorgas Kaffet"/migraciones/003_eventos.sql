@@ -0,0 +1,12 @@
+-- Migración 003: eventos de cambios en las cuentas para el tablero en vivo (/eventos).
+-- app.py inserta una fila por alta/edición/baja dentro de la misma transacción y cada
+-- proceso las lee por ID_Evento; la tarea "eventos_purga" borra las de más de una hora
+-- (EVENTOS_RETENCION_SEG).
+
+CREATE TABLE IF NOT EXISTS `tbl_eventos` (
+  `ID_Evento` bigint(20) UNSIGNED NOT NULL AUTO_INCREMENT,
+  `Tipo` enum('creada','editada','eliminada') NOT NULL,
+  `Folio` int(10) UNSIGNED NOT NULL,
+  `Creado` datetime NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`ID_Evento`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
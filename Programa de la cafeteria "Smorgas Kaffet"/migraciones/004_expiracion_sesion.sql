@@ -0,0 +1,6 @@
+-- Migración 004: índice por vencimiento de sesión para la tarea "sesiones_barrido" de app.py,
+-- que limpia por lotes (UPDATE ... WHERE Session_Expira < ahora ORDER BY Session_Expira LIMIT n)
+-- los tokens vencidos sin recorrer toda TBL_USUARIOS.
+
+ALTER TABLE `tbl_usuarios`
+  ADD KEY IF NOT EXISTS `idx_session_expira` (`Session_Expira`);
@@ -0,0 +1,42 @@
+-- Migración 005: archivo de cuentas cerradas (tarea "archivo_ventas" / flask --app app archivar-ventas).
+-- Las cuentas de días más viejos que ARCHIVO_HORIZONTE_DIAS pasan, por lotes, de
+-- tbl_compra/tbl_detalle a estas tablas con las mismas columnas e índices, así el trabajo
+-- del servicio (listado, FOR UPDATE, SUM de totales) solo toca lo reciente. El listado,
+-- el detalle, la exportación y reconstruir-resumenes leen ambas.
+-- Tablas aparte y no particiones RANGE por ID_Fecha: InnoDB no admite llaves foráneas en
+-- tablas particionadas y el detalle depende de fk_detalle_compra (ON DELETE CASCADE).
+-- Los Folio se conservan: requiere MariaDB >= 10.2.4 (AUTO_INCREMENT persistente) para que
+-- tbl_compra no vuelva a repartir folios ya archivados tras un reinicio.
+
+CREATE TABLE IF NOT EXISTS `tbl_compra_hist` (
+  `Folio` int(10) UNSIGNED NOT NULL,
+  `Importe_Total` decimal(12,2) NOT NULL DEFAULT 0.00,
+  `Cantidad_Total` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  `Hora` datetime NOT NULL,
+  `ID_Modo_Entrega` int(10) UNSIGNED NOT NULL,
+  `ID_Fecha` int(10) UNSIGNED NOT NULL,
+  `ID_Mesa` int(10) UNSIGNED NOT NULL,
+  `Version` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (`Folio`),
+  KEY `idx_compra_hist_modo` (`ID_Modo_Entrega`),
+  KEY `idx_compra_hist_fecha` (`ID_Fecha`),
+  KEY `idx_compra_hist_mesa` (`ID_Mesa`),
+  CONSTRAINT `fk_compra_hist_fecha` FOREIGN KEY (`ID_Fecha`) REFERENCES `tbl_fecha` (`ID_Fecha`),
+  CONSTRAINT `fk_compra_hist_mesa` FOREIGN KEY (`ID_Mesa`) REFERENCES `tbl_mesa` (`ID_Mesa`),
+  CONSTRAINT `fk_compra_hist_modo` FOREIGN KEY (`ID_Modo_Entrega`) REFERENCES `tbl_modo_entrega` (`ID_Modo_Entrega`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `tbl_detalle_hist` (
+  `ID_Detalle` int(10) UNSIGNED NOT NULL,
+  `Folio` int(10) UNSIGNED NOT NULL,
+  `ID_Producto` int(10) UNSIGNED NOT NULL,
+  `Cantidad` int(10) UNSIGNED NOT NULL DEFAULT 1,
+  `Precio_Unit` decimal(10,2) NOT NULL DEFAULT 0.00,
+  `Subtotal` decimal(12,2) NOT NULL DEFAULT 0.00,
+  `Version` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (`ID_Detalle`),
+  KEY `idx_detalle_hist_folio` (`Folio`),
+  KEY `idx_detalle_hist_producto` (`ID_Producto`),
+  CONSTRAINT `fk_detalle_hist_compra` FOREIGN KEY (`Folio`) REFERENCES `tbl_compra_hist` (`Folio`) ON DELETE CASCADE,
+  CONSTRAINT `fk_detalle_hist_producto` FOREIGN KEY (`ID_Producto`) REFERENCES `tbl_producto` (`ID_Producto`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
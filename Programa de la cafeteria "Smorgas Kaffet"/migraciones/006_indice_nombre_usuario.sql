@@ -0,0 +1,8 @@
+-- Migración 006: índice por Nombre_Usuario. login(), login_requerido() y el cierre de sesión
+-- buscan por Nombre_Usuario, pero la única clave era ux_usuarios_nombre_norm (la columna
+-- generada en minúsculas): cada búsqueda recorría TBL_USUARIOS completa. Con la colación
+-- utf8mb4_unicode_ci la comparación ya ignora mayúsculas, igual que la clave única.
+-- Detectado por herramientas/planes_sql.py.
+
+ALTER TABLE `tbl_usuarios`
+  ADD KEY IF NOT EXISTS `idx_usuarios_nombre` (`Nombre_Usuario`);
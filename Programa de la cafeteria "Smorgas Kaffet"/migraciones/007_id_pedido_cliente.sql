@@ -0,0 +1,12 @@
+-- Migración 007: ID_Pedido_Cliente en las cuentas (UUID que genera el formulario de
+-- pagina2). El diario de pedidos de app.py (PEDIDOS_DIARIO) lo usa para aplicar cada
+-- pedido una sola vez aunque se repita (reintento, reinicio, doble envío del formulario).
+-- Las cuentas anteriores quedan en NULL (el índice UNIQUE admite varios NULL).
+
+ALTER TABLE `tbl_compra`
+  ADD COLUMN IF NOT EXISTS `ID_Pedido_Cliente` char(36) DEFAULT NULL,
+  ADD UNIQUE KEY IF NOT EXISTS `ux_compra_pedido` (`ID_Pedido_Cliente`);
+
+ALTER TABLE `tbl_compra_hist`
+  ADD COLUMN IF NOT EXISTS `ID_Pedido_Cliente` char(36) DEFAULT NULL,
+  ADD UNIQUE KEY IF NOT EXISTS `ux_compra_hist_pedido` (`ID_Pedido_Cliente`);
@@ -0,0 +1,38 @@
+-- Migración 008: se quita el disparador trg_compra_totales_au (AFTER UPDATE en tbl_detalle).
+-- En cada UPDATE de un renglón volvía a sumar todo el folio y sobrescribía
+-- Cantidad_Total/Importe_Total: anulaba el modo "delta" de detalle_update()
+-- (DETALLE_MODO_TOTALES), hacía un SUM por renglón al guardar varios en
+-- /venta/<folio>/detalles, y sumaba Cantidad * Precio_Unit en lugar del Subtotal
+-- redondeado que guarda app.py (centavos de diferencia que conciliar_totales() reporta
+-- como deriva). Los totales los mantiene app.py en la misma transacción que el detalle y
+-- conciliar_totales() detecta (y con POST /admin/conciliacion?corregir=1 repara) cualquier deriva.
+--
+-- Antes de quitarlo: el /add original insertaba el detalle sin Subtotal, así que esos
+-- renglones quedaron en 0.00 (DEFAULT) y solo el disparador los contaba en la cabecera
+-- (Cantidad * Precio_Unit). Se rellena su Subtotal y se recalculan las cabeceras desde el
+-- detalle corregido; si no, el modo "delta" sumaría el renglón otra vez y la conciliación
+-- y los resúmenes tomarían esos 0.00 como importes reales.
+-- Después de aplicarla: flask --app app reconstruir-resumenes (los resúmenes de
+-- migraciones/002 se llenaron con los Subtotal en 0.00).
+
+UPDATE `tbl_detalle`
+   SET `Subtotal` = ROUND(`Cantidad` * `Precio_Unit`, 2), `Version` = `Version` + 1
+ WHERE `Subtotal` = 0 AND `Cantidad` > 0;
+
+UPDATE `tbl_detalle_hist`
+   SET `Subtotal` = ROUND(`Cantidad` * `Precio_Unit`, 2), `Version` = `Version` + 1
+ WHERE `Subtotal` = 0 AND `Cantidad` > 0;
+
+UPDATE `tbl_compra` c
+  JOIN (SELECT `Folio`, SUM(`Cantidad`) AS cant, SUM(`Subtotal`) AS imp
+          FROM `tbl_detalle` GROUP BY `Folio`) d ON d.`Folio` = c.`Folio`
+   SET c.`Cantidad_Total` = d.cant, c.`Importe_Total` = d.imp, c.`Version` = c.`Version` + 1
+ WHERE c.`Cantidad_Total` <> d.cant OR c.`Importe_Total` <> d.imp;
+
+UPDATE `tbl_compra_hist` c
+  JOIN (SELECT `Folio`, SUM(`Cantidad`) AS cant, SUM(`Subtotal`) AS imp
+          FROM `tbl_detalle_hist` GROUP BY `Folio`) d ON d.`Folio` = c.`Folio`
+   SET c.`Cantidad_Total` = d.cant, c.`Importe_Total` = d.imp, c.`Version` = c.`Version` + 1
+ WHERE c.`Cantidad_Total` <> d.cant OR c.`Importe_Total` <> d.imp;
+
+DROP TRIGGER IF EXISTS `trg_compra_totales_au`;
@@ -0,0 +1,133 @@
+# =============================
+# Smörgås Kaffet - Diario de pedidos (pytest)
+# Recuperación, aplicación y compactación del diario de /add (PEDIDOS_DIARIO) sobre un
+# archivo temporal, sin BD: la conexión y el INSERT de la cuenta son dobles de prueba.
+# =============================
+
+import os
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as smorgas  # noqa: E402  (necesita el directorio de app.py en sys.path)
+
+LINEAS = [{"id_producto": 3, "cantidad": 2, "precio": Decimal("10.50"), "subtotal": Decimal("21.00")}]
+ID_A = "aaaaaaaa-aaaa-4aaa-8aaa-aaaaaaaaaaaa"
+ID_B = "bbbbbbbb-bbbb-4bbb-8bbb-bbbbbbbbbbbb"
+
+
+class _BD:
+    """TBL_COMPRA de mentira: ID_Pedido_Cliente -> Folio, y cuántos INSERT se hicieron."""
+
+    def __init__(self):
+        self.folios, self.inserts = {}, 0
+
+    @contextmanager
+    def conexion(self, rol=None):
+        yield _Conexion(self)
+
+    def insertar(self, cur, id_fecha, id_mesa, id_modo, hora, lineas, id_pedido):
+        self.inserts += 1
+        self.folios[id_pedido] = 100 + self.inserts
+        return self.folios[id_pedido]
+
+class _Conexion:
+    def __init__(self, bd):
+        self.bd = bd
+
+    def cursor(self):
+        return _Cursor(self.bd)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class _Cursor:
+    def __init__(self, bd):
+        self.bd, self.fila = bd, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params=None):
+        assert sql == smorgas.SQL_FOLIO_PEDIDO
+        folio = self.bd.folios.get(params[0])
+        self.fila = {"Folio": folio} if folio else None
+
+    def fetchone(self):
+        return self.fila
+
+
+@pytest.fixture
+def diario(tmp_path, monkeypatch):
+    """Diario vacío en tmp_path, sin hilo aplicador y con la BD de mentira."""
+    bd = _BD()
+    ruta = str(tmp_path / "pedidos.jsonl")
+    monkeypatch.setattr(smorgas, "PEDIDOS_DIARIO", ruta)
+    monkeypatch.setattr(smorgas, "PEDIDOS_DIARIO_MAX_BYTES", 0)
+    monkeypatch.setattr(smorgas, "_DIARIO", dict(smorgas._DIARIO, fd=None, hilo=None, escritos=0,
+                                                 sincronizados=0, aplicados=0, rechazados=0))
+    monkeypatch.setattr(smorgas, "_PEDIDOS", OrderedDict())
+    monkeypatch.setattr(smorgas, "_PEDIDOS_RESUELTOS", OrderedDict())
+    monkeypatch.setattr(smorgas, "_bucle_diario", lambda: None)
+    monkeypatch.setattr(smorgas, "get_db_connection", bd.conexion)
+    monkeypatch.setattr(smorgas, "_id_fecha", lambda conn, dia: 1)
+    monkeypatch.setattr(smorgas, "_insertar_cuenta", bd.insertar)
+    yield ruta, bd
+    if smorgas._DIARIO["fd"] is not None:
+        os.close(smorgas._DIARIO["fd"])
+
+def _encolar(id_pedido):
+    with smorgas.app.test_request_context("/add"):
+        smorgas.session["usuario"] = "ana"
+        return smorgas._encolar_pedido(id_pedido, 101, 1, datetime(2026, 10, 18, 9, 0), LINEAS)
+
+
+def test_linea_a_medias_se_recorta(diario):
+    ruta, _ = diario
+    _encolar(ID_A)
+    with open(ruta, "ab") as f:
+        f.write(b'{"id":"' + ID_B.encode() + b'","lin')   # caída a mitad de la escritura
+    assert list(smorgas._leer_diario(ruta)) == [ID_A]
+    with open(ruta, "rb") as f:
+        assert f.read().endswith(b"}\n")
+
+def test_pedido_repetido_se_aplica_una_vez(diario):
+    ruta, bd = diario
+    assert _encolar(ID_A) is True
+    assert _encolar(ID_A) is False   # doble envío del formulario
+    smorgas._aplicar_pendientes()
+    assert bd.inserts == 1 and smorgas._PEDIDOS_RESUELTOS[ID_A]["folio"] == bd.folios[ID_A]
+
+    # Caída después del COMMIT pero antes de anotar el Folio: al reabrir vuelve a estar
+    # pendiente y _aplicar_pedido encuentra su Folio en vez de insertarlo otra vez
+    with open(ruta, "rb") as f:
+        sin_marca = f.read().splitlines(keepends=True)[:-1]
+    with open(ruta, "wb") as f:
+        f.writelines(sin_marca)
+    pendientes = smorgas._leer_diario(ruta)
+    assert list(pendientes) == [ID_A]
+    assert smorgas._aplicar_pedido(pendientes[ID_A]) == bd.folios[ID_A]
+    assert bd.inserts == 1
+
+def test_compactar_conserva_pendientes(diario):
+    ruta, bd = diario
+    _encolar(ID_A)
+    _encolar(ID_B)
+    smorgas._resolver_pedido(smorgas._PEDIDOS[ID_A], folio=7)
+    smorgas._compactar_diario()   # ID_B sigue sin aplicar: no se puede vaciar
+    assert list(smorgas._leer_diario(ruta)) == [ID_B]
+
+    smorgas._aplicar_pendientes()
+    smorgas._compactar_diario()
+    assert os.path.getsize(ruta) == 0 and not smorgas._PEDIDOS
@@ -0,0 +1,67 @@
+# =============================
+# Smörgås Kaffet - Regresión de planes de SQL (pytest)
+# Corre herramientas/planes_sql.py contra una BD de prueba chica recién generada y
+# falla si alguna sentencia (o un disparador) no pasa. Se salta si no hay MariaDB.
+# =============================
+"""
+Misma revisión que `python herramientas/planes_sql.py --recrear`, con pocos datos.
+
+Conexión con las variables de las herramientas: DB_USER_DEFAULT / DB_PASS_DEFAULT y
+además SMORGAS_PRUEBA_HOST (127.0.0.1) y SMORGAS_PRUEBA_PUERTO (3306). La BD de trabajo
+(SMORGAS_PRUEBA_BD_PLANES, por defecto proyecto_smorgas_planes) se borra y recrea.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+import pytest
+
+pymysql = pytest.importorskip("pymysql")
+
+DIR_HERRAMIENTAS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "herramientas")
+sys.path.insert(0, DIR_HERRAMIENTAS)
+
+import bd_prueba      # noqa: E402  (necesita DIR_HERRAMIENTAS en sys.path)
+import generar_datos  # noqa: E402
+import planes_sql     # noqa: E402
+
+
+def _args():
+    ap = argparse.ArgumentParser()
+    generar_datos.agregar_argumentos(ap)
+    args = ap.parse_args([
+        "--db-host", os.getenv("SMORGAS_PRUEBA_HOST", "127.0.0.1"),
+        "--db-puerto", os.getenv("SMORGAS_PRUEBA_PUERTO", "3306"),
+        "--bd", os.getenv("SMORGAS_PRUEBA_BD_PLANES", "proyecto_smorgas_planes"),
+        "--recrear", "--anios", "0.25", "--detalles", "20000", "--usuarios", "200",
+    ])
+    args.umbral_filas = 1000
+    return args
+
+
+@pytest.fixture(scope="module")
+def args():
+    args = _args()
+    try:
+        bd_prueba.conectar(args).close()
+    except pymysql.MySQLError as e:
+        pytest.skip(f"sin MariaDB en {args.db_host}:{args.db_puerto}: {e}")
+    generar_datos.generar(args)
+    random.seed(args.semilla)
+    return args
+
+
+def test_planes_sin_alertas(args, capsys):
+    resultado = planes_sql.revisar(args, list(planes_sql.CASOS_PLANES))
+    if planes_sql.fallida(resultado):
+        planes_sql.imprimir(resultado)
+        pytest.fail("planes_sql encontró sentencias con alertas, errores, sin cubrir o disparadores:\n"
+                    + capsys.readouterr().out)
+
+
+def test_sin_disparadores(args):
+    # migraciones/008 quita trg_compra_totales_au; ninguna migración posterior debe volver a crear uno
+    resultado = planes_sql.revisar(args, [])
+    assert [e["en"] for e in resultado["sentencias"] if e["estado"] == "disparador"] == []